@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+'''
+chunking_benchmark.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Compare fixed-size and content-defined chunking on shifted data. A file is
+stored once and then again after data has been inserted or removed. For
+both chunking schemes the amount of data that needs to be uploaded for the
+second version and the resulting de-duplication ratio are reported.
+
+---
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+from cStringIO import StringIO
+import hashlib
+import logging
+import os
+import struct
+import sys
+
+# We are running from the S3QL source directory, make sure
+# that we use modules from this directory
+basedir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..'))
+if (os.path.exists(os.path.join(basedir, 'setup.py')) and
+    os.path.exists(os.path.join(basedir, 'src', 's3ql', '__init__.py'))):
+    sys.path = [os.path.join(basedir, 'src')] + sys.path
+
+from s3ql.common import setup_logging
+from s3ql.parse_args import ArgumentParser
+
+log = logging.getLogger('benchmark')
+
+# Size of reads from the input stream
+BUFSIZE = 256 * 1024
+
+# Number of bytes that influence the rolling hash. Since the hash is
+# shifted by one bit for every byte, older bytes drop out of the 32 bit
+# value after this many bytes.
+WINDOW_SIZE = 32
+
+def _gear_table():
+    '''Return table of pseudo-random 32 bit values for every byte value
+
+    The table has to be the same for every run, otherwise chunks created
+    at different times would not match.
+    '''
+
+    return [ struct.unpack(b'<I', hashlib.sha256(struct.pack(b'<I', i)).digest()[:4])[0]
+             for i in range(256) ]
+
+GEAR = _gear_table()
+
+def fixed_chunks(fh, size):
+    '''Split *fh* into chunks of *size* bytes
+
+    This corresponds to the block layout used by the file system. Inserting
+    or removing data shifts all following chunk boundaries.
+    '''
+
+    while True:
+        buf = fh.read(size)
+        if not buf:
+            break
+        yield buf
+
+def cdc_chunks(fh, avg_size, min_size=None, max_size=None):
+    '''Split *fh* into content-defined chunks
+
+    Chunk boundaries are placed where a rolling hash over the last
+    `WINDOW_SIZE` bytes has a specific value, so they depend only on the
+    surrounding data and not on the offset in the stream. Inserting or
+    removing data therefore only changes the chunks around the modified
+    region.
+
+    *avg_size* must be a power of two. Chunks are at least *min_size*
+    (default: *avg_size*/4) and at most *max_size* (default: 4 *
+    *avg_size*) bytes long, so the average chunk is about *min_size* +
+    *avg_size* bytes.
+    '''
+
+    if avg_size < 2 or avg_size & (avg_size - 1):
+        raise ValueError('avg_size must be a power of two')
+    if min_size is None:
+        min_size = avg_size // 4
+    if max_size is None:
+        max_size = 4 * avg_size
+    if not 0 < min_size < max_size:
+        raise ValueError('Invalid chunk size limits')
+
+    # Use the highest bits of the hash, since they depend on all
+    # bytes in the window
+    bits = avg_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    buf = b''
+    eof = False
+    while True:
+        while not eof and len(buf) < max_size:
+            tmp = fh.read(BUFSIZE)
+            if not tmp:
+                eof = True
+            buf += tmp
+
+        if not buf:
+            break
+
+        cut = _find_boundary(buf, min_size, max_size, mask)
+        yield buf[:cut]
+        buf = buf[cut:]
+
+def _find_boundary(buf, min_size, max_size, mask):
+    '''Return length of the first chunk in *buf*'''
+
+    size = min(len(buf), max_size)
+    if size <= min_size:
+        return size
+
+    # Start hashing early enough that the hash at *min_size* is
+    # determined by a complete window
+    start = max(0, min_size - WINDOW_SIZE)
+    data = bytearray(buf[start:size])
+    gear = GEAR
+    hash_ = 0
+    pos = start
+    for byte in data:
+        hash_ = ((hash_ << 1) + gear[byte]) & 0xffffffff
+        pos += 1
+        if pos > min_size and not hash_ & mask:
+            return pos
+
+    return size
+
+def parse_args(args):
+    '''Parse command line'''
+
+    parser = ArgumentParser(
+                description='Compare upload volume and de-duplication ratio of fixed-size '
+                            'and content-defined chunking when data is shifted.')
+
+    parser.add_quiet()
+    parser.add_debug()
+    parser.add_version()
+    parser.add_argument('--file', metavar='<path>', default=None,
+                        help='Use contents of this file instead of random data')
+    parser.add_argument('--size', type=int, default=8, metavar='<MB>',
+                        help='Size of random test data (default: %(default)d)')
+    parser.add_argument('--blocksize', type=int, default=64, metavar='<KB>',
+                        help='Block size of the fixed scheme and average chunk size of '
+                             'the content-defined scheme, must be a power of two '
+                             '(default: %(default)d)')
+    parser.add_argument('--shift', type=int, default=100, metavar='<bytes>',
+                        help='Number of bytes that are inserted or removed '
+                             '(default: %(default)d)')
+
+    return parser.parse_args(args)
+
+def store(chunks, known):
+    '''Add *chunks* to *known* and return number of new bytes'''
+
+    new = 0
+    for buf in chunks:
+        hash_ = hashlib.sha256(buf).digest()
+        if hash_ not in known:
+            known.add(hash_)
+            new += len(buf)
+    return new
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    options = parse_args(args)
+    setup_logging(options)
+
+    if options.file:
+        with open(options.file, 'rb') as fh:
+            data = fh.read()
+    else:
+        data = os.urandom(options.size * 1024**2)
+
+    blocksize = options.blocksize * 1024
+    if blocksize & (blocksize - 1):
+        raise SystemExit('Block size must be a power of two')
+    
+    # The content-defined chunks are min_size + avg_size bytes on average
+    schemes = [ ('fixed', lambda fh: fixed_chunks(fh, blocksize)),
+                ('cdc', lambda fh: cdc_chunks(fh, blocksize // 2, min_size=blocksize // 2,
+                                              max_size=4 * blocksize)) ]
+
+    middle = len(data) // 2
+    filler = os.urandom(options.shift)
+    variants = [ ('insert at start', filler + data),
+                 ('insert in middle', data[:middle] + filler + data[middle:]),
+                 ('remove in middle', data[:middle] + data[middle + options.shift:]) ]
+
+    print('%-18s %-6s %12s %12s %8s' % ('Change', 'Scheme', 'Chunks', 'Upload (KB)', 'Dedup'))
+    for (name, modified) in variants:
+        for (scheme, chunker) in schemes:
+            log.info('Chunking data with %s scheme (%s)...', scheme, name)
+            known = set()
+            stored = store(chunker(StringIO(data)), known)
+            chunks = list(chunker(StringIO(modified)))
+            upload = store(chunks, known)
+            stored += upload
+            print('%-18s %-6s %12d %12.1f %8.2f'
+                  % (name, scheme, len(chunks), upload / 1024,
+                     (len(data) + len(modified)) / stored))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
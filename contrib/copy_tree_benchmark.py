@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+copy_tree_benchmark.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Measure the runtime of a snapshot (as created by s3qlcp) of a synthetic
+directory tree, and for how long the global lock is held without
+interruption while the copy is running. The file system is operated
+in-process on top of a local bucket.
+
+---
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+import atexit
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+# We are running from the S3QL source directory, make sure
+# that we use modules from this directory
+basedir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..'))
+if (os.path.exists(os.path.join(basedir, 'setup.py')) and
+    os.path.exists(os.path.join(basedir, 'src', 's3ql', '__init__.py'))):
+    sys.path = [os.path.join(basedir, 'src')] + sys.path
+
+from s3ql import fs
+from s3ql.backends import local
+from s3ql.backends.common import BucketPool
+from s3ql.block_cache import BlockCache
+from s3ql.common import setup_logging, create_tables, init_tables, ROOT_INODE
+from s3ql.database import Connection
+from s3ql.parse_args import ArgumentParser
+import llfuse
+
+log = logging.getLogger('benchmark')
+
+class Ctx(object):
+    def __init__(self):
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+
+class LockProbe(threading.Thread):
+    '''Repeatedly acquire the global lock and record the waiting times'''
+
+    def __init__(self, interval):
+        super(LockProbe, self).__init__()
+        self.interval = interval
+        self.waits = list()
+        self.stop = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        while not self.stop.is_set():
+            stamp = time.time()
+            with llfuse.lock:
+                self.waits.append(time.time() - stamp)
+            time.sleep(self.interval)
+
+def parse_args(args):
+    '''Parse command line'''
+
+    parser = ArgumentParser(
+                description='Measure the runtime of a snapshot of a synthetic directory '
+                            'tree and the maximum time for which the global lock is held.')
+
+    parser.add_quiet()
+    parser.add_debug()
+    parser.add_version()
+    parser.add_argument('--depth', type=int, default=3, metavar='<no>',
+                        help='Number of directory levels below the top directory '
+                             '(default: %(default)d)')
+    parser.add_argument('--fanout', type=int, default=10, metavar='<no>',
+                        help='Number of subdirectories in every directory '
+                             '(default: %(default)d)')
+    parser.add_argument('--files', type=int, default=20, metavar='<no>',
+                        help='Number of files in every directory (default: %(default)d)')
+    parser.add_argument('--size', type=int, default=4, metavar='<KB>',
+                        help='Size of every file. All files have the same contents, so only '
+                             'one block has to be stored (default: %(default)d)')
+
+    return parser.parse_args(args)
+
+def make_tree(server, id_p, depth, options, data):
+    '''Create synthetic tree in *id_p* and return number of entries'''
+
+    ctx = Ctx()
+    count = 0
+    for i in range(options.files):
+        (fh, _) = server.create(id_p, b'file_%d' % i,
+                                stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR, ctx)
+        if data:
+            server.write(fh, 0, data)
+        server.release(fh)
+        count += 1
+
+    if depth == 0:
+        return count
+
+    for i in range(options.fanout):
+        inode = server.mkdir(id_p, b'dir_%d' % i, stat.S_IFDIR | stat.S_IRWXU, ctx)
+        count += 1 + make_tree(server, inode.id, depth - 1, options, data)
+
+    return count
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    options = parse_args(args)
+    setup_logging(options)
+
+    bucket_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, bucket_dir)
+    cachedir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, cachedir, True)
+    dbfile = tempfile.NamedTemporaryFile()
+
+    db = Connection(dbfile.name)
+    create_tables(db)
+    init_tables(db)
+
+    bucket_pool = BucketPool(lambda: local.Bucket(bucket_dir, None, None))
+    cache = BlockCache(bucket_pool, db, cachedir + '/cache', 10 * 1024**2)
+    server = fs.Operations(cache, db, 64 * 1024)
+    probe = LockProbe(fs.GIL_RELEASE_INTERVAL / 10)
+
+    llfuse.lock.acquire()
+    try:
+        ctx = Ctx()
+        log.info('Creating directory tree...')
+        src = server.mkdir(ROOT_INODE, b'source', stat.S_IFDIR | stat.S_IRWXU, ctx)
+        entries = make_tree(server, src.id, options.depth, options,
+                            b'x' * (options.size * 1024))
+        dst = server.mkdir(ROOT_INODE, b'dest', stat.S_IFDIR | stat.S_IRWXU, ctx)
+        cache.commit()
+
+        log.info('Copying %d entries...', entries)
+        probe.start()
+        stamp = time.time()
+        server.copy_tree(src.id, dst.id)
+        runtime = time.time() - stamp
+        probe.stop.set()
+
+    finally:
+        llfuse.lock.release()
+        probe.stop.set()
+        if probe.is_alive():
+            probe.join()
+        with llfuse.lock:
+            server.destroy()
+            cache.destroy()
+        db.close()
+
+    waits = probe.waits
+    print('')
+    print('Copied %d entries in %.2f seconds (%.0f entries/sec)'
+          % (entries, runtime, entries / runtime))
+    if waits:
+        print('Lock acquired %d times during the copy, waited %.3f seconds on average '
+              'and %.3f seconds at most' % (len(waits), sum(waits) / len(waits), max(waits)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+'''
+readahead_benchmark.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Measure sequential read throughput with and without read-ahead. The file
+system is operated in-process on top of a local bucket that adds a fixed
+latency to every object retrieval, so that the effect of prefetching can
+be observed without network access.
+
+---
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+import atexit
+import logging
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+# We are running from the S3QL source directory, make sure
+# that we use modules from this directory
+basedir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), '..'))
+if (os.path.exists(os.path.join(basedir, 'setup.py')) and
+    os.path.exists(os.path.join(basedir, 'src', 's3ql', '__init__.py'))):
+    sys.path = [os.path.join(basedir, 'src')] + sys.path
+
+from s3ql import fs
+from s3ql.backends import local
+from s3ql.backends.common import BucketPool
+from s3ql.block_cache import BlockCache
+from s3ql.common import setup_logging, create_tables, init_tables, ROOT_INODE
+from s3ql.database import Connection
+from s3ql.parse_args import ArgumentParser
+import llfuse
+
+log = logging.getLogger('benchmark')
+
+# Size of the read requests, this is what the kernel typically uses
+READ_SIZE = 128 * 1024
+
+class SlowBucket(local.Bucket):
+    '''A local bucket that delays every object retrieval'''
+
+    def __init__(self, name, latency):
+        super(SlowBucket, self).__init__(name, None, None)
+        self.latency = latency
+
+    def open_read(self, key):
+        time.sleep(self.latency)
+        return super(SlowBucket, self).open_read(key)
+
+class Ctx(object):
+    def __init__(self):
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+
+def parse_args(args):
+    '''Parse command line'''
+
+    parser = ArgumentParser(
+                description='Measure sequential read throughput with and without '
+                            'read-ahead against a backend with artificial latency.')
+
+    parser.add_quiet()
+    parser.add_debug()
+    parser.add_version()
+    parser.add_argument('--size', type=int, default=64, metavar='<MB>',
+                        help='Size of the test file (default: %(default)d)')
+    parser.add_argument('--blocksize', type=int, default=1024, metavar='<KB>',
+                        help='File system block size (default: %(default)d)')
+    parser.add_argument('--latency', type=int, default=100, metavar='<ms>',
+                        help='Latency of every object retrieval (default: %(default)d)')
+    parser.add_argument('--readahead', type=int, default=8, metavar='<blocks>',
+                        help='Read-ahead window to compare against (default: %(default)d)')
+    parser.add_argument('--threads', type=int, default=8, metavar='<no>',
+                        help='Number of transfer threads (default: %(default)d)')
+
+    return parser.parse_args(args)
+
+def read_file(server, inode, size):
+    '''Read *inode* sequentially and return throughput in bytes/sec'''
+
+    fh = server.open(inode, os.O_RDONLY)
+    stamp = time.time()
+    offset = 0
+    while offset < size:
+        buf = server.read(fh, offset, READ_SIZE)
+        offset += len(buf)
+    dt = time.time() - stamp
+    server.release(fh)
+
+    return size / dt
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    options = parse_args(args)
+    setup_logging(options)
+
+    size = options.size * 1024**2
+    blocksize = options.blocksize * 1024
+
+    bucket_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, bucket_dir)
+    cachedir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, cachedir, True)
+    dbfile = tempfile.NamedTemporaryFile()
+
+    db = Connection(dbfile.name)
+    create_tables(db)
+    init_tables(db)
+
+    bucket_pool = BucketPool(lambda: SlowBucket(bucket_dir, options.latency / 1000))
+    cache = BlockCache(bucket_pool, db, cachedir + '/cache', 2 * size + blocksize)
+    server = fs.Operations(cache, db, blocksize)
+
+    llfuse.lock.acquire()
+    cache.init(options.threads)
+    try:
+        log.info('Creating %d MB test file...', options.size)
+        (fh, inode) = server.create(ROOT_INODE, b'testfile',
+                                    stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR, Ctx())
+        offset = 0
+        while offset < size:
+            offset += server.write(fh, offset, os.urandom(READ_SIZE))
+        server.release(fh)
+
+        results = dict()
+        for readahead in (0, options.readahead):
+            # Make sure that everything has to be downloaded again
+            cache.clear()
+            cache.max_readahead = readahead
+            log.info('Reading with read-ahead window of %d blocks...', readahead)
+            results[readahead] = read_file(server, inode.id, size)
+
+    finally:
+        server.destroy()
+        cache.destroy()
+        llfuse.lock.release()
+        db.close()
+
+    print('')
+    for readahead in (0, options.readahead):
+        print('Read-ahead %3d blocks: %8.2f KB/sec'
+              % (readahead, results[readahead] / 1024))
+    if results[0]:
+        print('Speedup: %.2f' % (results[options.readahead] / results[0]))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -224,6 +224,22 @@ class AbstractBucket(object):
         If `force` is true, do not return an error if the key does not exist.
         """
         pass
+    
+    def delete_multi(self, keys):
+        """Delete objects stored under `keys`
+        
+        Keys that do not exist are ignored. This implementation deletes
+        the objects one at a time, backends that can delete several
+        objects with one request override it.
+        """
+        
+        for key in keys:
+            self.delete(key, force=True)
+            
+    def has_delete_multi(self):
+        '''If True, `delete_multi` deletes several objects with one request'''
+        
+        return False
 
     @abstractmethod
     def list(self, prefix=''):
@@ -357,6 +373,13 @@ class BetterBucket(AbstractBucket):
         object. Returns a file-like object.
         """
    
+        (meta_raw, nonce, compr) = self._prepare_write(key, metadata)
+        fh = self.bucket.open_write(key, meta_raw)
+        return self._wrap_write(fh, nonce, compr)
+    
+    def _prepare_write(self, key, metadata):
+        '''Return raw metadata, nonce and compressor for new object *key*'''
+        
         # We always store metadata (even if it's just None), so that we can
         # verify that the object has been created by us when we call lookup().
         meta_buf = pickle.dumps(metadata, 2)
@@ -384,8 +407,11 @@ class BetterBucket(AbstractBucket):
         elif not self.compression:
             compr = None
             meta_raw['compression'] = 'None'
-
-        fh = self.bucket.open_write(key, meta_raw)
+            
+        return (meta_raw, nonce, compr)
+    
+    def _wrap_write(self, fh, nonce, compr):
+        '''Wrap *fh* into encryption and compression filters'''
 
         if nonce:
             fh = EncryptFilter(fh, self.passphrase, nonce)
@@ -393,6 +419,27 @@ class BetterBucket(AbstractBucket):
             fh = CompressFilter(fh, compr)
             
         return fh
+    
+    def encode(self, key, data, metadata=None, pool=None):
+        '''Compress and encrypt *data* for storage as object *key*
+        
+        Returns a tuple of the raw metadata, the encoded data and the
+        compressed size, which can be passed to `store_encoded`. If *pool* is
+        a `multiprocessing.Pool`, the work is done by one of its worker
+        processes, so that it is not limited by the global interpreter lock.
+        '''
+        
+        args = (self.passphrase, self.compression, key, data, metadata)
+        if pool is None:
+            return encode_object(*args)
+        else:
+            return pool.apply(encode_object, args)
+    
+    def store_encoded(self, key, meta_raw, buf):
+        '''Store object *key* that has been prepared with `encode`'''
+        
+        with self.bucket.open_write(key, meta_raw) as fh:
+            fh.write(buf)
             
     def is_get_consistent(self):
         '''If True, objects retrievals are guaranteed to be up-to-date
@@ -427,6 +474,17 @@ class BetterBucket(AbstractBucket):
         """
         return self.bucket.delete(key, force)
 
+    def delete_multi(self, keys):
+        """Delete objects stored under `keys`
+        
+        Keys that do not exist are ignored.
+        """
+        return self.bucket.delete_multi(keys)
+    
+    def has_delete_multi(self):
+        '''If True, `delete_multi` deletes several objects with one request'''
+        return self.bucket.has_delete_multi()
+
     def list(self, prefix=''):
         '''List keys in bucket
 
@@ -781,6 +839,45 @@ class LegacyDecryptDecompressFilter(AbstractInputFilter):
     def readline(self):
         raise RuntimeError('not implemented')
     
+class WriteBuffer(object):
+    '''Collect written data in memory'''
+    
+    def __init__(self):
+        super(WriteBuffer, self).__init__()
+        self.parts = []
+        
+    def write(self, data):
+        self.parts.append(data)
+        
+    def getvalue(self):
+        return b''.join(self.parts)
+    
+    def close(self):
+        pass
+
+def encode_object(passphrase, compression, key, data, metadata=None):
+    '''Compress and encrypt *data* for storage as object *key*
+    
+    This function is executed by the worker processes of
+    `BetterBucket.encode`, so it must not depend on any state of the
+    calling process. Returns a tuple of the raw metadata, the encoded data
+    and the compressed size.
+    '''
+    
+    bucket = BetterBucket(passphrase, compression, None)
+    (meta_raw, nonce, compr) = bucket._prepare_write(key, metadata) #IGNORE:W0212
+    buf = WriteBuffer()
+    fh = bucket._wrap_write(buf, nonce, compr) #IGNORE:W0212
+    fh.write(data)
+    fh.close()
+    
+    if isinstance(fh, CompressFilter):
+        compr_size = fh.compr_size
+    else:
+        compr_size = len(data)
+        
+    return (meta_raw, buf.getvalue(), compr_size)
+
 def encrypt(buf, passphrase, nonce):
     '''Encrypt *buf*'''
 
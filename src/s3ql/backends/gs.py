@@ -55,6 +55,21 @@ class Bucket(s3.Bucket):
         
         return region
         
+    def delete_multi(self, keys):
+        '''Delete objects stored under *keys*
+        
+        Google Storage does not support multi-object delete requests,
+        so the objects are deleted one at a time.
+        '''
+        
+        for key in keys:
+            self.delete(key, force=True)
+            
+    def has_delete_multi(self):
+        '''If True, `delete_multi` deletes several objects with one request'''
+        
+        return False
+        
     def is_get_consistent(self):
         '''If True, objects retrievals are guaranteed to be up-to-date
         
@@ -20,6 +20,7 @@ import hashlib
 import tempfile
 import urllib
 import xml.etree.cElementTree as ElementTree
+from xml.sax.saxutils import escape as xml_escape
 import os
 import errno
 
@@ -31,6 +32,14 @@ C_MONTH_NAMES = [ 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
     
 XML_CONTENT_RE = re.compile('^application/xml(?:;\s+|$)', re.IGNORECASE)
 
+# Maximum number of keys in a multi-object delete request
+MAX_DELETE_KEYS = 1000
+
+# Error codes with which servers reject multi-object delete requests
+# if they do not support them
+DELETE_MULTI_UNSUPPORTED = ('NotImplemented', 'MethodNotAllowed', 'InvalidRequest',
+                            'InvalidArgument', 'MalformedXML')
+
 class Bucket(AbstractBucket):
     """A bucket stored in Amazon S3
     
@@ -54,6 +63,7 @@ class Bucket(AbstractBucket):
         self.aws_key = aws_key
         self.aws_key_id = aws_key_id
         self.namespace = 'http://oss.aliyun.com/doc/2011-03-01'
+        self.delete_multi_ok = True
         
         self._init()
         
@@ -121,6 +131,67 @@ class Bucket(AbstractBucket):
                 pass
             else:
                 raise NoSuchObject(key)
+
+    def delete_multi(self, keys):
+        '''Delete objects stored under *keys*
+        
+        Up to `MAX_DELETE_KEYS` objects are deleted with one request. Keys
+        that do not exist are ignored. If the server rejects multi-object
+        delete requests, this and all further calls delete the objects one
+        at a time.
+        '''
+        
+        keys = list(keys)
+        for i in range(0, len(keys), MAX_DELETE_KEYS):
+            batch = keys[i:i+MAX_DELETE_KEYS]
+            if self.delete_multi_ok:
+                try:
+                    self._delete_multi(batch)
+                    continue
+                except S3Error as exc:
+                    if exc.code not in DELETE_MULTI_UNSUPPORTED:
+                        raise
+                    log.info('Server does not support multi-object delete requests (%s), '
+                             'deleting objects one at a time.', exc)
+                    self.delete_multi_ok = False
+                    
+            for key in batch:
+                self.delete(key, force=True)
+            
+    def has_delete_multi(self):
+        '''If True, `delete_multi` deletes several objects with one request'''
+        
+        return self.delete_multi_ok
+        
+    @retry
+    def _delete_multi(self, keys):
+        '''Delete objects stored under *keys* with one request'''
+        
+        log.debug('delete_multi(%d keys)', len(keys))
+        
+        body = [ '<?xml version="1.0" encoding="UTF-8"?>', 
+                 '<Delete><Quiet>true</Quiet>' ]
+        for key in keys:
+            body.append('<Object><Key>%s</Key></Object>' % xml_escape(self.prefix + key))
+        body.append('</Delete>')
+        body = ''.join(body)
+        
+        # False positive, hashlib *does* have md5 member
+        #pylint: disable=E1101
+        headers = { 'content-type': 'application/xml',
+                    'content-md5': b64encode(hashlib.md5(body).digest()) }
+        resp = self._do_request('POST', '/', subres='delete', headers=headers, body=body)
+        
+        # In quiet mode, only failed deletions are reported
+        root = ElementTree.parse(resp).getroot()
+        for el in root:
+            if not el.tag.endswith('Error'):
+                continue
+            namespace = el.tag[:-len('Error')]
+            code = el.findtext(namespace + 'Code')
+            if code == 'NoSuchKey':
+                continue
+            raise get_S3Error(code, el.findtext(namespace + 'Message'))
              
     def list(self, prefix=''):
         '''List keys in bucket
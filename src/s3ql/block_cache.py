@@ -8,15 +8,21 @@ This program can be distributed under the terms of the GNU GPLv3.
 
 from __future__ import division, print_function, absolute_import
 from .backends.common import CompressFilter
+from .cache_policy import get_policy, LRUPolicy
+from .cache_stats import CacheStats
 from .common import sha256_fh
+from .concurrency import AIMDController
 from .database import NoSuchRowError
 from .ordered_dict import OrderedDict
-from Queue import Queue
+from Queue import Queue, Empty as QueueEmpty
 from contextlib import contextmanager
 from llfuse import lock, lock_released
+import cPickle as pickle
+import heapq
 import logging
+import multiprocessing
 import os
-import shutil
+import stat
 import threading
 import time
 
@@ -25,10 +31,56 @@ log = logging.getLogger("BlockCache")
  
 # Buffer size when writing objects
 BUFSIZE = 256 * 1024
+
+# Maximum number of cache files that are kept open at the same time
+MAX_OPEN_FILES = 128
+
+# Maximum time (in seconds) that a writer is delayed by `BlockCache.throttle`
+# when the amount of dirty data approaches the limit
+MAX_THROTTLE_DELAY = 0.1
  
+# Default size below which blocks are packed together with other small
+# blocks into one storage object
+PACK_THRESHOLD = 64 * 1024
+
+# Maximum (uncompressed) size of a packed object
+MAX_PACK_SIZE = 1024 * 1024
+
+# Packed objects are rewritten when less than this fraction of
+# their data is still used
+REPACK_THRESHOLD = 0.5
+
+# When an entry is uploaded because its writeback time has come, other small
+# entries are only packed into the same object if they become due within
+# this many seconds
+PACK_DUE_SLACK = 1
+
+# Number of downloaded packed objects that are kept in memory, so that
+# their other blocks can be read without downloading the object again
+PACK_CACHE_SIZE = 8
+
+# Maximum number of objects that are removed from the backend
+# with one request
+DELETE_BATCH_SIZE = 1000
+
+# Number of objects that a removal thread claims at once if the
+# backend can only remove one object per request
+SINGLE_DELETE_BATCH_SIZE = 10
+
+# Number of threads that remove objects from the backend
+REMOVAL_THREADS = 10
+
+# Number of seconds that a removal thread waits before it tries
+# again after the backend failed to remove objects
+REMOVAL_RETRY_DELAY = 5
+
 # Special queue entry that signals threads to terminate
 QuitSentinel = object()
 
+# Name of the file in the cache directory that lists the clean
+# cache entries that have been preserved when unmounting
+INDEX_NAME = 'index'
+
 class Distributor(object):
     '''
     Distributes objects to consumers.
@@ -40,6 +92,9 @@ class Distributor(object):
         self.slot = None
         self.cv = threading.Condition()
         
+        # Number of objects that have been offered but not yet consumed
+        self.pending = 0
+        
     def put(self, obj):
         '''Offer *obj* for consumption
         
@@ -51,6 +106,7 @@ class Distributor(object):
             raise ValueError("Can't put None into Queue")
         
         with self.cv:
+            self.pending += 1
             while self.slot is not None:
                 self.cv.wait()
             self.slot = obj
@@ -67,76 +123,111 @@ class Distributor(object):
                 self.cv.wait()
             tmp = self.slot
             self.slot = None
+            self.pending -= 1
             self.cv.notify_all()
         return tmp
                 
                 
-class SimpleEvent(object):
+class CompletionSignal(object):
     '''
-    Like threading.Event, but without any internal flag. Calls
-    to `wait` always block until some other thread calls
-    `notify` or `notify_all`.
+    Signals that some transfer has completed.
+
+    Waiting threads first obtain a ticket with `ticket()` (typically while
+    still holding the global lock) and then call `wait(ticket)`. The wait
+    returns as soon as `notify_all` has been called after the ticket was
+    issued, so notifications that occur between obtaining the ticket and
+    starting to wait are not lost.
     '''
     
     def __init__(self):
-        super(SimpleEvent, self).__init__()
+        super(CompletionSignal, self).__init__()
         self.__cond = threading.Condition(threading.Lock())
+        self.__seq = 0
 
+    def ticket(self):
+        return self.__seq
+    
     def notify_all(self):
-        self.__cond.acquire()
-        try:
+        with self.__cond:
+            self.__seq += 1
             self.__cond.notify_all()
-        finally:
-            self.__cond.release()
 
-    def notify(self):
-        self.__cond.acquire()
-        try:
-            self.__cond.notify()
-        finally:
-            self.__cond.release()
-            
-    def wait(self):
-        self.__cond.acquire()
-        try:
-            self.__cond.wait()
-            return
-        finally:
-            self.__cond.release()
+    def wait(self, ticket):
+        with self.__cond:
+            while self.__seq == ticket:
+                self.__cond.wait()
   
                                
 class CacheEntry(object):
     """An element in the block cache
     
-    If `obj_id` is `None`, then the object has not yet been
-    uploaded to the backend. 
+    If `block_id` is `None`, then the contents of the entry have not
+    yet been uploaded to the backend. 
     
     Attributes:
     -----------
     
     :dirty:
        entry has been changed since it was last uploaded.
+       
+    :dirtied: time at which the entry became dirty
+    
+    :modified: time of the last modification
+    
+    :block_id: 
+       if not `None`, the entry holds a clean copy of this block and its
+       cache file may be hard linked to by other entries (see
+       `BlockCache.shared`).
     
     :size: current file size
     
     :pos: current position in file
+    
+    :filename: name of the cache file
+    
+    The cache file is opened when it is first accessed and may be closed
+    with `close` at any time to save file descriptors. It is transparently
+    reopened when it is accessed again.
     """
 
-    __slots__ = [ 'dirty', 'inode', 'blockno', 'last_access',
-                  'size', 'pos', 'fh' ]
+    __slots__ = [ 'dirty', 'inode', 'blockno', 'last_access', 'dirtied',
+                  'modified', 'size', 'pos', '_fh', 'filename', 'block_id' ]
 
-    def __init__(self, inode, blockno, filename):
+    def __init__(self, inode, blockno, filename, existing=False):
         super(CacheEntry, self).__init__()
-        # Writing 100MB in 128k chunks takes 90ms unbuffered and
-        # 116ms with 1 MB buffer. Reading time does not depend on
-        # buffer size.
-        self.fh = open(filename, "w+b", 0)
+        if existing:
+            self._fh = None
+            self.size = os.path.getsize(filename)
+        else:
+            # Writing 100MB in 128k chunks takes 90ms unbuffered and
+            # 116ms with 1 MB buffer. Reading time does not depend on
+            # buffer size.
+            self._fh = open(filename, "w+b", 0)
+            self.size = 0
+        self.filename = filename
         self.dirty = False
+        self.block_id = None
         self.inode = inode
         self.blockno = blockno
         self.last_access = 0
+        self.dirtied = 0
+        self.modified = 0
         self.pos = 0
-        self.size = os.fstat(self.fh.fileno()).st_size
+
+    @property
+    def fh(self):
+        if self._fh is None:
+            self._fh = open(self.filename, "r+b", 0)
+            self._fh.seek(self.pos)
+        return self._fh
+    
+    def is_open(self):
+        return self._fh is not None
+
+    def open(self):
+        '''Make sure that the cache file is open'''
+        
+        self.fh
 
     def read(self, size=None):
         buf = self.fh.read(size)
@@ -154,8 +245,26 @@ class CacheEntry(object):
     def tell(self):
         return self.pos
 
+    def _copy_on_write(self):
+        '''Make sure that the cache file is not shared with other entries'''
+        
+        if self.dirty or os.stat(self.filename).st_nlink == 1:
+            return
+        
+        # The cache file is a hard link to a clean copy of the block,
+        # so we can simply replace our link by a private copy.
+        self.fh.seek(0)
+        buf = self.fh.read()
+        self.close()
+        os.unlink(self.filename)
+        self._fh = open(self.filename, "w+b", 0)
+        self._fh.write(buf)
+        self._fh.seek(self.pos)
+        
     def truncate(self, size=None):
+        self._copy_on_write()
         self.dirty = True
+        self.modified = time.time()
         self.fh.truncate(size)
         if size is None:
             if self.pos < self.size:
@@ -164,16 +273,20 @@ class CacheEntry(object):
             self.size = size
 
     def write(self, buf):
+        self._copy_on_write()
         self.dirty = True
+        self.modified = time.time()
         self.fh.write(buf)
         self.pos += len(buf)
         self.size = max(self.pos, self.size)
 
     def close(self):
-        self.fh.close()
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
         
     def unlink(self):
-        os.unlink(self.fh.name)
+        os.unlink(self.filename)
         
     def __str__(self):
         return ('<%sCacheEntry, inode=%d, blockno=%d>' 
@@ -193,17 +306,92 @@ class BlockCache(object):
     
     :path: where cached data is stored
     :entries: ordered dictionary of cache entries
-    :size: current size of all cached entries
+    :policy: eviction policy (see `cache_policy` module) that tracks the
+       clean cache entries. Dirty entries are never evicted.
+    :pinned: set of inodes whose blocks are pinned in the cache
+    :pinned_policy: LRU policy that tracks the clean entries of pinned
+       inodes. They are only evicted when no other clean entries are left.
+    :pinned_size: current size of the entries in `pinned_policy`
+    :max_pinned: amount of clean data of pinned inodes that does not
+       count against `max_size`
+    :dirty_entries: ordered dictionary of dirty cache entries, the entries
+       that became dirty first are at the tail
+    :dirty_size: current size of all dirty entries
+    :max_dirty: maximum amount of dirty data. Writers are blocked by `throttle`
+       while this limit is exceeded. `None` means no limit.
+    :dirty_thresh: amount of dirty data above which `throttle` starts
+       uploading dirty entries and delaying writers
+    :writeback_delay: number of seconds after the last modification at
+       which `upload_due` uploads a dirty entry
+    :max_dirty_age: maximum number of seconds that an entry stays dirty
+       before it is uploaded by `upload_due`, even if it is still being
+       modified
+    :writeback_queue: heap of ``(due, dirtied, key)`` tuples of dirty
+       entries, ordered by the time at which they have to be uploaded. When
+       an entry is modified again, its heap item is not updated, instead the
+       actual due time is recalculated when the item reaches the top. Items of
+       entries that have been uploaded (or have become dirty again since the
+       item was added) are discarded at that point as well.
+    :size: current size of all cached entries. Entries that share
+       a cache file are only counted once.
     :max_size: maximum size to which cache can grow
-    :in_transit: set of objects currently in transit and
-         (inode, blockno) tuples currently being uploaded 
+    :in_transit: dict of objects currently in transit and
+         (inode, blockno) tuples currently being uploaded. The values are
+         `threading.Event` instances that are set when the transfer
+         completes.
     :removed_in_transit: set of objects that have been removed from the db
        while in transit, and should be removed from the backend as soon
        as the transit completes.
-    :to_upload: distributes objects to upload to worker threads
-    :to_remove: distributes objects to remove to worker threads
-    :transfer_complete: signals completion of an object transfer
-       (either upload or download)
+    :orphans: dict of cache entries that have been removed from the cache
+       while in transit, indexed by (inode, blockno). Their cache files
+       have already been unlinked but are still read by the transfer, so
+       they are only closed when the transit completes.
+    :to_upload: distributes objects to upload to worker threads. Every
+       object is passed as ``(obj_id, members)`` tuple, where *members* is
+       a list of ``(el, block_id)`` tuples of the cache entries whose
+       contents are stored in the object (in that order).
+    :removal_pending: event that is set to wake up the removal threads
+       when objects have been added to the *deleted_objects* table
+    :removal_quit: if true, the removal threads terminate after
+       their current batch
+    :removing: set of objects in the *deleted_objects* table that are
+       currently being removed by one of the removal threads
+    :max_deletes: maximum number of objects that the removal threads remove
+       from the backend per second (`None` for no limit)
+    :to_repack: queue of packed objects that should be rewritten
+       by the repack threads to reclaim unused space
+    :repacking: set of objects in the `to_repack` queue
+    :to_download: queue of (inode, blockno, warmup) tuples that should be
+       prefetched into the cache by the download threads. *warmup* is set
+       for blocks that have been scheduled with `prefetch_block`.
+    :prefetching: set of (inode, blockno) tuples that are currently
+       in the `to_download` queue
+    :warmup_queued: number of blocks that have been scheduled with
+       `prefetch_block`
+    :warmup_done: number of blocks scheduled with `prefetch_block` that
+       have been processed by the download threads
+    :open_entries: ordered dictionary of cache entries whose cache file
+       may currently be open, most recently used first
+    :max_open: maximum number of entries in `open_entries`
+    :max_readahead: maximum number of blocks that are prefetched
+       ahead of a sequential reader (0 disables read-ahead)
+    :pack_threshold: dirty entries smaller than this are packed together
+       with other small entries when they are uploaded (0 disables packing)
+    :keep_cache: if true, clean cache entries are preserved when the cache
+       is destroyed and reused when the cache is created again
+    :shared: dict mapping block ids to the set of (inode, blockno) tuples
+       whose cache entries are hard links to the same clean copy of the
+       block. New entries for a cached block are linked to the existing
+       copy instead of being downloaded again, the first write to such an
+       entry creates a private copy.
+    :packs: ordered dictionary mapping the ids of the most recently
+       downloaded packed objects to their decoded contents, most recently
+       used first. At most `PACK_CACHE_SIZE` objects are kept.
+    :stats: `CacheStats` instance with counters and histograms that
+       describe the efficiency of the cache (see `get_stats`)
+    :slot_freed: signals completion of any transfer (either upload or
+       download). Threads that are waiting for a specific transfer should
+       wait for its `in_transit` event instead.
     
     The `in_transit` attribute is used to
     - Prevent multiple threads from downloading the same object
@@ -211,72 +399,241 @@ class BlockCache(object):
       uploaded completely (can happen when a cache entry is linked to a
       block while the object containing the block is still being
       uploaded)
+    - Prevent threads from downloading or removing an object while
+      it is being repacked
+
+    Small blocks are not stored in objects of their own. When a dirty entry
+    smaller than `pack_threshold` is uploaded, other small dirty entries are
+    uploaded at the same time and all new blocks are stored at consecutive
+    offsets (`blocks.obj_offset`) of one object. The object's refcount is the
+    number of blocks stored in it. Since objects are compressed and
+    encrypted as a whole, the complete object is retrieved to read one of
+    its blocks. When most of the blocks in a packed object have been
+    removed, the remaining blocks are copied into a new object.
     """
 
-    def __init__(self, bucket_pool, db, cachedir, max_size, max_entries=768):
+    def __init__(self, bucket_pool, db, cachedir, max_size, max_entries=768,
+                 max_readahead=0, keep_cache=False, policy='lru', max_dirty=None,
+                 pack_threshold=PACK_THRESHOLD, writeback_delay=10, max_dirty_age=120,
+                 max_deletes=None, max_pinned=0):
         log.debug('Initializing')
         
         self.path = cachedir
         self.db = db
         self.bucket_pool = bucket_pool
         self.entries = OrderedDict()
+        self.dirty_entries = OrderedDict()
+        self.open_entries = OrderedDict()
+        self.max_open = MAX_OPEN_FILES
+        self.dirty_size = 0
+        self.max_dirty = max_dirty
+        self.dirty_thresh = max_dirty // 2 if max_dirty is not None else None
+        self.writeback_delay = writeback_delay
+        self.max_dirty_age = max_dirty_age
+        self.writeback_queue = []
+        self.policy_name = policy
+        self.policy = get_policy(policy, max_entries)
         self.max_entries = max_entries
         self.size = 0
         self.max_size = max_size
-        self.in_transit = set()
+        self.pinned = set(inode for (inode,) in db.query('SELECT inode FROM pinned_inodes'))
+        self.pinned_policy = LRUPolicy(max_entries)
+        self.pinned_size = 0
+        self.max_pinned = max_pinned
+        self.in_transit = dict()
+        self.shared = dict()
+        self.packs = OrderedDict()
         self.removed_in_transit = set()
+        self.orphans = dict()
         self.to_upload = Distributor()
-        self.to_remove = Queue()
+        self.removal_pending = threading.Event()
+        self.removal_quit = False
+        self.removing = set()
+        self.max_deletes = max_deletes
+        self.to_repack = Queue()
+        self.repacking = set()
+        self.to_download = Queue()
+        self.prefetching = set()
+        self.warmup_queued = 0
+        self.warmup_done = 0
+        self.max_readahead = max_readahead
+        self.pack_threshold = pack_threshold
+        self.keep_cache = keep_cache
         self.upload_threads = []
         self.removal_threads = []
-        self.transfer_completed = SimpleEvent()
+        self.repack_threads = []
+        self.download_threads = []
+        self.upload_control = AIMDController(1, 1)
+        self.download_control = AIMDController(1, 1)
+        self.process_pool = None
+        self.stats = CacheStats()
+        self.slot_freed = CompletionSignal()
 
         if not os.path.exists(self.path):
             os.mkdir(self.path)
+        else:
+            self._load_index()
+        
+    def _load_index(self):
+        '''Reuse cache entries that have been preserved by a previous mount'''
+        
+        for (inode, blockno) in read_index(self.path, self.db):
+            el = CacheEntry(inode, blockno, os.path.join(self.path, '%d-%d' % (inode, blockno)),
+                            existing=True)
+            self.entries[(inode, blockno)] = el
+            self._add_clean(el)
+            self.size += el.size
+            
+        if self.entries:
+            log.info('Reusing %d cached blocks (%.2f MB) from previous mount.',
+                     len(self.entries), self.size / 1024**2)
+        
+    def _save_index(self):
+        '''Close all cache entries and write index of the clean ones
+        
+        Entries that are still dirty are left in the cache directory
+        without being listed in the index, so that they will be committed
+        by fsck.
+        '''
+        
+        keys = [ (el.inode, el.blockno) for el in self.entries.values_rev() 
+                 if not el.dirty ]
+        saved = set(write_index(self.path, self.db, keys))
+        
+        for el in self.entries.itervalues():
+            el.close()
+            if not el.dirty and (el.inode, el.blockno) not in saved:
+                el.unlink()
+        
+        log.info('Preserved %d cached blocks for next mount.', len(saved))
+        self.entries.clear()
+        self.dirty_entries.clear()
+        del self.writeback_queue[:]
+        self.open_entries.clear()
+        self.dirty_size = 0
+        self.policy = get_policy(self.policy_name, self.max_entries)
+        self.pinned_policy = LRUPolicy(self.max_entries)
+        self.pinned_size = 0
+        self.shared.clear()
+        self.size = 0
         
     def __len__(self):
         '''Get number of objects in cache'''
         return len(self.entries)
 
-    def init(self, threads=1):
-        '''Start worker threads'''
+    def init(self, threads=1, min_threads=1, processes=0):
+        '''Start worker threads
+        
+        *threads* upload and download threads are started, but the number
+        of concurrent transfers is adjusted between *min_threads* and
+        *threads* depending on how the backend copes with the load. If
+        *processes* is non-zero, data is compressed and encrypted by a pool
+        of that many worker processes instead of by the upload threads.
+        '''
+        
+        # Start the processes first, so that no threads are running
+        # when forking
+        if processes:
+            self.process_pool = multiprocessing.Pool(processes, init_worker)
+            
+        min_threads = min(min_threads, threads)
+        self.upload_control = AIMDController(min_threads, threads)
+        self.download_control = AIMDController(min_threads, threads)
         
         for _ in range(threads):
             t = threading.Thread(target=self._upload_loop)
             t.start()
             self.upload_threads.append(t)
             
-        for _ in range(10): 
+        for _ in range(threads):
+            t = threading.Thread(target=self._download_loop)
+            t.daemon = True # prefetching is only an optimization
+            t.start()
+            self.download_threads.append(t)
+            
+        # Objects may still be pending from the last mount
+        self.removal_quit = False
+        self.removal_pending.set()
+        for _ in range(REMOVAL_THREADS):
             t = threading.Thread(target=self._removal_loop)
-            t.daemon = True # interruption will do no permanent harm
             t.start()
             self.removal_threads.append(t)
+            
+        t = threading.Thread(target=self._repack_loop)
+        t.start()
+        self.repack_threads.append(t)
                         
     def destroy(self):
         '''Clean up and stop worker threads'''
         
-        log.debug('destroy(): clearing cache...')
-        self.clear()
+        # Stop prefetching first, so that no new entries are
+        # added to the cache while we are clearing it
+        with lock_released:
+            while True:
+                try:
+                    self.to_download.get_nowait()
+                except QueueEmpty:
+                    break
+            for t in self.download_threads:
+                self.to_download.put(QuitSentinel)
+            log.debug('destroy(): waiting for download threads...')
+            for t in self.download_threads:
+                t.join()
+        self.download_threads = []
+        self.prefetching.clear()
+        self.warmup_done = self.warmup_queued
+            
+        if self.keep_cache:
+            log.debug('destroy(): flushing cache...')
+            self.commit()
+            while self.transfer_in_progress():
+                self.wait()
+            self._save_index()
+        else:
+            log.debug('destroy(): clearing cache...')
+            self.clear()
         
         with lock_released:
             for t in self.upload_threads:
                 self.to_upload.put(QuitSentinel)
             
-            for t in self.removal_threads:
-                self.to_remove.put(QuitSentinel)          
+            # Repacking may remove objects, so the repack threads
+            # have to terminate before the removal threads
+            for t in self.repack_threads:
+                self.to_repack.put(QuitSentinel)
         
             log.debug('destroy(): waiting for upload threads...')
             for t in self.upload_threads:
                 t.join()
-
+                
+            log.debug('destroy(): waiting for repack threads...')
+            for t in self.repack_threads:
+                t.join()
+            
+            self.removal_quit = True
+            self.removal_pending.set()
             log.debug('destroy(): waiting for removal threads...')
             for t in self.removal_threads:
                 t.join()
                             
         self.upload_threads = []
+        self.repack_threads = []
         self.removal_threads = []
-                
-        os.rmdir(self.path)
+        
+        pending = self.db.get_val('SELECT COUNT(id) FROM deleted_objects')
+        if pending:
+            log.info('%d objects will be removed from the backend during the next mount.',
+                     pending)
+        
+        if self.process_pool is not None:
+            log.debug('destroy(): waiting for worker processes...')
+            with lock_released:
+                self.process_pool.close()
+                self.process_pool.join()
+            self.process_pool = None
+        
+        if not os.listdir(self.path):
+            os.rmdir(self.path)
         
     def _upload_loop(self):
         '''Process upload queue'''
@@ -289,196 +646,1106 @@ class BlockCache(object):
             
             self._do_upload(*tmp)   
                     
-    def _do_upload(self, el, obj_id):
-        '''Upload object'''
+    def _do_upload(self, obj_id, members):
+        '''Upload object
+        
+        *members* is a list of ``(el, block_id)`` tuples of the cache
+        entries that are stored in the object.
+        '''
         
         try:
-            if log.isEnabledFor(logging.DEBUG):
-                time_ = time.time()
+            time_ = time.time()
                    
-            with self.bucket_pool() as bucket:  
-                with bucket.open_write('s3ql_data_%d' % obj_id) as fh:
-                    el.seek(0)
-                    while True:
-                        buf = el.read(BUFSIZE)
-                        if not buf:
-                            break
-                        fh.write(buf)
+            key = 's3ql_data_%d' % obj_id
+            size = sum(el.size for (el, _) in members)
+            with self.bucket_pool() as bucket:
+                if self.process_pool is not None:
+                    # Compress and encrypt in a worker process, so that
+                    # only the network transfer is done by this thread
+                    buf = list()
+                    for (el, _) in members:
+                        el.seek(0)
+                        buf.append(el.read(el.size))
+                    (meta_raw, buf, obj_size) = bucket.encode(key, b''.join(buf),
+                                                              pool=self.process_pool)
+                    
+                with self.upload_control() as transfer:
+                    if self.process_pool is not None:
+                        bucket.store_encoded(key, meta_raw, buf)
+                    else:
+                        with bucket.open_write(key) as fh:
+                            for (el, _) in members:
+                                el.seek(0)
+                                while True:
+                                    buf = el.read(BUFSIZE)
+                                    if not buf:
+                                        break
+                                    fh.write(buf)
+                        if isinstance(fh, CompressFilter):
+                            obj_size = fh.compr_size
+                        else:
+                            obj_size = size
+                    transfer.size = size
               
+            time_ = time.time() - time_
             if log.isEnabledFor(logging.DEBUG):
-                time_ = time.time() - time_
-                rate = el.size / (1024**2 * time_) if time_ != 0 else 0
-                log.debug('_do_upload(%s): uploaded %d bytes in %.3f seconds, %.2f MB/s',
-                          obj_id, el.size, time_, rate)             
-            
-            if isinstance(fh, CompressFilter):
-                obj_size = fh.compr_size
-            else:
-                obj_size = el.size
+                rate = size / (1024**2 * time_) if time_ != 0 else 0
+                log.debug('_do_upload(%s): uploaded %d bytes (%d blocks) in %.3f seconds, '
+                          '%.2f MB/s', obj_id, size, len(members), time_, rate)             
                                 
             with lock:
-                self.db.execute('UPDATE objects SET compr_size=? WHERE id=?',
-                                (obj_size, obj_id))
+                self.db.execute('UPDATE objects SET compr_size=?, size=? WHERE id=?',
+                                (obj_size, size, obj_id))
+                self.stats.record('latency.upload', time_)
+                self.stats.count('bytes.uploaded', size)
+                self.stats.count('bytes.uploaded_compressed', obj_size)
                     
-                el.dirty = False
-                self.in_transit.remove(obj_id)
-                self.in_transit.remove((el.inode, el.blockno))
-                self.transfer_completed.notify_all()
+                for (el, block_id) in members:
+                    self._mark_clean(el)
+                    self._share(el, block_id)
+                    self._end_transit((el.inode, el.blockno))
+                self._end_transit(obj_id)
                 
         except:
             with lock:
-                self.in_transit.remove(obj_id)
-                self.in_transit.remove((el.inode, el.blockno))
-                self.transfer_completed.notify_all()
+                # The data of the new blocks has not been stored, so they
+                # must not be used for deduplication. The entries get new
+                # blocks when they are uploaded again.
+                self.db.execute('UPDATE blocks SET hash=NULL WHERE obj_id=?', (obj_id,))
+                self._end_transit(obj_id)
+                for (el, _) in members:
+                    self._end_transit((el.inode, el.blockno))
+                    self._reschedule(el)
             raise
         
+    def _mark_clean(self, el):
+        '''Mark *el* as clean and hand it over to the eviction policy'''
+        
+        el.dirty = False
+        key = (el.inode, el.blockno)
+        if key in self.dirty_entries and self.entries.get(key) is el:
+            del self.dirty_entries[key]
+            self.dirty_size -= el.size
+            self._add_clean(el)
+            
+    def _mark_dirty(self, el):
+        '''Move *el* from the eviction policy to the dirty entries
+        
+        The entry is also scheduled for writeback.
+        '''
+        
+        key = (el.inode, el.blockno)
+        if key not in self.dirty_entries and self.entries.get(key) is el:
+            self._remove_clean(el)
+            self.dirty_entries[key] = el
+            self.dirty_size += el.size
+            el.dirtied = time.time()
+            heapq.heappush(self.writeback_queue, (self._due(el), el.dirtied, key))
+            
+    def _reschedule(self, el):
+        '''Schedule writeback of *el* again after its upload failed
+        
+        The next attempt is made after `writeback_delay` seconds at the
+        earliest.
+        '''
+        
+        key = (el.inode, el.blockno)
+        if el.dirty and self.dirty_entries.get(key) is el:
+            due = max(self._due(el), time.time() + self.writeback_delay)
+            heapq.heappush(self.writeback_queue, (due, el.dirtied, key))
+            
+    def _due(self, el):
+        '''Return time at which dirty entry *el* should be uploaded'''
+        
+        return min(max(el.modified, el.dirtied) + self.writeback_delay,
+                   el.dirtied + self.max_dirty_age)
+        
+    def upload_due(self):
+        '''Upload dirty entries whose writeback time has come
+        
+        Returns the time at which the next entry will become due, or `None`
+        if there are no dirty entries. This method releases the global lock.
+        '''
+        
+        queue = self.writeback_queue
+        while queue:
+            now = time.time()
+            (due, dirtied, key) = queue[0]
+            if due > now:
+                return due
+            heapq.heappop(queue)
+            
+            el = self.dirty_entries.get(key)
+            if el is None or not el.dirty or el.dirtied != dirtied:
+                # Already uploaded, or scheduled again
+                continue
+            
+            if key in self.in_transit:
+                # Check again after the upload has completed or failed
+                heapq.heappush(queue, (now + self.writeback_delay, dirtied, key))
+                continue
+            
+            due = self._due(el)
+            if due > now:
+                # Modified after having been scheduled
+                heapq.heappush(queue, (due, dirtied, key))
+                continue
+            
+            log.debug('upload_due: uploading %s', el)
+            try:
+                self.upload(el, due_only=True) # Releases global lock
+            except:
+                self._reschedule(el)
+                raise
+            
+        return None
+        
+    def _track_open(self, el):
+        '''Register *el* as recently used and limit number of open files
+        
+        Cache files of the least recently used entries are closed if there
+        are more than `max_open` entries with open files. Entries that are in
+        transit may be accessed without the global lock and are therefore
+        left alone.
+        '''
+        
+        key = (el.inode, el.blockno)
+        if key in self.open_entries:
+            self.open_entries.to_head(key)
+        else:
+            self.open_entries[key] = el
+            
+        if len(self.open_entries) <= self.max_open:
+            return
+        
+        for old in self.open_entries.values_rev():
+            if len(self.open_entries) <= self.max_open:
+                break
+            old_key = (old.inode, old.blockno)
+            if old_key in self.in_transit or old is el:
+                continue
+            del self.open_entries[old_key]
+            old.close()
+            
+    def _policy(self, key):
+        '''Return eviction policy responsible for *key*'''
+        
+        if key[0] in self.pinned:
+            return self.pinned_policy
+        return self.policy
+        
+    def _add_clean(self, el):
+        '''Hand over clean entry *el* to its eviction policy'''
+        
+        key = (el.inode, el.blockno)
+        policy = self._policy(key)
+        policy.add(key)
+        if policy is self.pinned_policy:
+            self.pinned_size += el.size
+            
+    def _remove_clean(self, el):
+        '''Remove *el* from its eviction policy'''
+        
+        key = (el.inode, el.blockno)
+        policy = self._policy(key)
+        policy.remove(key)
+        if policy is self.pinned_policy:
+            self.pinned_size -= el.size
     
-    def wait(self):
+    def _over_limit(self):
+        '''Return True if the cache has to be expired'''
+        
+        if len(self.entries) > self.max_entries:
+            return True
+        if self.size <= self.max_size:
+            return False
+        if not self.pinned:
+            return True
+        
+        return self.size - min(self.pinned_size, self.max_pinned) > self.max_size
+        
+    def pin(self, inodes):
+        '''Protect cached blocks of *inodes* from eviction
+        
+        Up to `max_pinned` bytes of clean blocks of pinned inodes do not
+        count against `max_size`, and pinned blocks are only evicted when
+        there are no other clean blocks left. Pins are stored in the
+        database, so they are still effective after a remount. This method
+        does not download any blocks.
+        '''
+        
+        new = set(inodes) - self.pinned
+        for inode in new:
+            self.db.execute('INSERT INTO pinned_inodes (inode) VALUES(?)', (inode,))
+        self._move_entries(new, self.policy, self.pinned_policy)
+        self.pinned.update(new)
+        
+    def unpin(self, inodes):
+        '''Remove pins of *inodes*'''
+        
+        old = set(inodes) & self.pinned
+        for inode in old:
+            self.db.execute('DELETE FROM pinned_inodes WHERE inode=?', (inode,))
+        self._move_entries(old, self.pinned_policy, self.policy)
+        self.pinned.difference_update(old)
+        
+    def prefetch_pinned(self):
+        '''Schedule blocks of pinned inodes for download
+        
+        Blocks are scheduled until their total size (including the blocks
+        that are already cached) reaches `max_pinned` (or `max_size`, if
+        `max_pinned` is zero). Returns the number of scheduled blocks.
+        '''
+        
+        limit = self.max_pinned or self.max_size
+        total = 0
+        scheduled = 0
+        for inode in sorted(self.pinned):
+            for (blockno, size) in list(self.db.query('SELECT blockno, blocks.size '
+                                                      'FROM inode_blocks_v JOIN blocks '
+                                                      'ON block_id = blocks.id '
+                                                      'WHERE inode=? ORDER BY blockno', 
+                                                      (inode,))):
+                total += size
+                if total > limit:
+                    return scheduled
+                if self.prefetch_block(inode, blockno):
+                    scheduled += 1
+                    
+        return scheduled
+        
+    def _move_entries(self, inodes, src, dst):
+        '''Move clean entries of *inodes* from policy *src* to *dst*'''
+        
+        if not inodes:
+            return
+        
+        for (key, el) in self.entries.iteritems():
+            if key[0] in inodes and key in src:
+                src.remove(key)
+                dst.add(key)
+                if dst is self.pinned_policy:
+                    self.pinned_size += el.size
+                else:
+                    self.pinned_size -= el.size
+        
+    def _forget(self, el):
+        '''Remove *el* from eviction policy or dirty entries'''
+        
+        key = (el.inode, el.blockno)
+        self.open_entries.pop(key, None)
+        if key in self.dirty_entries:
+            self.dirty_size -= self.dirty_entries.pop(key).size
+        elif key in self._policy(key):
+            self._remove_clean(el)
+            
+    def _share(self, el, block_id):
+        '''Register clean entry *el* as copy of block *block_id*
+        
+        If there already is a registered copy of the block, *el* is not
+        registered (since its size has been accounted for separately). The
+        same applies if *el* has been removed from the cache.
+        '''
+        
+        if (el.block_id is None and block_id not in self.shared
+            and self.entries.get((el.inode, el.blockno)) is el):
+            el.block_id = block_id
+            self.shared[block_id] = set([(el.inode, el.blockno)])
+            
+    def _unshare(self, el):
+        '''Unregister *el* as copy of a block
+        
+        Returns True if the size of *el* is accounted for in `size`, i.e. if
+        no other cache entry shares its cache file.
+        '''
+        
+        if el.block_id is None:
+            return True
+        
+        keys = self.shared[el.block_id]
+        keys.remove((el.inode, el.blockno))
+        if not keys:
+            del self.shared[el.block_id]
+        el.block_id = None
+        
+        return not keys
+    
+    def _link(self, inode, blockno, block_id):
+        '''Create cache entry for a cached copy of *block_id*
+        
+        Returns `None` if there is no cached copy of the block.
+        '''
+        
+        keys = self.shared.get(block_id)
+        if not keys:
+            return None
+        
+        src = self.entries[next(iter(keys))]
+        filename = os.path.join(self.path, '%d-%d' % (inode, blockno))
+        log.debug('_link(inode=%d, block=%d): sharing block %d with %s', 
+                  inode, blockno, block_id, src)
+        os.link(src.filename, filename)
+        el = CacheEntry(inode, blockno, filename, existing=True)
+        el.block_id = block_id
+        keys.add((inode, blockno))
+        
+        return el
+        
+    def _start_transit(self, key):
+        '''Mark *key* as being in transit
+        
+        *key* may be an object id or an ``(inode, blockno)`` tuple.
+        '''
+        
+        assert key not in self.in_transit
+        self.in_transit[key] = threading.Event()
+        
+    def _end_transit(self, key):
+        '''Mark transfer of *key* as completed and wake up waiting threads'''
+        
+        self.in_transit.pop(key).set()
+        el = self.orphans.pop(key, None)
+        if el is not None:
+            el.close()
+        self.slot_freed.notify_all()
+        
+    def wait(self, key=None):
         '''Wait until an object has been transferred
         
-        If there are no objects in transit, return immediately. This method
-        releases the global lock.
+        If *key* is given, wait until the transfer of *key* (an object id or an
+        ``(inode, blockno)`` tuple) has completed. Otherwise wait until any
+        transfer has completed. If there are no matching objects in transit,
+        return immediately. This method releases the global lock.
         '''
         
-        if not self.transfer_in_progress():
+        if key is None:
+            if not self.transfer_in_progress():
+                return
+            ticket = self.slot_freed.ticket()
+            stamp = time.time()
+            with lock_released:
+                self.slot_freed.wait(ticket)
+            self.stats.record('latency.wait', time.time() - stamp)
+            return
+        
+        event = self.in_transit.get(key)
+        if event is None:
             return
         
+        stamp = time.time()
         with lock_released:
-            self.transfer_completed.wait()
+            event.wait()
+        self.stats.record('latency.wait', time.time() - stamp)
                                             
-    def upload(self, el):
+    def upload(self, el, due_only=False):
         '''Upload cache entry `el` asynchronously
         
-        Return (uncompressed) size of cache entry.
+        If *el* is smaller than `pack_threshold`, other small dirty entries
+        are committed at the same time and all their new blocks are packed
+        into one object. If *due_only* is true, only entries whose writeback
+        time has (almost) come are packed. Return (uncompressed) size of all
+        committed entries.
         
         This method releases the global lock.
         '''
         
         log.debug('upload(%s): start', el)
         
-        assert (el.inode, el.blockno) not in self.in_transit
-        self.in_transit.add((el.inode, el.blockno))
+        entries = [ el ]
+        if el.size < self.pack_threshold:
+            entries += self._pack_candidates(el, due_only)
+        hashed = self._hash_entries(entries) # Releases global lock
         
-        try:        
-            el.seek(0)
-            hash_ = sha256_fh(el)
-            
-            try:
-                old_block_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
-                                               'WHERE inode=? AND blockno=?', 
-                                               (el.inode, el.blockno))
-            except NoSuchRowError:
-                old_block_id = None
+        # Entries whose contents are stored in the new object
+        members = list()
+        # Blocks that are no longer referenced by the committed entries
+        old_blocks = list()
+        obj_id = None
+        obj_size = 0
+        size = 0
+        try:
+            for (el, hash_) in hashed:
+                size += el.size
+                try:
+                    old_block_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
+                                                   'WHERE inode=? AND blockno=?', 
+                                                   (el.inode, el.blockno))
+                except NoSuchRowError:
+                    old_block_id = None
+                    
+                if hash_ is None:
+                    log.debug('upload(%s): contains only zeros, storing as hole', el)
+                    self.stats.count('upload.zero')
+                    block_id = None
+                else:
+                    try:
+                        block_id = self.db.get_val('SELECT id FROM blocks WHERE hash=?', (hash_,))
+                    except NoSuchRowError:
+                        block_id = None
+        
+                # No block with same hash
+                if hash_ is not None and block_id is None:
+                    if obj_id is None:
+                        obj_id = self.db.rowid('INSERT INTO objects (refcount) VALUES(0)')
+                        log.debug('upload(%s): created new object %d', el, obj_id)
+                        self._start_transit(obj_id)
+                    block_id = self.db.rowid('INSERT INTO blocks (refcount, obj_id, obj_offset, '
+                                             'hash, size) VALUES(?,?,?,?,?)', 
+                                             (1, obj_id, obj_size, hash_, el.size))
+                    self.db.execute('UPDATE objects SET refcount=refcount+1 WHERE id=?', 
+                                    (obj_id,))
+                    log.debug('upload(%s): created new block %d at offset %d', 
+                              el, block_id, obj_size)
+                    self.stats.count('upload.new')
+                    obj_size += el.size
+                    members.append((el, block_id))
+                    
+                elif old_block_id == block_id:
+                    log.debug('upload(%s): unchanged, block_id=%s', el, block_id)
+                    self.stats.count('upload.unchanged')
+                    self._mark_clean(el)
+                    if block_id is not None:
+                        self._share(el, block_id)
+                    self._end_transit((el.inode, el.blockno))
+                    continue
                 
-            try:
-                block_id = self.db.get_val('SELECT id FROM blocks WHERE hash=?', (hash_,))
-    
-            # No block with same hash
-            except NoSuchRowError:
-                obj_id = self.db.rowid('INSERT INTO objects (refcount) VALUES(1)')
-                log.debug('upload(%s): created new object %d', el, obj_id)
-                block_id = self.db.rowid('INSERT INTO blocks (refcount, obj_id, hash, size) '
-                                         'VALUES(?,?,?,?)', (1, obj_id, hash_, el.size))
-                log.debug('upload(%s): created new block %d', el, block_id)
-                log.debug('upload(%s): adding to upload queue', el)
-                self.in_transit.add(obj_id)
-                with lock_released:
-                    if not self.upload_threads:
-                        log.warn("upload(%s): no upload threads, uploading synchronously", el)
-                        self._do_upload(el, obj_id)
-                    else:
-                        self.to_upload.put((el, obj_id))
+                # There is a block with the same hash, or the entry is a hole
+                else:
+                    if block_id is not None:
+                        log.debug('upload(%s): (re)linking to %d', el, block_id)
+                        self.stats.count('upload.dedup')
+                        self.db.execute('UPDATE blocks SET refcount=refcount+1 WHERE id=?',
+                                        (block_id,))
+                    self._mark_clean(el)
+                    if block_id is not None:
+                        self._share(el, block_id)
+                    self._end_transit((el.inode, el.blockno))
+                    
+                self._set_block(el.inode, el.blockno, block_id)
+                if old_block_id is not None:
+                    old_blocks.append(old_block_id)
+        except:
+            for (el, _) in hashed:
+                if (el.inode, el.blockno) in self.in_transit:
+                    self._end_transit((el.inode, el.blockno))
+            if obj_id is not None:
+                self._end_transit(obj_id)
+            raise
+        
+        if members:
+            log.debug('upload: adding object %d (%d blocks) to upload queue', 
+                      obj_id, len(members))
+            with lock_released:
+                if not self.upload_threads:
+                    log.warn("upload: no upload threads, uploading synchronously")
+                    self._do_upload(obj_id, members)
+                else:
+                    self.to_upload.put((obj_id, members))
                 
-            # There is a block with the same hash                        
-            else:
-                if old_block_id == block_id:
-                    log.debug('upload(%s): unchanged, block_id=%d', el, block_id)
-                    el.dirty = False
-                    self.in_transit.remove((el.inode, el.blockno))
-                    return el.size
-                      
-                log.debug('upload(%s): (re)linking to %d', el, block_id)
-                self.db.execute('UPDATE blocks SET refcount=refcount+1 WHERE id=?',
-                                (block_id,))
-                el.dirty = False
-                self.in_transit.remove((el.inode, el.blockno))
+        for block_id in old_blocks:
+            self._release_block(block_id) # Releases global lock
+                                      
+        return size
+        
+    def _pack_candidates(self, el, due_only=False):
+        '''Return other dirty entries that can be packed together with *el*
+        
+        The oldest dirty entries that are smaller than `pack_threshold` and
+        not in transit are selected until their total size would exceed
+        `MAX_PACK_SIZE`. If *due_only* is true, entries that do not become
+        due within `PACK_DUE_SLACK` seconds are skipped.
+        '''
+        
+        deadline = time.time() + PACK_DUE_SLACK
+        candidates = list()
+        size = el.size
+        # All entries of a pack are kept open during the upload
+        max_no = self.max_open // 2
+        for other in self.dirty_entries.values_rev():
+            if len(candidates) >= max_no or size + self.pack_threshold > MAX_PACK_SIZE:
+                break
+            if (other is el or not other.dirty or other.size >= self.pack_threshold
+                or (other.inode, other.blockno) in self.in_transit
+                or (due_only and self._due(other) > deadline)):
+                continue
+            candidates.append(other)
+            size += other.size
+            
+        return candidates
+            
+    def _hash_entries(self, entries):
+        '''Mark *entries* as in transit and calculate their hashes
+        
+        Returns a list of ``(el, hash_)`` tuples for all entries that have not
+        been removed from the cache in the meantime. *hash_* is `None` if the
+        entry contains only zeros. 
+        
+        This method releases the global lock.
+        '''
+        
+        # Marking the entries as in transit prevents them from being modified,
+        # so they can be hashed without holding the global lock. The cache
+        # files have to be opened now, since `remove` may unlink them while
+        # we are hashing (but leaves the files of entries in transit open).
+        for el in entries:
+            el.open()
+            self._track_open(el)
+            self._start_transit((el.inode, el.blockno))
+        
+        hashes = list()    
+        try:
+            with lock_released:
+                for el in entries:
+                    el.seek(0)
+                    if is_zero(el):
+                        hashes.append(None)
+                    else:
+                        el.seek(0)
+                        hashes.append(sha256_fh(el))
         except:
-            self.in_transit.remove((el.inode, el.blockno))
+            for el in entries:
+                self._end_transit((el.inode, el.blockno))
             raise
-                         
-
-        if el.blockno == 0:
-            self.db.execute('UPDATE inodes SET block_id=? WHERE id=?', (block_id, el.inode))
+        
+        hashed = list()
+        for (el, hash_) in zip(entries, hashes):
+            if self.entries.get((el.inode, el.blockno)) is not el:
+                log.debug('upload(%s): removed while hashing, aborting', el)
+                self._end_transit((el.inode, el.blockno))
+                continue
+            hashed.append((el, hash_))
+            
+        return hashed
+    
+    def _set_block(self, inode, blockno, block_id):
+        '''Let block *blockno* of *inode* refer to *block_id*
+        
+        If *block_id* is `None`, the block becomes a hole.
+        '''
+        
+        if block_id is None:
+            if blockno == 0:
+                self.db.execute('UPDATE inodes SET block_id=NULL WHERE id=?', (inode,))
+            else:
+                self.db.execute('DELETE FROM inode_blocks WHERE inode=? AND blockno=?',
+                                (inode, blockno))
+        elif blockno == 0:
+            self.db.execute('UPDATE inodes SET block_id=? WHERE id=?', (block_id, inode))
         else:
             self.db.execute('INSERT OR REPLACE INTO inode_blocks (block_id, inode, blockno) '
-                            'VALUES(?,?,?)', (block_id, el.inode, el.blockno)) 
-                                
-        # Check if we have to remove an old block
-        if not old_block_id:
-            log.debug('upload(%s): no old block, returning', el)
-            return el.size
-                    
-        refcount = self.db.get_val('SELECT refcount FROM blocks WHERE id=?', (old_block_id,))
-        if refcount > 1:
-            log.debug('upload(%s):  decreased refcount for prev. block: %d', el, old_block_id)
-            self.db.execute('UPDATE blocks SET refcount=refcount-1 WHERE id=?', (old_block_id,))
-            return el.size
-                    
-        log.debug('upload(%s): removing prev. block %d', el, old_block_id)
-        old_obj_id = self.db.get_val('SELECT obj_id FROM blocks WHERE id=?', (old_block_id,))
-        self.db.execute('DELETE FROM blocks WHERE id=?', (old_block_id,))
-        refcount = self.db.get_val('SELECT refcount FROM objects WHERE id=?', (old_obj_id,))
-        if refcount > 1:
-            log.debug('upload(%s):  decreased refcount for prev. obj: %d', el, old_obj_id)
-            self.db.execute('UPDATE objects SET refcount=refcount-1 WHERE id=?',
-                            (old_obj_id,))
-            return el.size
-        
-        log.debug('upload(%s): removing object %d',  el, old_obj_id)
-        self.db.execute('DELETE FROM objects WHERE id=?', (old_obj_id,))
-
-        while old_obj_id in self.in_transit:
-            log.debug('upload(%s): waiting for transfer of old object %d to complete',
-                      el, old_obj_id)
-            self.wait()
-              
-        with lock_released:          
-            if not self.removal_threads:
-                log.warn("upload(%s): no removal threads, removing synchronously", el)
-                self._do_removal(old_obj_id)
+                            'VALUES(?,?,?)', (block_id, inode, blockno)) 
+            
+    def _release_block(self, block_id):
+        '''Decrease reference count of *block_id*
+        
+        If the block is no longer referenced, it is deleted. If it was the last
+        block stored in its object, the object is removed as well. Packed
+        objects that have become mostly unused are scheduled for repacking.
+        
+        This method releases the global lock.
+        '''
+        
+        self._release_blocks({ block_id: 1 })
+        
+    def _release_blocks(self, refs):
+        '''Drop references to several blocks at once
+        
+        *refs* is a dict mapping block ids to the number of references that
+        are dropped. Works like `_release_block`, but each block and object
+        is only updated once and all orphaned objects are scheduled for
+        removal in one go.
+        
+        This method releases the global lock.
+        '''
+        
+        # Objects mapped to the number of their blocks that have been deleted
+        obj_refs = dict()
+        for (block_id, count) in refs.iteritems():
+            (refcount, obj_id) = self.db.get_row('SELECT refcount, obj_id FROM blocks '
+                                                 'WHERE id=?', (block_id,))
+            if refcount > count:
+                log.debug('_release_blocks: decreasing refcount of block %d by %d', 
+                          block_id, count)
+                self.db.execute('UPDATE blocks SET refcount=refcount-? WHERE id=?', 
+                                (count, block_id))
+                continue
+            
+            log.debug('_release_blocks: deleting block %d', block_id)
+            self.db.execute('DELETE FROM blocks WHERE id=?', (block_id,))
+            obj_refs[obj_id] = obj_refs.get(obj_id, 0) + 1
+        
+        orphaned = list()
+        repack = list()
+        for (obj_id, count) in obj_refs.iteritems():
+            refcount = self.db.get_val('SELECT refcount FROM objects WHERE id=?', (obj_id,))
+            if refcount > count:
+                log.debug('_release_blocks: decreasing refcount of object %d by %d', 
+                          obj_id, count)
+                self.db.execute('UPDATE objects SET refcount=refcount-? WHERE id=?', 
+                                (count, obj_id))
+                repack.append(obj_id)
             else:
-                log.debug('upload(%s): adding %d to removal queue', el, old_obj_id)            
-                self.to_remove.put(old_obj_id)
-                                      
-        return el.size
+                orphaned.append(obj_id)
+                
+        for obj_id in orphaned:
+            while obj_id in self.in_transit:
+                log.debug('_release_blocks: waiting for transfer of object %d to complete',
+                          obj_id)
+                self.wait(obj_id)
+            log.debug('_release_blocks: removing object %d', obj_id)
+            self.db.execute('DELETE FROM objects WHERE id=?', (obj_id,))
+        if orphaned:
+            self._schedule_removal(*orphaned) # Releases global lock
+            
+        for obj_id in repack:
+            self._check_repack(obj_id) # Releases global lock
+                
+    def _check_repack(self, obj_id):
+        '''Schedule repacking of *obj_id* if most of it is unused
+        
+        This method releases the global lock.
+        '''
+        
+        if obj_id in self.repacking:
+            return
+        
+        total = self.db.get_val('SELECT size FROM objects WHERE id=?', (obj_id,))
+        used = self.db.get_val('SELECT SUM(size) FROM blocks WHERE obj_id=?', (obj_id,)) or 0
+        if used >= REPACK_THRESHOLD * total:
+            return
         
+        log.debug('_check_repack(%d): only %d of %d bytes used, repacking', 
+                  obj_id, used, total)
+        self.repacking.add(obj_id)
+        with lock_released:
+            if not self.repack_threads:
+                log.warn("_check_repack(%d): no repack threads, repacking synchronously", 
+                         obj_id)
+                self._do_repack(obj_id)
+            else:
+                self.to_repack.put(obj_id)
             
+
     def transfer_in_progress(self):
         '''Return True if there are any blocks in transit'''
         
         return len(self.in_transit) > 0
 
+    def _schedule_removal(self, *obj_ids):
+        '''Schedule removal of *obj_ids* from the backend
+        
+        The objects must already have been deleted from the *objects* table.
+        They are recorded in the *deleted_objects* table, so that the removal
+        is not lost if the file system crashes before the objects have been
+        removed. This method releases the global lock.
+        '''
+        
+        for obj_id in obj_ids:
+            self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (obj_id,))
+            self.packs.pop(obj_id, None)
+        if self.removal_threads:
+            self.removal_pending.set()
+            return
+        
+        log.warn("_schedule_removal(%s): no removal threads, removing synchronously", 
+                 ', '.join('%d' % x for x in obj_ids))
+        with lock_released:
+            while self._remove_batch():
+                pass
+            
     def _removal_loop(self):
-        '''Process removal queue'''
+        '''Remove objects listed in the *deleted_objects* table'''
               
         while True:
-            tmp = self.to_remove.get()
+            self.removal_pending.wait()
+            self.removal_pending.clear()
+            
+            while not self.removal_quit:
+                stamp = time.time()
+                try:
+                    count = self._remove_batch()
+                except Exception:
+                    # The objects are still listed in deleted_objects
+                    log.warn('Removing objects failed, retrying in %d seconds:',
+                             REMOVAL_RETRY_DELAY, exc_info=True)
+                    time.sleep(REMOVAL_RETRY_DELAY)
+                    continue
+                if not count:
+                    break
+                
+                if self.max_deletes:
+                    # The limit is shared by all removal threads
+                    delay = (count * len(self.removal_threads) / self.max_deletes
+                             - (time.time() - stamp))
+                    if delay > 0:
+                        time.sleep(delay)
+                        
+            if self.removal_quit:
+                break
+    
+    def _remove_batch(self):
+        '''Remove a batch of objects from the backend
+        
+        If the backend can remove several objects with one request, up to
+        `DELETE_BATCH_SIZE` objects are removed, otherwise up to
+        `SINGLE_DELETE_BATCH_SIZE`. Objects that are being removed by other
+        threads are skipped, and another removal thread is woken up if there
+        are more objects left.
+        
+        Returns the number of removed objects. This method acquires the
+        global lock.
+        '''
+        
+        with self.bucket_pool() as bucket:
+            if bucket.has_delete_multi():
+                size = DELETE_BATCH_SIZE
+            else:
+                size = SINGLE_DELETE_BATCH_SIZE
+                
+            with lock:
+                ids = [ x[0] for x in self.db.query('SELECT id FROM deleted_objects LIMIT ?',
+                                                    (size + len(self.removing),))
+                        if x[0] not in self.removing ][:size]
+                if not ids:
+                    return 0
+                self.removing.update(ids)
+                if len(ids) == size:
+                    self.removal_pending.set()
+        
+            try:
+                log.debug('_remove_batch(): removing %d objects', len(ids))
+                bucket.delete_multi([ 's3ql_data_%d' % id_ for id_ in ids ])
+                    
+                with lock:
+                    for id_ in ids:
+                        self.db.execute('DELETE FROM deleted_objects WHERE id=?', (id_,))
+            finally:
+                with lock:
+                    self.removing.difference_update(ids)
+                
+        return len(ids)
+
+    def _repack_loop(self):
+        '''Process repack queue'''
+        
+        while True:
+            tmp = self.to_repack.get()
             
             if tmp is QuitSentinel:
-                break   
+                break
+            
+            try:
+                self._do_repack(tmp)
+            except Exception:
+                # The object will be scheduled again when the next
+                # of its blocks is removed.
+                log.warn('Repacking object %d failed:', tmp, exc_info=True)
+            
+    def _do_repack(self, obj_id):
+        '''Copy the blocks that are still used in *obj_id* into a new object
+        
+        The old object is removed once it no longer contains any blocks.
+        This method acquires the global lock.
+        '''
+        
+        with lock:
+            self.repacking.discard(obj_id)
+            if (obj_id in self.in_transit 
+                or not self.db.has_val('SELECT 1 FROM objects WHERE id=?', (obj_id,))):
+                return
+            
+            # Marking the object as in transit prevents it from being
+            # downloaded or removed while the blocks are moved.
+            self._start_transit(obj_id)
+            blocks = list(self.db.query('SELECT id, obj_offset, size FROM blocks '
+                                        'WHERE obj_id=? ORDER BY obj_offset', (obj_id,)))
+            new_id = self.db.rowid('INSERT INTO objects (refcount) VALUES(0)')
+            self._start_transit(new_id)
+        
+        log.debug('_do_repack(%d): moving %d blocks to object %d', obj_id, len(blocks), new_id)
+        try:
+            offsets = dict()
+            size = 0
+            with self.bucket_pool() as src_bucket:
+                with self.bucket_pool() as dst_bucket:
+                    with src_bucket.open_read('s3ql_data_%d' % obj_id) as src:
+                        with dst_bucket.open_write('s3ql_data_%d' % new_id) as dst:
+                            pos = 0
+                            for (block_id, offset, block_size) in blocks:
+                                copy_part(src, dst, offset - pos, block_size)
+                                pos = offset + block_size
+                                offsets[block_id] = size
+                                size += block_size
+                            # Read to the end, so that the checksum is verified
+                            while src.read(BUFSIZE):
+                                pass
+            
+            if isinstance(dst, CompressFilter):
+                obj_size = dst.compr_size
+            else:
+                obj_size = size
+                
+        except:
+            with lock:
+                self._end_transit(obj_id)
+                self._end_transit(new_id)
+                self.db.execute('DELETE FROM objects WHERE id=?', (new_id,))
+            raise
+        
+        with lock:
+            # Blocks may have been removed in the meantime
+            moved = 0
+            for (block_id, offset) in offsets.iteritems():
+                moved += self.db.execute('UPDATE blocks SET obj_id=?, obj_offset=? '
+                                         'WHERE id=? AND obj_id=?', 
+                                         (new_id, offset, block_id, obj_id))
+            self.db.execute('UPDATE objects SET refcount=?, compr_size=?, size=? WHERE id=?',
+                            (moved, obj_size, size, new_id))
+            self.db.execute('UPDATE objects SET refcount=refcount-? WHERE id=?', 
+                            (moved, obj_id))
+            refcount = self.db.get_val('SELECT refcount FROM objects WHERE id=?', (obj_id,))
+            
+            self._end_transit(obj_id)
+            self._end_transit(new_id)
+            
+            if refcount == 0:
+                self.db.execute('DELETE FROM objects WHERE id=?', (obj_id,))
+                self._schedule_removal(obj_id)
+            if moved == 0:
+                self.db.execute('DELETE FROM objects WHERE id=?', (new_id,))
+                self._schedule_removal(new_id)
+            
+        log.debug('_do_repack(%d): moved %d blocks to object %d', obj_id, moved, new_id)
+            
+    def _download(self, el, block_id):
+        '''Download block *block_id* into cache entry *el*
+        
+        The caller must make sure that the object holding the block is not
+        already in transit. If the object contains other blocks as well, its
+        decoded contents are kept in `packs`, so that the other blocks can be
+        retrieved without downloading the object again. If the download
+        fails, the cache file of *el* is removed. This method releases the
+        global lock.
+        '''
+        
+        (obj_id, offset, size) = self.db.get_row('SELECT obj_id, obj_offset, size '
+                                                 'FROM blocks WHERE id=?', (block_id,))
+        if obj_id in self.packs:
+            self.packs.to_head(obj_id)
+            el.write(self.packs[obj_id][offset:offset+size])
+            el.dirty = False
+            self.stats.count('download.pack')
+            return
+        
+        packed = self.db.has_val('SELECT 1 FROM blocks WHERE obj_id=? AND id != ?',
+                                 (obj_id, block_id))
+        self._start_transit(obj_id)
+        stamp = time.time()
+        buf = None
+        try:
+            with lock_released:
+                with self.download_control() as transfer:
+                    with self.bucket_pool() as bucket:
+                        with bucket.open_read('s3ql_data_%d' % obj_id) as fh:
+                            if packed:
+                                buf = fh.read()
+                                el.write(buf[offset:offset+size])
+                            else:
+                                copy_part(fh, el, offset, size)
+                                # Read to the end, so that the checksum is verified
+                                while fh.read(BUFSIZE):
+                                    pass
+                    transfer.size = size if buf is None else len(buf)
+        except:
+            el.close()
+            el.unlink()
+            raise
+        finally:
+            self._end_transit(obj_id)
+                
+        self.stats.record('latency.download', time.time() - stamp)
+        self.stats.count('bytes.downloaded', size if buf is None else len(buf))
+        
+        if buf is not None:
+            self.packs[obj_id] = buf
+            while len(self.packs) > PACK_CACHE_SIZE:
+                self.packs.pop_last()
+        
+        # Writing will have set dirty flag
+        el.dirty = False
+        
+    def prefetch(self, inode, start_no, end_no):
+        '''Schedule blocks of *inode* for download into the cache
+        
+        Blocks from *start_no* to, but not including, *end_no* are retrieved
+        by the download threads in the background. Blocks that are already
+        cached or in transit are skipped. This method does not block.
+        '''
+        
+        if not self.download_threads:
+            return
+        
+        for blockno in range(start_no, end_no):
+            key = (inode, blockno)
+            if (key in self.entries or key in self.in_transit 
+                or key in self.prefetching):
+                continue
+            
+            self.prefetching.add(key)
+            self.to_download.put((inode, blockno, False))
+            
+    def prefetch_block(self, inode, blockno):
+        '''Schedule block *blockno* of *inode* for cache warm-up
+        
+        In contrast to `prefetch`, the block is also counted in
+        `warmup_queued` and `warmup_done`, so that the progress of the
+        warm-up can be reported. If there are no download threads, the block
+        is downloaded immediately (this releases the global lock).
+        
+        Returns False if the block is already cached or scheduled.
+        '''
+        
+        key = (inode, blockno)
+        if (key in self.entries or key in self.in_transit 
+            or key in self.prefetching):
+            return False
+        
+        self.warmup_queued += 1
+        if not self.download_threads:
+            try:
+                self._do_prefetch(inode, blockno)
+            finally:
+                self.warmup_done += 1
+            return True
+        
+        self.prefetching.add(key)
+        self.to_download.put((inode, blockno, True))
+        return True
+            
+    def _download_loop(self):
+        '''Process prefetch queue'''
+        
+        while True:
+            tmp = self.to_download.get()
+            
+            if tmp is QuitSentinel:
+                break
             
-            self._do_removal(tmp)        
+            (inode, blockno, warmup) = tmp
+            with lock:
+                self.prefetching.discard((inode, blockno))
+                try:
+                    self._do_prefetch(inode, blockno)
+                except Exception:
+                    # The block will be retrieved again when it is actually
+                    # accessed, so we don't want to terminate the thread.
+                    log.warn('Prefetching block %d of inode %d failed:',
+                             blockno, inode, exc_info=True)
+                finally:
+                    if warmup:
+                        self.warmup_done += 1
     
-    def _do_removal(self, obj_id):
-        '''Remove object'''
-      
-        with self.bucket_pool() as bucket:
-            bucket.delete('s3ql_data_%d' % obj_id)           
+    def _do_prefetch(self, inode, blockno):
+        '''Download block *blockno* of *inode* into the cache
+        
+        This method releases the global lock.
+        '''
+        
+        key = (inode, blockno)
+        if key in self.entries or key in self.in_transit:
+            return
+        
+        try:
+            block_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
+                                       'WHERE inode=? AND blockno=?', (inode, blockno))
+        except NoSuchRowError:
+            # Nothing to download
+            return
+        
+        obj_id = self.db.get_val('SELECT obj_id FROM blocks WHERE id=?', (block_id,))
+        if obj_id in self.in_transit:
+            return
+        
+        el = self._link(inode, blockno, block_id)
+        if el is not None:
+            self.entries[key] = el
+            self._add_clean(el)
+            return
+        
+        if self._over_limit():
+            self.expire() # Releases global lock
+            
+            # Situation may have changed while we were waiting 
+            if key in self.entries or key in self.in_transit:
+                return
+            try:
+                obj_id = self.db.get_val('SELECT obj_id FROM blocks WHERE id=?', (block_id,))
+            except NoSuchRowError:
+                return
+            if obj_id in self.in_transit:
+                return
+        
+        log.debug('_do_prefetch(inode=%d, block=%d): downloading object %d', 
+                  inode, blockno, obj_id)
+        
+        # Marking the block as in transit prevents get() from creating
+        # another cache file with the same name while we are downloading.
+        self._start_transit(key)
+        try:
+            el = CacheEntry(inode, blockno, 
+                            os.path.join(self.path, '%d-%d' % (inode, blockno)))
+            self._download(el, block_id) # Releases global lock
+            
+            # The block may have been changed or removed while we were
+            # downloading.
+            try:
+                current_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
+                                             'WHERE inode=? AND blockno=?', (inode, blockno))
+            except NoSuchRowError:
+                current_id = None
+            if current_id != block_id:
+                log.debug('_do_prefetch(inode=%d, block=%d): block changed, discarding', 
+                          inode, blockno)
+                el.close()
+                el.unlink()
+                return
+            
+            self.entries[key] = el
+            self._add_clean(el)
+            self._track_open(el)
+            self.size += el.size
+            self._share(el, block_id)
+            self.stats.count('prefetch.download')
+        finally:
+            self._end_transit(key)
                 
+    def is_hole(self, inode, blockno):
+        '''Return True if block *blockno* of *inode* has never been written
+        
+        Such blocks contain only zeros and can be read without creating a
+        cache entry.
+        '''
+        
+        key = (inode, blockno)
+        if key in self.entries or key in self.in_transit:
+            return False
+        
+        if self.db.has_val('SELECT 1 FROM inode_blocks_v WHERE inode=? AND blockno=?',
+                           (inode, blockno)):
+            return False
+        
+        self.stats.count('get.hole')
+        return True
+        
     @contextmanager
-    def get(self, inode, blockno):
+    def get(self, inode, blockno, overwrite=False):
         """Get file handle for block `blockno` of `inode`
         
+        If *overwrite* is true, the caller promises to overwrite the entire
+        block. If the block is not cached, an empty cache entry is created
+        instead of retrieving the current contents from the backend. If the
+        managed block raises an exception, such an entry is discarded again.
+        
         This method releases the global lock, and the managed block
         may do so as well.
         
@@ -489,14 +1756,15 @@ class BlockCache(object):
 
         #log.debug('get(inode=%d, block=%d): start', inode, blockno)
 
-        if self.size > self.max_size or len(self.entries) > self.max_entries:
+        if self._over_limit():
             self.expire()
 
         el = None
+        fresh = False
         while el is None:
             # Don't allow changing objects while they're being uploaded
             if (inode, blockno) in self.in_transit:
-                self.wait()
+                self.wait((inode, blockno))
                 continue
             
             try:
@@ -512,63 +1780,152 @@ class BlockCache(object):
                 # No corresponding object
                 except NoSuchRowError:
                     #log.debug('get(inode=%d, block=%d): creating new block', inode, blockno)
+                    self.stats.count('get.new')
                     el = CacheEntry(inode, blockno, filename)
                     
-                # Need to download corresponding object
                 else:
+                    if overwrite:
+                        log.debug('get(inode=%d, block=%d): will be overwritten, not downloading', 
+                                  inode, blockno)
+                        self.stats.count('get.overwrite')
+                        el = CacheEntry(inode, blockno, filename)
+                        fresh = True
+                        self.entries[(inode, blockno)] = el
+                        self._add_clean(el)
+                        break
+                    
+                    # Need to download corresponding object
                     #log.debug('get(inode=%d, block=%d): downloading block', inode, blockno)
                     obj_id = self.db.get_val('SELECT obj_id FROM blocks WHERE id=?', (block_id,))
                     
                     if obj_id in self.in_transit:
                         log.debug('get(inode=%d, block=%d): object %d in transit, waiting', 
                                   inode, blockno, obj_id)
-                        self.wait()
+                        self.wait(obj_id)
                         continue
                         
-                    # We need to download
-                    self.in_transit.add(obj_id)
-                    try:
-                        el = CacheEntry(inode, blockno, filename)   
-                        with lock_released:
-                            with self.bucket_pool() as bucket:
-                                with bucket.open_read('s3ql_data_%d' % obj_id) as fh:
-                                    shutil.copyfileobj(fh, el)
-                    except:
-                        el.unlink()
-                        raise
-                    finally:
-                        self.in_transit.remove(obj_id)
-                        with lock_released:
-                            self.transfer_completed.notify_all()
-                        
-                    # Writing will have set dirty flag
-                    el.dirty = False
-                    self.size += el.size
+                    el = self._link(inode, blockno, block_id)
+                    if el is None:
+                        # We need to download
+                        el = CacheEntry(inode, blockno, filename)
+                        self._download(el, block_id)
+                        self.size += el.size
+                        self._share(el, block_id)
+                        self.stats.count('get.download')
+                    else:
+                        self.stats.count('get.linked')
                 
                 self.entries[(inode, blockno)] = el
+                self._add_clean(el)
                 
             # In Cache
             else:
                 #log.debug('get(inode=%d, block=%d): in cache', inode, blockno)
+                self.stats.count('get.dirty' if el.dirty else 'get.clean')
                 self.entries.to_head((inode, blockno))
+                policy = self._policy((inode, blockno))
+                if (inode, blockno) in policy:
+                    policy.access((inode, blockno))
 
         el.last_access = time.time()
         oldsize = el.size
+        self._track_open(el)
 
         # Provide fh to caller
+        discard = False
         try:
             #log.debug('get(inode=%d, block=%d): yield', inode, blockno)
             yield el
+        except:
+            # A fresh entry does not hold the contents of the block
+            discard = fresh
+            raise
         finally:
+            if (inode, blockno) in self.dirty_entries:
+                self.dirty_size += el.size - oldsize
+            elif el.dirty:
+                if (inode, blockno) in self.pinned_policy:
+                    self.pinned_size += el.size - oldsize
+                self._mark_dirty(el)
+                
             # Update cachesize 
-            self.size += el.size - oldsize
+            if el.dirty and el.block_id is not None:
+                # No longer a copy of the object
+                if self._unshare(el):
+                    self.size += el.size - oldsize
+                else:
+                    self.size += el.size
+            else:
+                self.size += el.size - oldsize
+                
+            if discard and self.entries.get((inode, blockno)) is el:
+                del self.entries[(inode, blockno)]
+                self._forget(el)
+                el.close()
+                el.unlink()
+                self.size -= el.size
 
         #log.debug('get(inode=%d, block=%d): end', inode, blockno)
 
 
+    def throttle(self):
+        '''Throttle writers if there is too much dirty data
+        
+        If the amount of dirty data exceeds `dirty_thresh`, uploads of the
+        oldest dirty entries are started and the caller is delayed in
+        proportion to how close the amount of dirty data is to `max_dirty`. If
+        `max_dirty` is exceeded, the method blocks until enough data has been
+        uploaded.
+        
+        This method releases the global lock.
+        '''
+        
+        if self.max_dirty is None or self.dirty_size <= self.dirty_thresh:
+            return
+        
+        self._writeback(self.dirty_size - self.dirty_thresh) # Releases global lock
+        
+        while self.dirty_size >= self.max_dirty:
+            log.debug('throttle: %d bytes dirty, waiting for uploads', self.dirty_size)
+            self._writeback(self.dirty_size - self.dirty_thresh) # Releases global lock
+            if not self.transfer_in_progress():
+                break
+            self.wait() # Releases global lock
+            
+        if self.dirty_size > self.dirty_thresh:
+            delay = (MAX_THROTTLE_DELAY * (self.dirty_size - self.dirty_thresh) 
+                     / max(self.max_dirty - self.dirty_thresh, 1))
+            with lock_released:
+                time.sleep(min(delay, MAX_THROTTLE_DELAY))
+                
+    def _writeback(self, need_size):
+        '''Start uploading oldest dirty entries
+        
+        Uploads are started until the size of the entries being uploaded
+        reaches *need_size*.
+        
+        This method releases the global lock.
+        '''
+        
+        for el in self.dirty_entries.values_rev():
+            if need_size <= 0:
+                break
+            if not el.dirty:
+                # Became clean while we released the lock
+                continue
+            if (el.inode, el.blockno) not in self.in_transit:
+                log.debug('_writeback: uploading %s', el)
+                self.upload(el) # Releases global lock
+            need_size -= el.size
+            
     def expire(self):
         """Perform cache expiry
         
+        Clean entries are evicted in the order determined by the eviction
+        policy. If this is not sufficient, the dirty entries that were
+        modified first are uploaded so that they can be evicted once the
+        upload has completed.
+        
         This method releases the global lock.
         """
 
@@ -578,46 +1935,53 @@ class BlockCache(object):
         log.debug('expire: start')
 
         did_nothing_count = 0
-        while (len(self.entries) > self.max_entries or
-               (len(self.entries) > 0  and self.size > self.max_size)):
-
-            need_size = self.size - self.max_size
-            need_entries = len(self.entries) - self.max_entries
-            
-            # Try to expire entries that are not dirty
-            for el in self.entries.values_rev():
-                if el.dirty:
-                    if (el.inode, el.blockno) in self.in_transit:
-                        log.debug('expire: %s is dirty, but already being uploaded', el)
-                        continue
-                    else:                        
-                        log.debug('expire: %s is dirty, trying to flush', el)
-                        break
+        while self.entries:
+            over_entries = len(self.entries) > self.max_entries
+            if not (over_entries or 
+                    self.size - min(self.pinned_size, self.max_pinned) > self.max_size):
+                break
 
-                del self.entries[(el.inode, el.blockno)]
+            # Pinned entries are only evicted when no other clean
+            # entries are left
+            key = self.policy.evict()
+            if key is None and (over_entries or self.pinned_size > self.max_pinned):
+                key = self.pinned_policy.evict()
+                if key is not None:
+                    self.pinned_size -= self.entries[key].size
+            if key is not None:
+                # clear() sets max_entries to zero
+                if self.max_entries == 0:
+                    self.stats.count('evict.clear')
+                elif over_entries:
+                    self.stats.count('evict.entries')
+                elif key[0] in self.pinned:
+                    self.stats.count('evict.pinned')
+                else:
+                    self.stats.count('evict.size')
+                el = self.entries.pop(key)
+                log.debug('expire: removing %s', el)
+                self.open_entries.pop(key, None)
                 el.close()
                 el.unlink()
-                need_entries -= 1
-                self.size -= el.size
-                need_size -= el.size
-                
+                if self._unshare(el):
+                    self.size -= el.size
                 did_nothing_count = 0
-                if need_size <= 0 and need_entries <= 0:
-                    break
-                     
-            if need_size <= 0 and need_entries <= 0:
-                break
+                continue
                 
-            # Try to upload just enough
-            for el in self.entries.values_rev():
-                if el.dirty and (el.inode, el.blockno) not in self.in_transit:
-                    log.debug('expire: uploading %s..', el)
-                    freed = self.upload(el) # Releases global lock
-                    need_size -= freed
-                    did_nothing_count = 0
-                else:
+            # Only dirty entries left, try to upload just enough
+            need_size = self.size - min(self.pinned_size, self.max_pinned) - self.max_size
+            need_entries = len(self.entries) - self.max_entries
+            for el in self.dirty_entries.values_rev():
+                if not el.dirty:
+                    # Became clean while we released the lock
+                    continue
+                if (el.inode, el.blockno) in self.in_transit:
                     log.debug('expire: %s can soon be expired..', el)
                     need_size -= el.size
+                else:
+                    log.debug('expire: uploading %s..', el)
+                    need_size -= self.upload(el) # Releases global lock
+                    did_nothing_count = 0
                 need_entries -= 1                
         
                 if need_size <= 0 and need_entries <= 0:
@@ -653,70 +2017,59 @@ class BlockCache(object):
 
         if end_no is None:
             end_no = start_no + 1
+        
+        # The range may be much larger than the number of blocks that
+        # actually exist (e.g. for sparse files), so we only look at the
+        # existing cache entries and database rows.
+        if end_no - start_no > len(self.entries):
+            keys = [ key for key in self.entries 
+                     if key[0] == inode and start_no <= key[1] < end_no ]
+        else:
+            keys = [ (inode, blockno) for blockno in xrange(start_no, end_no)
+                     if (inode, blockno) in self.entries ]
             
-        for blockno in range(start_no, end_no):
+        for key in keys:
             # We can't use self.mlock here to prevent simultaneous retrieval
             # of the block with get(), because this could deadlock
-            if (inode, blockno) in self.entries:
-                log.debug('remove(inode=%d, blockno=%d): removing from cache', 
-                          inode, blockno)
-                
-                # Type inference fails here
-                #pylint: disable-msg=E1103
-                el = self.entries.pop((inode, blockno))
+            log.debug('remove(inode=%d, blockno=%d): removing from cache', *key)
+            
+            # Type inference fails here
+            #pylint: disable-msg=E1103
+            el = self.entries.pop(key)
+            self._forget(el)
+            if key in self.in_transit:
+                # The cache file is still being read by the transfer
+                self.orphans[key] = el
+            else:
+                el.close()
+            self.stats.count('evict.remove')
 
+            if self._unshare(el):
                 self.size -= el.size
-                el.unlink()
-
-            try:
-                block_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
-                                           'WHERE inode=? AND blockno=?', (inode, blockno))
-            except NoSuchRowError:
-                log.debug('remove(inode=%d, blockno=%d): block not in db', inode, blockno)
-                continue
+            el.unlink()
 
-            # Detach inode from block
-            if blockno == 0:
+        # Block ids mapped to number of references that are dropped
+        refs = dict()
+        if start_no == 0 and end_no > 0:
+            block_id = self.db.get_val('SELECT block_id FROM inodes WHERE id=?', (inode,))
+            if block_id is not None:
                 self.db.execute('UPDATE inodes SET block_id=NULL WHERE id=?', (inode,))
-            else:
-                self.db.execute('DELETE FROM inode_blocks WHERE inode=? AND blockno=?',
-                                (inode, blockno))
+                refs[block_id] = 1
                 
-            # Decrease block refcount
-            refcount = self.db.get_val('SELECT refcount FROM blocks WHERE id=?', (block_id,))
-            if refcount > 1:
-                log.debug('remove(inode=%d, blockno=%d): decreasing refcount for block %d',
-                          inode, blockno, block_id)                    
-                self.db.execute('UPDATE blocks SET refcount=refcount-1 WHERE id=?',
-                                (block_id,))
-                continue
-            
-            # Detach block from object
-            log.debug('remove(inode=%d, blockno=%d): deleting block %d',
-                      inode, blockno, block_id)     
-            obj_id = self.db.get_val('SELECT obj_id FROM blocks WHERE id=?', (block_id,))
-            self.db.execute('DELETE FROM blocks WHERE id=?', (block_id,))
-            
-            # Decrease object refcount
-            refcount = self.db.get_val('SELECT refcount FROM objects WHERE id=?', (obj_id,))
-            if refcount > 1:
-                log.debug('remove(inode=%d, blockno=%d): decreasing refcount for object %d',
-                          inode, blockno, obj_id)                    
-                self.db.execute('UPDATE objects SET refcount=refcount-1 WHERE id=?',
-                                (obj_id,))
-            else:
-                while obj_id in self.in_transit:
-                    log.debug('remove(inode=%d, blockno=%d): waiting for transfer of '
-                              'object %d to complete', inode, blockno, obj_id)
-                    self.wait()           
-                self.db.execute('DELETE FROM objects WHERE id=?', (obj_id,))
-                with lock_released:
-                    if not self.removal_threads:  
-                        log.warn("remove(): no removal threads, removing synchronously")
-                        self._do_removal(obj_id)
-                    else:                            
-                        self.to_remove.put(obj_id)
- 
+        for (block_id, count) in self.db.query('SELECT block_id, COUNT(blockno) '
+                                               'FROM inode_blocks WHERE inode=? '
+                                               'AND blockno >= ? AND blockno < ? '
+                                               'GROUP BY block_id', 
+                                               (inode, start_no, end_no)):
+            refs[block_id] = refs.get(block_id, 0) + count
+        self.db.execute('DELETE FROM inode_blocks WHERE inode=? AND blockno >= ? AND blockno < ?',
+                        (inode, start_no, end_no))
+        
+        log.debug('remove(inode=%d, start=%d, end=%s): releasing %d blocks', 
+                  inode, start_no, end_no, len(refs))
+        if refs:
+            self._release_blocks(refs) # Releases global lock
+
         log.debug('remove(inode=%d, start=%d, end=%s): end', inode, start_no, end_no)
 
     def flush(self, inode):
@@ -735,7 +2088,7 @@ class BlockCache(object):
         This method releases the global lock.
         """
     
-        for el in self.entries.itervalues():
+        for el in list(self.dirty_entries.values_rev()):
             if not (el.dirty and (el.inode, el.blockno) not in self.in_transit):
                 continue
             
@@ -752,11 +2105,158 @@ class BlockCache(object):
         self.max_entries = 0
         self.expire() # Releases global lock
         self.max_entries = bak
+        self.packs.clear()
             
         log.debug('clear: end')
 
 
+    def get_stats(self):
+        '''Return cache statistics
+        
+        Returns a dict with the counters and histograms of `stats` and the
+        current values of the cache's size and queue lengths under the
+        ``gauges`` key.
+        '''
+        
+        stats = self.stats.snapshot()
+        stats['gauges'] = {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'size': self.size,
+            'max_size': self.max_size,
+            'pinned_inodes': len(self.pinned),
+            'pinned_size': self.pinned_size,
+            'max_pinned': self.max_pinned,
+            'dirty_entries': len(self.dirty_entries),
+            'dirty_size': self.dirty_size,
+            'in_transit': len(self.in_transit),
+            'upload_queue': self.to_upload.pending,
+            'removal_queue': self.db.get_val('SELECT COUNT(id) FROM deleted_objects'),
+            'repack_queue': self.to_repack.qsize(),
+            'download_queue': self.to_download.qsize() }
+        
+        return stats
+    
     def __del__(self):
         if len(self.entries) > 0:
             raise RuntimeError("BlockCache instance was destroyed without calling destroy()!")
 
+
+def write_index(cachedir, db, keys):
+    '''Write index of preserved cache entries
+    
+    *keys* is a sequence of ``(inode, blockno)`` tuples whose cache files in
+    *cachedir* are clean, in least-recently used first order. The hash and size
+    of the corresponding database block are recorded, so that the entries can
+    be revalidated by `read_index`. Returns the list of keys that have been
+    written (entries for blocks that do not exist in the database are
+    skipped).
+    '''
+    
+    index = list()
+    for (inode, blockno) in keys:
+        try:
+            (hash_, size) = db.get_row('SELECT hash, size FROM inode_blocks_v JOIN blocks '
+                                       'ON block_id = id WHERE inode=? AND blockno=?',
+                                       (inode, blockno))
+        except NoSuchRowError:
+            continue
+        index.append((inode, blockno, hash_, size))
+    
+    if index:
+        with open(os.path.join(cachedir, INDEX_NAME), 'wb') as fh:
+            pickle.dump(index, fh, 2)
+            
+    return [ (inode, blockno) for (inode, blockno, _, _) in index ]
+    
+def read_index(cachedir, db):
+    '''Read and validate index of preserved cache entries
+    
+    Returns a list of ``(inode, blockno)`` tuples (in least-recently used first
+    order) whose cache files in *cachedir* still hold the current contents of
+    the respective block. Cache files of outdated entries are removed. The index
+    itself is removed as well, so that the entries are treated as dirty if the
+    file system is not unmounted cleanly.
+    '''
+    
+    path = os.path.join(cachedir, INDEX_NAME)
+    if not os.path.exists(path):
+        return []
+    
+    with open(path, 'rb') as fh:
+        index = pickle.load(fh)
+    os.unlink(path)
+    
+    valid = list()
+    for (inode, blockno, hash_, size) in index:
+        filename = os.path.join(cachedir, '%d-%d' % (inode, blockno))
+        try:
+            row = db.get_row('SELECT hash, size FROM inode_blocks_v JOIN blocks '
+                             'ON block_id = id WHERE inode=? AND blockno=?', (inode, blockno))
+        except NoSuchRowError:
+            row = None
+            
+        if not os.path.exists(filename):
+            continue
+        
+        if row is None or tuple(row) != (hash_, size) or os.path.getsize(filename) != size:
+            log.debug('read_index: block %d of inode %d has changed, discarding', 
+                      blockno, inode)
+            os.unlink(filename)
+            continue
+        
+        valid.append((inode, blockno))
+        
+    return valid
+
+def init_worker():
+    '''Initialize worker process of the compression pool
+    
+    The workers are forked from the mounted file system process, so they
+    inherit its file descriptor for the FUSE device. It is closed, so that
+    the workers do not keep the file system connection alive.
+    '''
+    
+    try:
+        fuse_dev = os.stat('/dev/fuse').st_rdev
+        fds = [ int(x) for x in os.listdir('/dev/fd') ]
+    except OSError:
+        return
+    
+    for fd in fds:
+        try:
+            st = os.fstat(fd)
+        except OSError:
+            # The descriptor used by listdir()
+            continue
+        if stat.S_ISCHR(st.st_mode) and st.st_rdev == fuse_dev:
+            os.close(fd)
+
+def is_zero(fh):
+    '''Return True if *fh* contains only null bytes from the current position'''
+    
+    while True:
+        buf = fh.read(BUFSIZE)
+        if not buf:
+            return True
+        if buf.count(b'\0') != len(buf):
+            return False
+
+def copy_part(src, dst, skip, size):
+    '''Copy *size* bytes from *src* to *dst* after skipping *skip* bytes
+    
+    *src* does not need to be seekable.
+    '''
+    
+    while skip > 0:
+        buf = src.read(min(skip, BUFSIZE))
+        if not buf:
+            raise EOFError('Unexpected end of object')
+        skip -= len(buf)
+        
+    while size > 0:
+        buf = src.read(min(size, BUFSIZE))
+        if not buf:
+            raise EOFError('Unexpected end of object')
+        dst.write(buf)
+        size -= len(buf)
@@ -0,0 +1,198 @@
+'''
+cache_policy.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Eviction policies for the block cache.
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+from .ordered_dict import OrderedDict
+
+__all__ = [ 'LRUPolicy', 'TwoQPolicy', 'ARCPolicy', 'POLICIES', 'get_policy' ]
+
+
+class LRUPolicy(object):
+    '''Evict the least recently used entry
+
+    A policy keeps track of the keys of clean cache entries and decides
+    which of them should be evicted next. Every key is passed to `add` when
+    the entry is inserted, to `access` whenever it is used and to `remove`
+    when it is dropped for any other reason than eviction (e.g. because the
+    entry has become dirty). `evict` selects the next victim, removes it from
+    the policy and returns its key. All operations take constant time.
+    '''
+
+    def __init__(self, capacity):
+        super(LRUPolicy, self).__init__()
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key):
+        self.entries[key] = key
+
+    def access(self, key):
+        self.entries.to_head(key)
+
+    def remove(self, key):
+        del self.entries[key]
+
+    def evict(self):
+        '''Remove and return key of next victim, or `None` if empty'''
+
+        if not self.entries:
+            return None
+        return self.entries.pop_last()
+
+
+class TwoQPolicy(object):
+    '''2Q replacement (Johnson & Shasha, 1994)
+
+    New entries are placed in the FIFO queue *a1in* and evicted from there
+    without polluting the main LRU queue *am*, unless they are accessed again
+    shortly after having been evicted (i.e., while they are still remembered
+    in *a1out*). Therefore a single sequential scan does not push out
+    frequently used entries.
+    '''
+
+    def __init__(self, capacity):
+        super(TwoQPolicy, self).__init__()
+        self.max_in = max(1, capacity // 4)
+        self.max_out = max(1, capacity // 2)
+        self.a1in = OrderedDict()
+        self.a1out = OrderedDict()
+        self.am = OrderedDict()
+
+    def __len__(self):
+        return len(self.a1in) + len(self.am)
+
+    def __contains__(self, key):
+        return key in self.a1in or key in self.am
+
+    def add(self, key):
+        if key in self.a1out:
+            del self.a1out[key]
+            self.am[key] = key
+        else:
+            self.a1in[key] = key
+
+    def access(self, key):
+        if key in self.am:
+            self.am.to_head(key)
+
+    def remove(self, key):
+        if key in self.am:
+            del self.am[key]
+        else:
+            del self.a1in[key]
+
+    def evict(self):
+        '''Remove and return key of next victim, or `None` if empty'''
+
+        if self.a1in and (len(self.a1in) > self.max_in or not self.am):
+            key = self.a1in.pop_last()
+            self.a1out[key] = key
+            if len(self.a1out) > self.max_out:
+                self.a1out.pop_last()
+            return key
+
+        if self.am:
+            return self.am.pop_last()
+
+        return None
+
+
+class ARCPolicy(object):
+    '''Adaptive replacement cache (Megiddo & Modha, 2003)
+
+    Recently used entries are kept in *t1* and entries that have been used
+    more than once in *t2*. Keys of evicted entries are remembered in *b1*
+    and *b2*, a hit in one of these lists shifts the target size *p* of *t1*
+    in favor of the respective list.
+    '''
+
+    def __init__(self, capacity):
+        super(ARCPolicy, self).__init__()
+        self.capacity = max(1, capacity)
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def __contains__(self, key):
+        return key in self.t1 or key in self.t2
+
+    def add(self, key):
+        if key in self.b1:
+            self.p = min(self.capacity,
+                         self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            self.t2[key] = key
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            self.t2[key] = key
+        else:
+            self.t1[key] = key
+
+        # Limit size of ghost lists
+        if len(self.t1) + len(self.b1) > self.capacity and self.b1:
+            self.b1.pop_last()
+        if (len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * self.capacity
+            and self.b2):
+            self.b2.pop_last()
+
+    def access(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = key
+        else:
+            self.t2.to_head(key)
+
+    def remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            del self.t2[key]
+
+    def evict(self):
+        '''Remove and return key of next victim, or `None` if empty'''
+
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            key = self.t1.pop_last()
+            self.b1[key] = key
+            return key
+
+        if self.t2:
+            key = self.t2.pop_last()
+            self.b2[key] = key
+            return key
+
+        return None
+
+
+POLICIES = { 'lru': LRUPolicy,
+             '2q': TwoQPolicy,
+             'arc': ARCPolicy }
+
+def get_policy(name, capacity):
+    '''Return new instance of eviction policy *name*
+
+    *capacity* is the expected number of cache entries.
+    '''
+
+    try:
+        return POLICIES[name](capacity)
+    except KeyError:
+        raise ValueError('Unknown cache policy: %s' % name)
@@ -0,0 +1,120 @@
+'''
+cache_stats.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Counters and histograms describing the behaviour of the block cache.
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+
+__all__ = [ 'Histogram', 'CacheStats', 'percentile' ]
+
+# Upper bound of the first histogram bucket (in seconds). Every further
+# bucket is twice as wide as the previous one.
+HIST_BASE = 0.001
+
+# Number of histogram buckets. The last bucket collects all values
+# that do not fit into the other ones.
+HIST_BUCKETS = 18
+
+class Histogram(object):
+    '''Distribution of durations
+
+    Bucket *i* counts the values up to ``HIST_BASE * 2**i`` seconds that did
+    not fit into bucket *i-1*.
+    '''
+
+    __slots__ = [ 'buckets', 'count', 'total', 'max' ]
+
+    def __init__(self):
+        super(Histogram, self).__init__()
+        self.buckets = [ 0 ] * HIST_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        '''Record *value*'''
+
+        limit = HIST_BASE
+        idx = 0
+        while value > limit and idx < HIST_BUCKETS - 1:
+            limit *= 2
+            idx += 1
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        '''Return contents as dict'''
+
+        return { 'buckets': list(self.buckets),
+                 'count': self.count,
+                 'total': self.total,
+                 'max': self.max }
+
+def percentile(hist, fraction):
+    '''Return upper bound of the bucket containing the *fraction* quantile
+
+    *hist* is a histogram snapshot as returned by `Histogram.snapshot`.
+    Returns `None` if no values have been recorded.
+    '''
+
+    if not hist['count']:
+        return None
+
+    needed = fraction * hist['count']
+    seen = 0
+    for (idx, cnt) in enumerate(hist['buckets']):
+        seen += cnt
+        if seen >= needed:
+            break
+
+    if idx == HIST_BUCKETS - 1:
+        return hist['max']
+    return min(HIST_BASE * 2**idx, hist['max'])
+
+class CacheStats(object):
+    '''Statistics of a block cache
+
+    Counters are identified by names of the form ``<group>.<reason>``, e.g.
+    ``get.download`` or ``evict.size``. Histograms record durations in
+    seconds.
+
+    The instance is not threadsafe, it is protected by the global lock
+    just like the cache itself.
+    '''
+
+    def __init__(self):
+        super(CacheStats, self).__init__()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def count(self, name, value=1):
+        '''Increase counter *name* by *value*'''
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, name, duration):
+        '''Add *duration* to histogram *name*'''
+
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].add(duration)
+
+    def reset(self):
+        '''Reset all counters and histograms'''
+
+        self.counters.clear()
+        self.histograms.clear()
+
+    def snapshot(self):
+        '''Return copy of all counters and histograms as dict'''
+
+        return { 'counters': dict(self.counters),
+                 'histograms': dict((name, hist.snapshot())
+                                    for (name, hist) in self.histograms.iteritems()) }
@@ -15,6 +15,7 @@ from s3ql.common import (CTRL_NAME, QuietError, setup_logging)
 from s3ql.parse_args import ArgumentParser
 import textwrap
 import sys
+import time
 import cPickle as pickle
 
 log = logging.getLogger("ctrl")
@@ -51,6 +52,34 @@ def parse_args(args):
     sparser.add_argument('cachesize', metavar='<size>', type=int,
                          help='New cache size in KB')
     
+    sparser = subparsers.add_parser('readahead', help='Change read-ahead window',
+                                    parents=[pparser])          
+    sparser.add_argument('readahead', metavar='<blocks>', type=int,
+                         help='Maximum number of blocks to prefetch (0 to disable)')
+    
+    sparser = subparsers.add_parser('prefetch', help='Download files into the cache',
+                                    epilog=pparser.epilog)
+    sparser.add_argument('path', metavar='<path>', type=(lambda x: x.rstrip('/')),
+                         help='File or directory to prefetch')
+    sparser.add_argument('--recursive', action='store_true', default=False,
+                         help='Also prefetch the contents of all subdirectories')
+    sparser.add_argument('--max-bytes', type=int, default=None, metavar='<bytes>',
+                         help='Maximum amount of data to prefetch '
+                              '(default: cache size)')
+    sparser.add_argument('--no-wait', action='store_false', dest='wait', default=True,
+                         help='Return immediately instead of waiting until all data '
+                              'has been downloaded')
+    
+    sparser = subparsers.add_parser('pin', help='Keep files in the cache',
+                                    epilog=pparser.epilog)
+    sparser.add_argument('path', metavar='<path>', type=(lambda x: x.rstrip('/')),
+                         help='File or directory tree to pin')
+    
+    sparser = subparsers.add_parser('unpin', help='Remove pin from files',
+                                    epilog=pparser.epilog)
+    sparser.add_argument('path', metavar='<path>', type=(lambda x: x.rstrip('/')),
+                         help='File or directory tree to unpin')
+    
     sparser = subparsers.add_parser('log', help='Change log level',
                                     parents=[pparser])
 
@@ -74,6 +103,13 @@ def parse_args(args):
             # Protected member ok, hopefully this won't break
             #pylint: disable=W0212
             options.level = logging._levelNames[options.level.upper()]
+
+    if options.action in ('prefetch', 'pin', 'unpin'):
+        # Every directory contains the control file
+        if os.path.isdir(options.path):
+            options.mountpoint = options.path
+        else:
+            options.mountpoint = os.path.dirname(os.path.abspath(options.path))
                              
     return options
 
@@ -90,12 +126,12 @@ def main(args=None):
     path = options.mountpoint
     
     if not os.path.exists(path):
-        raise QuietError('Mountpoint %r does not exist' % path)
+        raise QuietError('%r does not exist' % path)
     
     ctrlfile = os.path.join(path, CTRL_NAME)
     if not (CTRL_NAME not in llfuse.listdir(path)
             and os.path.exists(ctrlfile)):
-        raise QuietError('Mountpoint is not an S3QL file system')
+        raise QuietError('%r is not on an S3QL file system' % path)
 
     if os.stat(ctrlfile).st_uid != os.geteuid() and os.geteuid() != 0:
         raise QuietError('Only root and the mounting user may run s3qlctrl.')
@@ -114,6 +150,42 @@ def main(args=None):
     elif options.action == 'cachesize':
         llfuse.setxattr(ctrlfile, 'cachesize', pickle.dumps(options.cachesize*1024))    
 
+    elif options.action == 'readahead':
+        llfuse.setxattr(ctrlfile, 'readahead', pickle.dumps(options.readahead))
+
+    elif options.action == 'prefetch':
+        prefetch(ctrlfile, options)
+        
+    elif options.action in ('pin', 'unpin'):
+        if not os.path.exists(options.path):
+            raise QuietError('%r does not exist' % options.path)
+        llfuse.setxattr(ctrlfile, 'pin', 
+                        pickle.dumps((os.stat(options.path).st_ino, 
+                                      options.action == 'pin'), pickle.HIGHEST_PROTOCOL))
+
+        
+def prefetch(ctrlfile, options):
+    '''Prefetch *options.path* and report progress'''
+    
+    if not os.path.exists(options.path):
+        raise QuietError('%r does not exist' % options.path)
+    
+    (done0, queued0) = pickle.loads(llfuse.getxattr(ctrlfile, 'prefetch?'))
+    llfuse.setxattr(ctrlfile, 'prefetch', 
+                    pickle.dumps((os.stat(options.path).st_ino, options.recursive,
+                                  options.max_bytes), pickle.HIGHEST_PROTOCOL))
+    
+    if not options.wait:
+        return
+    
+    # Progress is reported for all blocks that have been scheduled since we
+    # started, including those scheduled by concurrent prefetch commands.
+    while True:
+        (done, queued) = pickle.loads(llfuse.getxattr(ctrlfile, 'prefetch?'))
+        log.info('Prefetched %d of %d blocks...', done - done0, queued - queued0)
+        if done >= queued:
+            break
+        time.sleep(1)
         
 
 if __name__ == '__main__':
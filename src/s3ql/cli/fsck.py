@@ -8,6 +8,7 @@ This program can be distributed under the terms of the GNU GPLv3.
 
 from __future__ import division, print_function, absolute_import
 from s3ql import CURRENT_FS_REV
+from s3ql.block_cache import INDEX_NAME
 from s3ql.backends.common import get_bucket
 from s3ql.common import (get_bucket_cachedir, cycle_metadata, setup_logging, 
     QuietError, get_seq_no, restore_metadata, dump_metadata)
@@ -83,7 +84,8 @@ def main(args=None):
         else:
             log.info('Using cached metadata.')
             db = Connection(cachepath + '.db')
-            assert not os.path.exists(cachepath + '-cache') or param['needs_fsck']
+            assert (not os.path.exists(cachepath + '-cache') or param['needs_fsck']
+                    or os.path.exists(os.path.join(cachepath + '-cache', INDEX_NAME)))
     
         if param_remote['seq_no'] != param['seq_no']:
             log.warn('Remote metadata is outdated.')
@@ -91,7 +93,8 @@ def main(args=None):
             
     else:
         param = param_remote
-        assert not os.path.exists(cachepath + '-cache')
+        assert (not os.path.exists(cachepath + '-cache')
+                or os.path.exists(os.path.join(cachepath + '-cache', INDEX_NAME)))
         # .db might exist if mount.s3ql is killed at exactly the right instant
         # and should just be ignored.
        
@@ -175,7 +178,8 @@ def main(args=None):
     if fsck.uncorrectable_errors:
         raise QuietError("Uncorrectable errors found, aborting.")
         
-    if os.path.exists(cachepath + '-cache'):
+    if (os.path.exists(cachepath + '-cache')
+        and not os.listdir(cachepath + '-cache')):
         os.rmdir(cachepath + '-cache')
         
     log.info('Saving metadata...')
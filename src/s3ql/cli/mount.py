@@ -33,6 +33,10 @@ import time
 
 log = logging.getLogger("mount")
 
+# Lower bound for the automatically determined maximum number of
+# upload threads
+MIN_MAX_THREADS = 8
+
 def install_thread_excepthook():
     """work around sys.excepthook thread bug
     
@@ -101,13 +105,26 @@ def main(args=None):
         inode_cache.RANDOMIZE_INODES = True
     else:
         db.execute('DROP INDEX IF EXISTS ix_contents_inode')
+
+    # Needed to find the other blocks that are stored in a packed object
+    db.execute('CREATE INDEX IF NOT EXISTS ix_blocks_obj_id ON blocks(obj_id)')
                        
     metadata_upload_thread = MetadataUploadThread(bucket_pool, param, db,
                                                   options.metadata_upload_interval)
     metadata_download_thread = MetadataDownloadThread(bucket_pool, param, cachepath,
                                                       options.metadata_download_interval)
+    if options.max_dirty is None:
+        max_dirty = options.cachesize * 1024 // 2
+    else:
+        max_dirty = options.max_dirty * 1024
     block_cache = BlockCache(bucket_pool, db, cachepath + '-cache',
-                             options.cachesize * 1024, options.max_cache_entries)
+                             options.cachesize * 1024, options.max_cache_entries,
+                             options.readahead, options.keep_cache,
+                             options.cache_policy, max_dirty,
+                             writeback_delay=options.writeback_delay,
+                             max_dirty_age=options.max_dirty_age,
+                             max_deletes=options.max_deletes or None,
+                             max_pinned=options.pinned_cachesize * 1024)
     commit_thread = CommitThread(block_cache)
     operations = fs.Operations(block_cache, db, blocksize=param['blocksize'],
                                upload_event=metadata_upload_thread.event)
@@ -125,7 +142,10 @@ def main(args=None):
     # After we start threads, we must be sure to terminate them
     # or the process will hang 
     try:
-        block_cache.init(options.threads)
+        block_cache.init(options.threads, options.min_threads,
+                         options.compression_processes)
+        with llfuse.lock:
+            block_cache.prefetch_pinned()
         metadata_upload_thread.start()
         metadata_download_thread.start()
         commit_thread.start()
@@ -241,7 +261,11 @@ def main(args=None):
         fh.close()
     
 def determine_threads(options):
-    '''Return optimum number of upload threads'''
+    '''Return maximum number of upload threads
+    
+    The number of concurrent transfers is adjusted by the block cache
+    at runtime, this is only the upper limit.
+    '''
             
     cores = os.sysconf('SC_NPROCESSORS_ONLN')
     memory = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGESIZE')
@@ -257,13 +281,17 @@ def determine_threads(options):
     if cores == -1 or memory == -1:
         log.warn("Can't determine number of cores, using 2 upload threads.")
         return 1
-    elif 2*cores * mem_per_thread > (memory/2):
+    
+    # Transfers spend most of their time waiting for the network,
+    # so use more threads than cores
+    threads = max(2*cores, MIN_MAX_THREADS)
+    if threads * mem_per_thread > (memory/2):
         threads = int((memory/2) // mem_per_thread)
-        log.info('Using %d upload threads (memory limited).', threads)
+        log.info('Using up to %d upload threads (memory limited).', threads)
         return threads
     else:
-        log.info("Using %d upload threads.", 2*cores)
-        return 2*cores
+        log.info("Using up to %d upload threads.", threads)
+        return threads
     
         
 def get_metadata(bucket, cachepath, readonly=False):
@@ -408,12 +436,42 @@ def parse_args(args):
                       help="Cache size in kb (default: 102400 (100 MB)). Should be at least 10 times "
                       "the blocksize of the filesystem, otherwise an object may be retrieved and "
                       "written several times during a single write() or read() operation.")
-    parser.add_argument("--max-cache-entries", type=int, default=768, metavar='<num>',
+    parser.add_argument("--pinned-cachesize", type=int, default=0, metavar='<size>', 
+                      help="Amount of data from trees pinned with `s3qlctrl pin` that is kept "
+                      "in the cache in addition to --cachesize, in kb (default: %(default)d). "
+                      "Pinned blocks are evicted only after all other clean blocks.")
+    parser.add_argument("--max-cache-entries", type=int, default=10000, metavar='<num>',
                       help="Maximum number of entries in cache (default: %(default)d). "
-                      'Each cache entry requires one file descriptor, so if you increase '
-                      'this number you have to make sure that your process file descriptor '
-                      'limit (as set with `ulimit -n`) is high enough (at least the number ' 
-                      'of cache entries + 100).')
+                      'Cache files are only kept open while they are in use, so this '
+                      'number is not limited by the process file descriptor limit.')
+    parser.add_argument("--readahead", type=int, default=4, metavar='<blocks>',
+                      help="Maximum number of blocks that are downloaded in advance when "
+                      "a file is read sequentially (default: %(default)d). The read-ahead "
+                      "window starts with one block and grows while the file is read "
+                      "sequentially. Set to 0 to disable read-ahead.")
+    parser.add_argument("--max-dirty", type=int, default=None, metavar='<size>',
+                      help="Maximum amount of modified data in the cache that has not yet "
+                      "been uploaded, in kb (default: half the cache size). When half of this "
+                      "amount is reached, write requests are delayed increasingly to give the "
+                      "uploads a chance to keep up.")
+    parser.add_argument("--writeback-delay", type=int, default=10, metavar='<seconds>',
+                      help="Upload modified blocks once they have not been changed for "
+                      "this many seconds (default: %(default)d).")
+    parser.add_argument("--max-dirty-age", type=int, default=120, metavar='<seconds>',
+                      help="Upload modified blocks at the latest this many seconds after "
+                      "they have first been changed, even if they are still being "
+                      "modified (default: %(default)d).")
+    parser.add_argument("--max-deletes", type=int, default=1000, metavar='<no>',
+                      help="Maximum number of objects that are removed from the backend "
+                      "per second, 0 for no limit (default: %(default)d).")
+    parser.add_argument("--cache-policy", choices=('lru', '2q', 'arc'), default='lru',
+                      help="Policy for evicting clean blocks from the cache (default: "
+                      "%(default)s). `2q` and `arc` prevent large sequential reads from "
+                      "pushing frequently used blocks out of the cache.")
+    parser.add_argument("--keep-cache", action="store_true", default=False,
+                      help="Do not empty the cache when unmounting. Clean cache entries are "
+                      "kept on disk and reused when the file system is mounted again, so "
+                      "that recently used data does not have to be downloaded again.")
     parser.add_argument("--allow-other", action="store_true", default=False, help=
                       'Normally, only the user who called `mount.s3ql` can access the mount '
                       'point. This user then also has full access to it, independent of '
@@ -448,7 +506,20 @@ def parse_args(args):
                            'Set to 0 to disable. Default: 10s.')
     parser.add_argument("--threads", action="store", type=int,
                       default=None, metavar='<no>',
-                      help='Number of parallel upload threads to use (default: auto).')
+                      help='Maximum number of parallel uploads and downloads. The number '
+                           'of concurrent transfers is adjusted between --min-threads and '
+                           'this value depending on the latency and error rate of the '
+                           'backend (default: auto).')
+    parser.add_argument("--min-threads", action="store", type=int,
+                      default=1, metavar='<no>',
+                      help='Minimum number of parallel uploads and downloads '
+                           '(default: %(default)d).')
+    parser.add_argument("--compression-processes", action="store", type=int,
+                      default=0, metavar='<no>',
+                      help='Compress and encrypt data in this many separate worker '
+                           'processes instead of in the upload threads. This allows '
+                           'to use more than one CPU core. Every process needs about '
+                           '200 MB of RAM with LZMA compression (default: disabled).')
     parser.add_argument("--nfs", action="store_true", default=False,
                       help='Support export of S3QL file systems over NFS ' 
                            '(default: %(default)s)')
@@ -665,7 +736,10 @@ def setup_exchook():
    
 class CommitThread(Thread):
     '''
-    Periodically upload dirty blocks.
+    Upload dirty blocks when their writeback time has come.
+    
+    The thread sleeps until the next dirty block becomes due (see
+    `BlockCache.upload_due`), so the cache is never scanned.
     
     This class uses the llfuse global lock. When calling objects
     passed in the constructor, the global lock is acquired first.
@@ -682,29 +756,17 @@ class CommitThread(Thread):
         log.debug('CommitThread: start')
  
         while not self.stop_event.is_set():
-            did_sth = False
-            stamp = time.time()
-            for el in self.block_cache.entries.values_rev():
-                if stamp - el.last_access < 10:
-                    break
-                if not (el.dirty and (el.inode, el.blockno) not in self.block_cache.in_transit):
-                    continue
-                        
-                # Acquire global lock to access UploadManager instance
-                with llfuse.lock:
-                    if self.stop_event.is_set():
-                        break
-                    # Object may have been accessed while waiting for lock
-                    if not (el.dirty and (el.inode, el.blockno) not in self.block_cache.in_transit):
-                        continue
-                    self.block_cache.upload(el)
-                did_sth = True
-
+            with llfuse.lock:
                 if self.stop_event.is_set():
                     break
+                due = self.block_cache.upload_due()
             
-            if not did_sth:
-                self.stop_event.wait(5)
+            # Blocks that become dirty while we are waiting are due
+            # no earlier than writeback_delay seconds from now
+            timeout = self.block_cache.writeback_delay
+            if due is not None:
+                timeout = min(timeout, max(due - time.time(), 0))
+            self.stop_event.wait(timeout)
 
         log.debug('CommitThread: end')    
         
@@ -8,9 +8,11 @@ This program can be distributed under the terms of the GNU GPLv3.
 
 from __future__ import division, print_function, absolute_import
 
+import cPickle as pickle
 import llfuse
 import os
 import logging
+from s3ql.cache_stats import percentile
 from s3ql.common import (CTRL_NAME, QuietError, setup_logging) 
 from s3ql.parse_args import ArgumentParser
 import posixpath
@@ -31,6 +33,9 @@ def parse_args(args):
     parser.add_argument("mountpoint", metavar='<mountpoint>',
                         type=(lambda x: x.rstrip('/')),
                         help='Mount point of the file system to examine')
+    parser.add_argument("--cache", action="store_true", default=False,
+                        help='Print statistics about the block cache instead '
+                             'of the file system')
 
     return parser.parse_args(args)
 
@@ -57,13 +62,19 @@ def main(args=None):
     if os.stat(ctrlfile).st_uid != os.geteuid() and os.geteuid() != 0:
         raise QuietError('Only root and the mounting user may run s3qlstat.')
     
+    if options.cache:
+        buf = llfuse.getxattr(ctrlfile, b's3qlcache', size_guess=4096)
+        print_cache_stats(pickle.loads(buf))
+        return
+    
     # Use a decent sized buffer, otherwise the statistics have to be
     # calculated thee(!) times because we need to invoce getxattr
     # three times.
     buf = llfuse.getxattr(ctrlfile, b's3qlstat', size_guess=256)
 
-    (entries, blocks, inodes, fs_size, dedup_size,
-     compr_size, db_size) = struct.unpack('QQQQQQQ', buf)
+    (entries, blocks, inodes, fs_size, dedup_size, compr_size, db_size,
+     up_slots, up_max, down_slots, down_max, pinned_inodes, pinned_size,
+     max_pinned) = struct.unpack('QQQQQQQQQQQQQQ', buf)
     p_dedup = dedup_size * 100 / fs_size if fs_size else 0
     p_compr_1 = compr_size * 100 / fs_size if fs_size else 0
     p_compr_2 = compr_size * 100 / dedup_size if dedup_size else 0
@@ -77,9 +88,73 @@ def main(args=None):
            'After compression:    %.2f MB (%.2f%% of total, %.2f%% of de-duplicated)'
              % (compr_size /mb, p_compr_1, p_compr_2),
            'Database size:        %.2f MB (uncompressed)' % (db_size / mb),
+           'Concurrent transfers: %d of %d uploads, %d of %d downloads'
+             % (up_slots, up_max, down_slots, down_max),
+           'Pinned inodes:        %d (%.2f MB cached, %.2f MB reserved)'
+             % (pinned_inodes, pinned_size / mb, max_pinned / mb),
            '(some values do not take into account not-yet-uploaded dirty blocks in cache)', 
            sep='\n')
     
 
+def print_cache_stats(stats):
+    '''Print block cache statistics returned by `BlockCache.get_stats`'''
+    
+    gauges = stats['gauges']
+    counters = stats['counters']
+    hists = stats['histograms']
+    mb = 1024**2
+    
+    def count(name):
+        return counters.get(name, 0)
+    
+    hits = count('get.clean') + count('get.dirty') + count('get.linked')
+    misses = count('get.download')
+    lookups = hits + misses + count('get.new') + count('get.overwrite')
+    hit_ratio = hits * 100 / (hits + misses) if hits + misses else 0
+    
+    print('Cache entries:        %d of %d' % (gauges['entries'], gauges['max_entries']),
+          'Cache size:           %.2f MB of %.2f MB' % (gauges['size'] / mb, 
+                                                     gauges['max_size'] / mb),
+          'Dirty entries:        %d (%.2f MB)' % (gauges['dirty_entries'], 
+                                                  gauges['dirty_size'] / mb),
+          'Pinned:               %d inodes, %.2f MB of %.2f MB' 
+            % (gauges['pinned_inodes'], gauges['pinned_size'] / mb, 
+               gauges['max_pinned'] / mb),
+          'Block lookups:        %d' % lookups,
+          '  clean hits:         %d' % count('get.clean'),
+          '  dirty hits:         %d' % count('get.dirty'),
+          '  shared copy hits:   %d' % count('get.linked'),
+          '  downloads:          %d' % count('get.download'),
+          '  new blocks:         %d' % count('get.new'),
+          '  full overwrites:    %d' % count('get.overwrite'),
+          'Hit ratio:            %.2f%% (excluding new and overwritten blocks)' % hit_ratio,
+          'Hole reads:           %d' % count('get.hole'),
+          'Prefetched blocks:    %d' % count('prefetch.download'),
+          'Evictions:            %d for size, %d pinned, %d for entry limit, %d removed, '
+          '%d flushed' % (count('evict.size'), count('evict.pinned'), count('evict.entries'),
+                          count('evict.remove'), count('evict.clear')),
+          'Committed blocks:     %d new, %d de-duplicated, %d unchanged, %d zero'
+            % (count('upload.new'), count('upload.dedup'), count('upload.unchanged'),
+               count('upload.zero')),
+          'Downloaded:           %.2f MB' % (count('bytes.downloaded') / mb),
+          'Uploaded:             %.2f MB (%.2f MB compressed)' 
+            % (count('bytes.uploaded') / mb, count('bytes.uploaded_compressed') / mb),
+          'Queues:               %d uploads, %d removals, %d repacks, %d prefetches, '
+          '%d in transit' % (gauges['upload_queue'], gauges['removal_queue'],
+                             gauges['repack_queue'], gauges['download_queue'],
+                             gauges['in_transit']),
+          sep='\n')
+    
+    for (name, title) in (('latency.download', 'Download latency'),
+                          ('latency.upload', 'Upload latency'),
+                          ('latency.wait', 'Time waiting for transfers')):
+        hist = hists.get(name)
+        if not hist or not hist['count']:
+            continue
+        print('%-22s%d times, avg %.3f s, median <= %.3f s, 95%% <= %.3f s, max %.3f s'
+              % (title + ':', hist['count'], hist['total'] / hist['count'], 
+                 percentile(hist, 0.5), percentile(hist, 0.95), hist['max']))
+    
+
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -92,6 +92,15 @@ def add_stdout_logging(quiet=False):
     return handler
 
 RETRY_TIMEOUT=60*60*24
+
+# Number of retries made by the current thread
+_retries = threading.local()
+
+def get_retry_count():
+    '''Return number of retries made by `retry` in the current thread'''
+
+    return getattr(_retries, 'count', 0)
+
 def retry(fn):
     '''Decorator for retrying a method on some exceptions
     
@@ -120,6 +129,7 @@ def retry(fn):
                 
                 log.debug('%s.%s(*): trying again after %r exception:', 
                           self.__class__.__name__, fn.__name__, exc)
+                _retries.count = get_retry_count() + 1
                 
             time.sleep(interval)
             waited += interval
@@ -189,7 +199,8 @@ def dump_metadata(ofh, conn):
                       ('inode_blocks', 'inode, blockno'),
                       ('inodes', 'id'), ('symlink_targets', 'inode'),
                       ('names', 'id'), ('contents', 'parent_inode, name_id'),
-                      ('ext_attributes', 'inode, name')]
+                      ('ext_attributes', 'inode, name'), ('deleted_objects', 'id'),
+                      ('pinned_inodes', 'inode')]
 
     columns = dict()
     for (table, _) in tables_to_dump:
@@ -465,11 +476,21 @@ def init_tables(conn):
 def create_tables(conn): 
     # Table of storage objects
     # Refcount is included for performance reasons
+    # Size is the uncompressed size, it may be zero for objects
+    # created before revision 13
     conn.execute("""
     CREATE TABLE objects (
         id        INTEGER PRIMARY KEY AUTOINCREMENT,
         refcount  INT NOT NULL, 
-        compr_size INT  
+        compr_size INT,
+        size      INT NOT NULL DEFAULT 0
+    )""")
+
+    # Objects that have been removed from the objects table, but
+    # still need to be removed from the backend
+    conn.execute("""
+    CREATE TABLE deleted_objects (
+        id        INTEGER PRIMARY KEY
     )""")
 
     # Table of known data blocks
@@ -480,7 +501,8 @@ def create_tables(conn):
         hash      BLOB(16) UNIQUE,
         refcount  INT NOT NULL,
         size      INT NOT NULL,    
-        obj_id    INTEGER NOT NULL REFERENCES objects(id)
+        obj_id    INTEGER NOT NULL REFERENCES objects(id),
+        obj_offset INT NOT NULL DEFAULT 0
     )""")
                 
     # Table with filesystem metadata
@@ -558,6 +580,12 @@ def create_tables(conn):
         PRIMARY KEY (inode, name)               
     )""")
 
+    # Inodes whose blocks should be kept in the cache
+    conn.execute("""
+    CREATE TABLE pinned_inodes (
+        inode     INTEGER PRIMARY KEY REFERENCES inodes(id)
+    )""")
+
     # Shortcurts
     conn.execute("""
     CREATE VIEW contents_v AS
@@ -0,0 +1,164 @@
+'''
+concurrency.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Adaptive limit for the number of concurrent transfers.
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+from .common import get_retry_count
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+__all__ = [ 'AIMDController' ]
+
+log = logging.getLogger("concurrency")
+
+# Weight of the most recent transfer in the moving averages
+EWMA_WEIGHT = 0.1
+
+# Transfers that take longer than this multiple of the time that their
+# size would take at the average throughput are taken as a sign of
+# congestion
+SLOW_FACTOR = 4
+
+# Transfers shorter than this (in seconds) are never considered slow
+MIN_SLOW_DURATION = 1
+
+class Transfer(object):
+    '''A transfer in progress
+
+    The number of transferred bytes should be stored in the *size* attribute.
+    '''
+
+    __slots__ = [ 'size' ]
+
+    def __init__(self):
+        self.size = 0
+
+class AIMDController(object):
+    '''Adapt number of concurrent transfers to the backend
+
+    Every transfer has to reserve a slot by calling the instance (which
+    returns a context manager). The number of slots is adjusted by additive
+    increase/multiplicative decrease (AIMD): a transfer that completes
+    successfully while all slots are in use raises the limit by 1/*limit*,
+    i.e. by one slot for every round of transfers. If a transfer fails, had
+    to retry a request (e.g. because the backend asked us to slow down) or
+    transferred its data much more slowly than average, the limit is halved. The limit is
+    decreased at most once per round, so that the transfers that were
+    already running do not reduce it any further.
+
+    This class is threadsafe.
+
+    Attributes:
+    -----------
+
+    :min_limit: minimum number of slots
+    :max_limit: maximum number of slots
+    :limit: current number of slots (fractional)
+    :active: number of transfers in progress
+    :latency: moving average of transfer duration in seconds (`None` if no
+       transfer has completed yet)
+    :throughput: moving average of the throughput of single transfers in
+       bytes per second (`None` if no transfer has completed yet)
+    :requests: number of completed transfers
+    :errors: number of failed or congested transfers
+    '''
+
+    def __init__(self, min_limit, max_limit, limit=None):
+        super(AIMDController, self).__init__()
+
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError('Invalid limits: %d, %d' % (min_limit, max_limit))
+
+        if limit is None:
+            limit = max(min_limit, max_limit // 2)
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(limit)
+        self.active = 0
+        self.latency = None
+        self.throughput = None
+        self.requests = 0
+        self.errors = 0
+        self.since_decrease = 0
+        self.cv = threading.Condition(threading.Lock())
+
+    @property
+    def slots(self):
+        '''Current number of slots'''
+
+        return int(self.limit)
+
+    @contextmanager
+    def __call__(self):
+        '''Reserve a transfer slot (context manager)
+
+        Blocks while all slots are in use and yields a `Transfer` instance.
+        '''
+
+        transfer = Transfer()
+        with self.cv:
+            while self.active >= int(self.limit):
+                self.cv.wait()
+            self.active += 1
+            saturated = self.active >= int(self.limit)
+
+        retries = get_retry_count()
+        stamp = time.time()
+        try:
+            yield transfer
+        except:
+            self._completed(time.time() - stamp, transfer.size, saturated, True)
+            raise
+        self._completed(time.time() - stamp, transfer.size, saturated,
+                        get_retry_count() != retries)
+
+    def _completed(self, duration, size, saturated, congested):
+        '''Update limit after a transfer has completed'''
+
+        with self.cv:
+            self.active -= 1
+            self.requests += 1
+            self.since_decrease += 1
+
+            # Large transfers take longer than small ones, so the duration
+            # is compared with the time expected for the transfer's size
+            if (not congested and self.throughput and size
+                and duration > max(MIN_SLOW_DURATION, 
+                                   SLOW_FACTOR * size / self.throughput)):
+                log.debug('Transfer of %d bytes took %.3f seconds (average %.0f bytes/sec), '
+                          'assuming congestion', size, duration, self.throughput)
+                congested = True
+
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += EWMA_WEIGHT * (duration - self.latency)
+            if duration > 0:
+                rate = size / duration
+                if self.throughput is None:
+                    self.throughput = rate
+                else:
+                    self.throughput += EWMA_WEIGHT * (rate - self.throughput)
+
+            if congested:
+                self.errors += 1
+                if self.since_decrease >= self.limit:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.since_decrease = 0
+                    log.debug('Decreased transfer limit to %d', self.limit)
+            elif saturated:
+                old = int(self.limit)
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                if int(self.limit) != old:
+                    log.debug('Increased transfer limit to %d', self.limit)
+
+            self.cv.notify_all()
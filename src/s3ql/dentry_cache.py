@@ -0,0 +1,80 @@
+'''
+dentry_cache.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function, absolute_import
+
+from .ordered_dict import OrderedDict
+
+__all__ = [ 'DentryCache' ]
+
+CACHE_SIZE = 10000
+
+class DentryCache(object):
+    '''
+    This class caches the results of directory entry lookups.
+
+    Every entry maps a parent inode and a name to the inode of the
+    directory entry, or to `None` if no entry with this name exists
+    (negative entry). When the cache is full, the least recently used
+    entry is removed.
+
+    The cache has to be informed about every change of the *contents*
+    table, either by calling `invalidate` for the affected name or by
+    calling `clear`.
+
+    Attributes:
+    -----------
+    :entries: ordered dict of cached entries, most recently used first
+    :max_size: maximum number of cached entries
+    '''
+
+    def __init__(self, max_size=CACHE_SIZE):
+        super(DentryCache, self).__init__()
+        self.entries = OrderedDict()
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, id_p, name):
+        '''Return inode of *name* in directory *id_p*
+
+        Returns `None` if the entry is known not to exist, and raises
+        `KeyError` if the entry is not cached.
+        '''
+
+        key = (id_p, name)
+        id_ = self.entries[key]
+        self.entries.to_head(key)
+        return id_
+
+    def add(self, id_p, name, id_):
+        '''Cache inode *id_* (or `None`) for *name* in directory *id_p*'''
+
+        key = (id_p, name)
+        if key in self.entries:
+            self.entries[key] = id_
+            self.entries.to_head(key)
+            return
+
+        self.entries[key] = id_
+        while len(self.entries) > self.max_size:
+            self.entries.pop_last()
+
+    def invalidate(self, id_p, name):
+        '''Remove *name* in directory *id_p* from the cache'''
+
+        try:
+            del self.entries[(id_p, name)]
+        except KeyError:
+            pass
+
+    def clear(self):
+        '''Remove all entries'''
+
+        self.entries.clear()
@@ -10,8 +10,9 @@ from __future__ import division, print_function, absolute_import
 from .backends.common import NoSuchObject, ChecksumError
 from .common import (get_path, CTRL_NAME, CTRL_INODE, LoggerFilter)
 from .database import NoSuchRowError
-from .inode_cache import InodeCache, OutOfInodesError
-from cStringIO import StringIO
+from .dentry_cache import DentryCache
+from . import inode_cache
+from .inode_cache import InodeCache, OutOfInodesError, ATTRIBUTES
 from llfuse import FUSEError
 import cPickle as pickle
 import collections
@@ -20,6 +21,7 @@ import llfuse
 import logging
 import math
 import os
+from random import randint
 import stat
 import struct
 import time
@@ -27,9 +29,31 @@ import time
 # standard logger for this module
 log = logging.getLogger("fs")
 
+# Inode attributes, qualified so that they can be used in joins
+INODE_COLUMNS = ', '.join('inodes.%s' % x for x in ATTRIBUTES)
+
 # For long requests, we force a GIL release in the following interval
 GIL_RELEASE_INTERVAL = 0.05
 
+# Time (in seconds) for which the kernel may cache the non-existence of a
+# directory entry. Entries that are not created by a request of the kernel
+# (i.e., by copy_tree()) have to be invalidated explicitly.
+NEGATIVE_TIMEOUT = 300
+
+class NegativeEntry(object):
+    '''Lookup result for a non-existing directory entry
+    
+    The kernel caches entries with inode number zero as negative entries
+    for `entry_timeout` seconds.
+    '''
+    
+    st_ino = 0
+    generation = 0
+    entry_timeout = NEGATIVE_TIMEOUT
+    attr_timeout = 0
+    st_mode = st_nlink = st_uid = st_gid = st_rdev = st_size = 0
+    st_blksize = st_blocks = st_atime = st_mtime = st_ctime = 0
+
 class Operations(llfuse.Operations):
     """A full-featured file system for online data storage
 
@@ -47,9 +71,14 @@ class Operations(llfuse.Operations):
 
     :cache:       Holds information about cached blocks
     :inode_cache: A cache for the attributes of the currently opened inodes.
+    :dentries:    A cache for the results of directory entry lookups,
+                  including lookups of non-existing entries.
     :open_inodes: dict of currently opened inodes. This is used to not remove
                   the blocks of unlinked inodes that are still open.
     :upload_event: If set, triggers a metadata upload
+    :read_state:  dict mapping inodes to ``(next_offset, window)`` tuples. This
+                  is used to detect sequential reads and to adapt the number of
+                  blocks that are prefetched ahead of the reader.
  
     Multithreading
     --------------
@@ -72,16 +101,31 @@ class Operations(llfuse.Operations):
         super(Operations, self).__init__()
 
         self.inodes = InodeCache(db)
+        self.dentries = DentryCache()
         self.db = db
         self.upload_event = upload_event
         self.open_inodes = collections.defaultdict(lambda: 0)
         self.blocksize = blocksize
         self.cache = block_cache
+        self.read_state = dict()
 
     def destroy(self):
         self.inodes.destroy()
 
     def lookup(self, id_p, name):
+        try:
+            return self._lookup(id_p, name)
+        except FUSEError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+            return NegativeEntry()
+        
+    def _lookup(self, id_p, name):
+        '''Return inode of entry *name* in directory *id_p*
+        
+        Raises `FUSEError` with ENOENT if there is no such entry.
+        '''
+        
         if name == CTRL_NAME:
             inode = self.inodes[CTRL_INODE]
             
@@ -101,9 +145,16 @@ class Operations(llfuse.Operations):
             return self.inodes[id_]
 
         try:
-            id_ = self.db.get_val("SELECT inode FROM contents_v WHERE name=? AND parent_inode=?",
-                                  (name, id_p))
-        except NoSuchRowError:
+            id_ = self.dentries.get(id_p, name)
+        except KeyError:
+            try:
+                id_ = self.db.get_val("SELECT inode FROM contents_v WHERE name=? AND parent_inode=?",
+                                      (name, id_p))
+            except NoSuchRowError:
+                id_ = None
+            self.dentries.add(id_p, name, id_)
+            
+        if id_ is None:
             raise(llfuse.FUSEError(errno.ENOENT))
         return self.inodes[id_]
 
@@ -152,12 +203,16 @@ class Operations(llfuse.Operations):
         if inode.atime < inode.ctime or inode.atime < inode.mtime:
             inode.atime = time.time() 
 
+        # The attributes are retrieved together with the names, so
+        # that we do not need a separate query for every entry.
         # The ResultSet is automatically deleted
         # when yield raises GeneratorExit.  
-        res = self.db.query("SELECT rowid, name, inode FROM contents_v "
-                            'WHERE parent_inode=? AND contents_v.rowid > ? ORDER BY rowid', (id_, off))
-        for (next_, name, cid_) in res:
-            yield (name, self.inodes[cid_], next_)
+        res = self.db.query('SELECT contents_v.rowid, name, %s FROM contents_v '
+                            'JOIN inodes ON inodes.id = contents_v.inode '
+                            'WHERE parent_inode=? AND contents_v.rowid > ? '
+                            'ORDER BY contents_v.rowid' % INODE_COLUMNS, (id_, off))
+        for row in res:
+            yield (row[1], self.inodes.load(row[2:]), row[0])
 
     def getxattr(self, id_, name):
         # Handle S3QL commands
@@ -168,6 +223,13 @@ class Operations(llfuse.Operations):
             elif name == b's3qlstat':
                 return self.extstat()
 
+            elif name == b's3qlcache':
+                return pickle.dumps(self.cache.get_stats(), 2)
+
+            elif name == b'prefetch?':
+                return pickle.dumps((self.cache.warmup_done, 
+                                     self.cache.warmup_queued), 2)
+
             raise llfuse.FUSEError(errno.EINVAL)
 
         else:
@@ -199,12 +261,18 @@ class Operations(llfuse.Operations):
                     raise llfuse.FUSEError(errno.ENOTTY)
             elif name == 'lock':
                 self.lock_tree(*pickle.loads(value))  
+            elif name == 'prefetch':
+                self.prefetch_tree(*pickle.loads(value))
+            elif name == 'pin':
+                self.pin_tree(*pickle.loads(value))
             elif name == 'rmtree':
                 self.remove_tree(*pickle.loads(value))
             elif name == 'logging':
                 update_logging(*pickle.loads(value))
             elif name == 'cachesize':
                 self.cache.max_size = pickle.loads(value)      
+            elif name == 'readahead':
+                self.cache.max_readahead = pickle.loads(value)
             else:
                 raise llfuse.FUSEError(errno.EINVAL)
         else:
@@ -259,6 +327,113 @@ class Operations(llfuse.Operations):
 
         log.debug('lock_tree(%d): end', id0)
 
+    def prefetch_tree(self, id0, recursive=False, max_bytes=None):
+        '''Schedule blocks below *id0* for download into the cache
+        
+        If *id0* is a directory, the blocks of the files that it contains
+        are scheduled (and, if *recursive* is set, those of all its
+        subdirectories). At most *max_bytes* (or the maximum cache size,
+        whichever is smaller) are scheduled. For pinned trees, the pinned
+        cache size takes the place of the maximum cache size. The blocks
+        are downloaded by the download threads of the block cache, this
+        method does not wait for them.
+        
+        Returns the number of scheduled blocks.
+        '''
+        
+        log.debug('prefetch_tree(%d): start', id0)
+        
+        if id0 in self.cache.pinned:
+            limit = self.cache.max_pinned or self.cache.max_size
+        else:
+            limit = self.cache.max_size
+        if max_bytes is None:
+            max_bytes = limit
+        else:
+            max_bytes = min(max_bytes, limit)
+        
+        queue = [ id0 ]
+        seen = set(queue)
+        total = 0
+        scheduled = 0
+        full = False
+        processed = 0 # Number of steps since last GIL release
+        stamp = time.time() # Time of last GIL release
+        gil_step = 250 # Approx. number of steps between GIL releases
+        while queue and not full:
+            id_ = queue.pop()
+            blocks = list(self.db.query('SELECT blockno, blocks.size FROM inode_blocks_v '
+                                        'JOIN blocks ON block_id = blocks.id '
+                                        'WHERE inode=? ORDER BY blockno', (id_,)))
+            for (blockno, size) in blocks:
+                if total + size > max_bytes:
+                    full = True
+                    break
+                if self.cache.prefetch_block(id_, blockno):
+                    total += size
+                    scheduled += 1
+                processed += 1
+                
+            if id_ == id0 or recursive:
+                for (cid_,) in list(self.db.query('SELECT inode FROM contents '
+                                                  'WHERE parent_inode=?', (id_,))):
+                    if cid_ not in seen:
+                        seen.add(cid_)
+                        queue.append(cid_)
+                    processed += 1
+                            
+            if processed > gil_step:
+                dt = time.time() - stamp
+                gil_step = max(int(gil_step * GIL_RELEASE_INTERVAL / dt), 1)
+                log.debug('prefetch_tree(%d): Adjusting gil_step to %d', 
+                          id0, gil_step)  
+                processed = 0
+                llfuse.lock.yield_()
+                stamp = time.time()
+
+        log.debug('prefetch_tree(%d): scheduled %d blocks (%d bytes)', 
+                  id0, scheduled, total)
+        return scheduled
+
+    def pin_tree(self, id0, pin=True):
+        '''Pin or unpin directory tree in the cache
+        
+        When pinning, the blocks of the tree are also scheduled for
+        download.
+        '''
+        
+        log.debug('pin_tree(%d, %s): start', id0, pin)
+        queue = [ id0 ]
+        inodes = set(queue)
+        processed = 0 # Number of steps since last GIL release
+        stamp = time.time() # Time of last GIL release
+        gil_step = 500 # Approx. number of steps between GIL releases
+        while queue:
+            id_p = queue.pop()
+            for (id_,) in list(self.db.query('SELECT inode FROM contents WHERE parent_inode=?',
+                                             (id_p,))):
+                if id_ not in inodes:
+                    inodes.add(id_)
+                    queue.append(id_)
+                processed += 1
+                
+            if processed > gil_step:
+                dt = time.time() - stamp
+                gil_step = max(int(gil_step * GIL_RELEASE_INTERVAL / dt), 1)
+                log.debug('pin_tree(%d): Adjusting gil_step to %d', 
+                          id0, gil_step)  
+                processed = 0
+                llfuse.lock.yield_()
+                stamp = time.time()
+        
+        if pin:
+            self.cache.pin(inodes)
+            self.prefetch_tree(id0, recursive=True)
+        else:
+            self.cache.unpin(inodes)
+            
+        log.debug('pin_tree(%d, %s): end, %d inodes', id0, pin, len(inodes))
+
     def remove_tree(self, id_p0, name0):
         '''Remove directory tree'''
                
@@ -267,7 +442,7 @@ class Operations(llfuse.Operations):
         if self.inodes[id_p0].locked:
             raise FUSEError(errno.EPERM)
             
-        id0 = self.lookup(id_p0, name0).id
+        id0 = self._lookup(id_p0, name0).id
         queue = [ id0 ]
         processed = 0 # Number of steps since last GIL release
         stamp = time.time() # Time of last GIL release
@@ -314,12 +489,19 @@ class Operations(llfuse.Operations):
         
     
     def copy_tree(self, src_id, target_id):
-        '''Efficiently copy directory tree'''
+        '''Efficiently copy directory tree
+
+        The tree is replicated one directory level at a time. The entries of
+        a level are collected in a temporary table and then copied in
+        batches, every batch is handled by a fixed number of ``INSERT ...
+        SELECT`` and ``UPDATE`` statements, independent of the number of
+        entries. The global lock is released between batches, the batch size
+        is adjusted so that the lock is not held for much longer than
+        `GIL_RELEASE_INTERVAL`.
+        '''
 
         log.debug('copy_tree(%d, %d): start', src_id, target_id)
 
-        # To avoid lookups and make code tidier
-        make_inode = self.inodes.create_inode
         db = self.db
                 
         # First we make sure that all blocks are in the database
@@ -335,93 +517,187 @@ class Operations(llfuse.Operations):
         # We first replicate into a dummy inode, so that we
         # need to invalidate only once.
         timestamp = time.time()
-        tmp = make_inode(mtime=timestamp, ctime=timestamp, atime=timestamp,
-                         uid=0, gid=0, mode=0, refcount=0)
+        tmp = self.inodes.create_inode(mtime=timestamp, ctime=timestamp, atime=timestamp,
+                                       uid=0, gid=0, mode=0, refcount=0)
+
+        # Other copies may run while we release the lock, so the
+        # temporary tables have to be unique
+        t = dict((name, 'copy_%s_%d' % (name, tmp.id))
+                 for name in ('dirs', 'entries', 'batch', 'new', 'map', 'refs'))
         
-        queue = [ (src_id, tmp.id, 0) ]
-        id_cache = dict()
-        processed = 0 # Number of steps since last GIL release
-        stamp = time.time() # Time of last GIL release
-        gil_step = 100 # Approx. number of steps between GIL releases
-        while queue:
-            (src_id, target_id, rowid) = queue.pop()
-            log.debug('copy_tree(%d, %d): Processing directory (%d, %d, %d)', 
-                      src_inode.id, target_inode.id, src_id, target_id, rowid)
-            for (name_id, id_, rowid) in db.query('SELECT name_id, inode, rowid FROM contents '
-                                                  'WHERE parent_inode=? AND rowid > ? '
-                                                  'ORDER BY rowid', (src_id, rowid)):
-
-                if id_ not in id_cache:
-                    inode = self.inodes[id_]
-    
-                    try:
-                        inode_new = make_inode(refcount=1, mode=inode.mode, size=inode.size,
-                                               uid=inode.uid, gid=inode.gid,
-                                               mtime=inode.mtime, atime=inode.atime,
-                                               ctime=inode.ctime, rdev=inode.rdev)
-                    except OutOfInodesError:
-                        log.warn('Could not find a free inode')
-                        raise FUSEError(errno.ENOSPC)
-    
-                    id_new = inode_new.id
-    
-                    if inode.refcount != 1:
-                        id_cache[id_] = id_new
-    
-                    db.execute('INSERT INTO symlink_targets (inode, target) '
-                               'SELECT ?, target FROM symlink_targets WHERE inode=?',
-                               (id_new, id_))
-                        
-                    db.execute('INSERT INTO inode_blocks (inode, blockno, block_id) '
-                               'SELECT ?, blockno, block_id FROM inode_blocks '
-                               'WHERE inode=?', (id_new, id_))
+        # Directories whose entries have yet to be copied
+        db.execute('CREATE TEMPORARY TABLE %(dirs)s (src INT, target INT)' % t)
+        
+        # Entries of the current level
+        db.execute('CREATE TEMPORARY TABLE %(entries)s (seq INTEGER PRIMARY KEY, '
+                   'src_p INT, name_id INT, target_p INT)' % t)
+        
+        # Entries of the current batch
+        db.execute('CREATE TEMPORARY TABLE %(batch)s (name_id INT, src INT, '
+                   'target_p INT, target INT)' % t)
+        
+        # Inodes created in the current batch
+        db.execute('CREATE TEMPORARY TABLE %(new)s (seq INTEGER PRIMARY KEY, '
+                   'src INT UNIQUE, target INT UNIQUE)' % t)
+        
+        # Copies of inodes with more than one link
+        db.execute('CREATE TEMPORARY TABLE %(map)s (src INTEGER PRIMARY KEY, target INT)' % t)
+        
+        # Reference count increments
+        db.execute('CREATE TEMPORARY TABLE %(refs)s (id INTEGER PRIMARY KEY, count INT)' % t)
+        
+        try:
+            db.execute('INSERT INTO %(dirs)s (src, target) VALUES(?, ?)' % t,
+                       (src_id, tmp.id))
+            step = 1000 # Approx. number of entries between GIL releases
+            level = 0
+            while db.has_val('SELECT 1 FROM %(dirs)s' % t):
+                db.execute('DELETE FROM %(entries)s' % t)
+                db.execute('INSERT INTO %(entries)s (src_p, name_id, target_p) '
+                           'SELECT parent_inode, name_id, target '
+                           'FROM %(dirs)s JOIN contents ON parent_inode = src' % t)
+                db.execute('DELETE FROM %(dirs)s' % t)
+                (lo, hi) = db.get_row('SELECT IFNULL(MIN(seq)-1, 0), IFNULL(MAX(seq), 0) '
+                                      'FROM %(entries)s' % t)
+                log.debug('copy_tree(%d, %d): Copying %d entries on level %d',
+                          src_inode.id, target_inode.id, hi - lo, level)
+                
+                while lo < hi:
+                    stamp = time.time()
+                    self._copy_batch(t, lo, lo + step)
+                    lo += step
                     
-                    db.execute('UPDATE inodes SET block_id='
-                               '(SELECT block_id FROM inodes WHERE id=?) '
-                               'WHERE id=?', (id_, id_new))   
-                                     
-                    processed += db.execute('REPLACE INTO blocks (id, hash, refcount, size, obj_id) '
-                                            'SELECT id, hash, refcount+1, size, obj_id '
-                                            'FROM inode_blocks_v JOIN blocks ON block_id = id '
-                                            'WHERE inode = ?', (id_new,))
+                    dt = time.time() - stamp
+                    if dt > 0:
+                        step = max(int(step * GIL_RELEASE_INTERVAL / dt), 1)
+                    log.debug('copy_tree(%d, %d): Adjusting step to %d',
+                              src_inode.id, target_inode.id, step)
+                    llfuse.lock.yield_()
                     
-                    if db.has_val('SELECT 1 FROM contents WHERE parent_inode=?', (id_,)):
-                        queue.append((id_, id_new, 0))
-                else:
-                    id_new = id_cache[id_]
-                    self.inodes[id_new].refcount += 1
-    
-                db.execute('INSERT INTO contents (name_id, inode, parent_inode) VALUES(?, ?, ?)',
-                           (name_id, id_new, target_id))
-                db.execute('UPDATE names SET refcount=refcount+1 WHERE id=?', (name_id,))
+                level += 1
                 
-                processed += 1
-                
-                if processed > gil_step:
-                    log.debug('copy_tree(%d, %d): Requeueing (%d, %d, %d) to yield lock', 
-                              src_inode.id, target_inode.id, src_id, target_id, rowid)
-                    queue.append((src_id, target_id, rowid))
-                    break
-            
-            if processed > gil_step:
-                dt = time.time() - stamp
-                gil_step = max(int(gil_step * GIL_RELEASE_INTERVAL / dt), 1)
-                log.debug('copy_tree(%d, %d): Adjusting gil_step to %d', 
-                          src_inode.id, target_inode.id, gil_step) 
-                processed = 0
-                llfuse.lock.yield_()
-                stamp = time.time()
+        finally:
+            for name in t.itervalues():
+                db.execute('DROP TABLE %s' % name)
 
         # Make replication visible
         self.db.execute('UPDATE contents SET parent_inode=? WHERE parent_inode=?',
                         (target_inode.id, tmp.id))
+        self.dentries.clear()
         del self.inodes[tmp.id]
         llfuse.invalidate_inode(target_inode.id)
         
+        # The kernel may have cached the non-existence of the new entries
+        names = [ name for (name,) in 
+                  db.query('SELECT name FROM contents JOIN names ON names.id = name_id '
+                           'WHERE parent_inode=?', (target_inode.id,)) ]
+        for name in names:
+            llfuse.invalidate_entry(target_inode.id, name)
+        
         log.debug('copy_tree(%d, %d): end', src_inode.id, target_inode.id)
 
+    def _copy_batch(self, t, lo, hi):
+        '''Copy entries *lo+1* to *hi* of the current level
+        
+        *t* maps the names of the temporary tables used by `copy_tree` to
+        their actual names.
+        '''
+        
+        db = self.db
+        
+        # The source may have changed while we released the lock, so
+        # we look up the current entries.
+        db.execute('DELETE FROM %(batch)s' % t)
+        db.execute('INSERT INTO %(batch)s (name_id, src, target_p, target) '
+                   'SELECT e.name_id, c.inode, e.target_p, m.target '
+                   'FROM %(entries)s AS e JOIN contents AS c '
+                   '  ON c.parent_inode = e.src_p AND c.name_id = e.name_id '
+                   'LEFT JOIN %(map)s AS m ON m.src = c.inode '
+                   'WHERE e.seq > ? AND e.seq <= ?' % t, (lo, hi))
+        
+        # Inodes that have not yet been copied
+        self.inodes.flush()
+        db.execute('DELETE FROM %(new)s' % t)
+        db.execute('INSERT INTO %(new)s (src) SELECT DISTINCT src FROM %(batch)s '
+                   'WHERE target IS NULL' % t)
+        self._assign_inode_ids(t['new'])
+        
+        db.execute('INSERT INTO inodes (id, uid, gid, mode, mtime, atime, ctime, '
+                   '                    refcount, size, rdev, block_id) '
+                   'SELECT n.target, uid, gid, mode, mtime, atime, ctime, '
+                   '       0, size, rdev, block_id '
+                   'FROM %(new)s AS n JOIN inodes ON inodes.id = n.src' % t)
+        db.execute('INSERT INTO %(map)s (src, target) '
+                   'SELECT n.src, n.target FROM %(new)s AS n JOIN inodes ON inodes.id = n.src '
+                   'WHERE inodes.refcount > 1' % t)
+        db.execute('UPDATE %(batch)s SET target = (SELECT target FROM %(new)s AS n '
+                   '                                WHERE n.src = %(batch)s.src) '
+                   'WHERE target IS NULL' % t)
+        
+        db.execute('INSERT INTO symlink_targets (inode, target) '
+                   'SELECT n.target, s.target FROM %(new)s AS n '
+                   'JOIN symlink_targets AS s ON s.inode = n.src' % t)
+        db.execute('INSERT INTO inode_blocks (inode, blockno, block_id) '
+                   'SELECT n.target, b.blockno, b.block_id FROM %(new)s AS n '
+                   'JOIN inode_blocks AS b ON b.inode = n.src' % t)
+        self._add_refcounts(t, 'blocks',
+                            'SELECT block_id, COUNT(*) FROM %(new)s AS n '
+                            'JOIN inode_blocks_v AS b ON b.inode = n.target '
+                            'GROUP BY block_id' % t)
+        
+        db.execute('INSERT INTO contents (name_id, inode, parent_inode) '
+                   'SELECT name_id, target, target_p FROM %(batch)s' % t)
+        self._add_refcounts(t, 'names', 'SELECT name_id, COUNT(*) FROM %(batch)s '
+                            'GROUP BY name_id' % t)
+        self._add_refcounts(t, 'inodes', 'SELECT target, COUNT(*) FROM %(batch)s '
+                            'GROUP BY target' % t)
+        
+        # Directories for the next level
+        db.execute('INSERT INTO %(dirs)s (src, target) SELECT src, target FROM %(new)s AS n '
+                   'WHERE EXISTS (SELECT 1 FROM contents WHERE parent_inode = n.src)' % t)
+
+    def _add_refcounts(self, t, table, query):
+        '''Increase reference counts in *table*
+        
+        *query* has to return the ids of the rows that are to be updated,
+        together with the increment.
+        '''
+        
+        self.db.execute('DELETE FROM %(refs)s' % t)
+        self.db.execute('INSERT INTO %s (id, count) %s' % (t['refs'], query))
+        self.db.execute('UPDATE %(table)s SET refcount = refcount + '
+                        '(SELECT count FROM %(refs)s WHERE %(refs)s.id = %(table)s.id) '
+                        'WHERE id IN (SELECT id FROM %(refs)s)'
+                        % { 'table': table, 'refs': t['refs'] })
+        
+    def _assign_inode_ids(self, table):
+        '''Assign unused inode numbers to the rows in *table*
+        
+        The numbers are stored in the *target* column.
+        '''
+        
+        db = self.db
+        if not inode_cache.RANDOMIZE_INODES:
+            first = db.get_val('SELECT MIN(seq) FROM %s' % table)
+            if first is not None:
+                db.execute('UPDATE %s SET target = seq + ?' % table,
+                           (db.get_val('SELECT MAX(id) FROM inodes') - first + 1,))
+            return
+        
+        # See InodeCache.create_inode
+        for (seq,) in list(db.query('SELECT seq FROM %s' % table)):
+            for _ in range(100):
+                id_ = randint(0, 2 ** 32 - 1)
+                if not (db.has_val('SELECT 1 FROM inodes WHERE id=?', (id_,)) or
+                        db.has_val('SELECT 1 FROM %s WHERE target=?' % table, (id_,))):
+                    break
+            else:
+                log.warn('Could not find a free inode')
+                raise FUSEError(errno.ENOSPC)
+            db.execute('UPDATE %s SET target=? WHERE seq=?' % table, (id_, seq))
+
     def unlink(self, id_p, name):
-        inode = self.lookup(id_p, name)
+        inode = self._lookup(id_p, name)
 
         if stat.S_ISDIR(inode.mode):
             raise llfuse.FUSEError(errno.EISDIR)
@@ -429,7 +705,7 @@ class Operations(llfuse.Operations):
         self._remove(id_p, name, inode.id)
 
     def rmdir(self, id_p, name):
-        inode = self.lookup(id_p, name)
+        inode = self._lookup(id_p, name)
 
         if self.inodes[id_p].locked:
             raise FUSEError(errno.EPERM)
@@ -463,6 +739,7 @@ class Operations(llfuse.Operations):
         name_id = self._del_name(name)
         self.db.execute("DELETE FROM contents WHERE name_id=? AND parent_inode=?",
                         (name_id, id_p))
+        self.dentries.invalidate(id_p, name)
         
         inode = self.inodes[id_]
         inode.refcount -= 1
@@ -478,6 +755,7 @@ class Operations(llfuse.Operations):
             # get created at this point and we can safely delete the inode
             self.db.execute('DELETE FROM ext_attributes WHERE inode=?', (id_,))
             self.db.execute('DELETE FROM symlink_targets WHERE inode=?', (id_,))
+            self.cache.unpin((id_,))
             del self.inodes[id_]
 
     def symlink(self, id_p, name, target, ctx):
@@ -507,10 +785,10 @@ class Operations(llfuse.Operations):
             or self.inodes[id_p_new].locked):
             raise FUSEError(errno.EPERM) 
             
-        inode_old = self.lookup(id_p_old, name_old)
+        inode_old = self._lookup(id_p_old, name_old)
 
         try:
-            inode_new = self.lookup(id_p_new, name_new)
+            inode_new = self._lookup(id_p_new, name_new)
         except llfuse.FUSEError as exc:
             if exc.errno != errno.ENOENT:
                 raise
@@ -567,6 +845,8 @@ class Operations(llfuse.Operations):
         self.db.execute("UPDATE contents SET name_id=?, parent_inode=? WHERE name_id=? "
                         "AND parent_inode=?", (name_id_new, id_p_new,
                                                name_id_old, id_p_old))
+        self.dentries.invalidate(id_p_old, name_old)
+        self.dentries.invalidate(id_p_new, name_new)
 
         inode_p_old = self.inodes[id_p_old]
         inode_p_new = self.inodes[id_p_new]
@@ -595,6 +875,8 @@ class Operations(llfuse.Operations):
         name_id_old = self._del_name(name_old)          
         self.db.execute('DELETE FROM contents WHERE name_id=? AND parent_inode=?',
                         (name_id_old, id_p_old))
+        self.dentries.invalidate(id_p_old, name_old)
+        self.dentries.invalidate(id_p_new, name_new)
 
         inode_new = self.inodes[id_new]
         inode_new.refcount -= 1
@@ -615,6 +897,7 @@ class Operations(llfuse.Operations):
             # get created at this point and we can safely delete the inode
             self.db.execute('DELETE FROM ext_attributes WHERE inode=?', (id_new,))
             self.db.execute('DELETE FROM symlink_targets WHERE inode=?', (id_new,))
+            self.cache.unpin((id_new,))
             del self.inodes[id_new]
 
 
@@ -640,6 +923,7 @@ class Operations(llfuse.Operations):
 
         self.db.execute("INSERT INTO contents (name_id, inode, parent_inode) VALUES(?,?,?)",
                         (self._add_name(new_name), id_, new_id_p))
+        self.dentries.invalidate(new_id_p, new_name)
         inode = self.inodes[id_]
         inode.refcount += 1
         inode.ctime = timestamp
@@ -725,21 +1009,26 @@ class Operations(llfuse.Operations):
         self.inodes.flush()
         
         entries = self.db.get_val("SELECT COUNT(rowid) FROM contents")
-        blocks = self.db.get_val("SELECT COUNT(id) FROM objects")
+        blocks = self.db.get_val("SELECT COUNT(id) FROM blocks")
         inodes = self.db.get_val("SELECT COUNT(id) FROM inodes")
         fs_size = self.db.get_val('SELECT SUM(size) FROM inodes') or 0
         dedup_size = self.db.get_val('SELECT SUM(size) FROM blocks') or 0
         compr_size = self.db.get_val('SELECT SUM(compr_size) FROM objects') or 0
 
-        return struct.pack('QQQQQQQ', entries, blocks, inodes, fs_size, dedup_size,
-                           compr_size, self.db.get_size())
+        up = self.cache.upload_control
+        down = self.cache.download_control
+
+        return struct.pack('QQQQQQQQQQQQQQ', entries, blocks, inodes, fs_size, dedup_size,
+                           compr_size, self.db.get_size(), up.slots, up.max_limit,
+                           down.slots, down.max_limit, len(self.cache.pinned),
+                           self.cache.pinned_size, self.cache.max_pinned)
 
 
     def statfs(self):
         stat_ = llfuse.StatvfsData
 
         # Get number of blocks & inodes
-        blocks = self.db.get_val("SELECT COUNT(id) FROM objects")
+        blocks = self.db.get_val("SELECT COUNT(id) FROM blocks")
         inodes = self.db.get_val("SELECT COUNT(id) FROM inodes")
         size = self.db.get_val('SELECT SUM(size) FROM blocks')
 
@@ -823,6 +1112,7 @@ class Operations(llfuse.Operations):
 
         self.db.execute("INSERT INTO contents(name_id, inode, parent_inode) VALUES(?,?,?)",
                         (self._add_name(name), inode.id, id_p))
+        self.dentries.add(id_p, name, inode.id)
 
         return inode
 
@@ -834,7 +1124,6 @@ class Operations(llfuse.Operations):
         
         This method releases the global lock while it is running.
         '''
-        buf = StringIO()
         inode = self.inodes[fh]
 
         # Make sure that we don't read beyond the file size. This
@@ -842,10 +1131,24 @@ class Operations(llfuse.Operations):
         # cheap and nice for testing.
         size = inode.size
         length = min(size - offset, length)
+        
+        if length > 0:
+            # If the request spans several blocks, let the download threads
+            # retrieve the remaining blocks while we wait for the first one
+            first_block = offset // self.blocksize
+            last_block = (offset + length - 1) // self.blocksize
+            if last_block > first_block:
+                self.cache.prefetch(fh, first_block + 1, last_block + 1)
+                
+            self._readahead(fh, offset, length, size)
 
+        # Most requests do not cross a block boundary, in that case
+        # the buffer returned by _read() can be passed on directly
+        # without copying.
+        bufs = []
         while length > 0:
             tmp = self._read(fh, offset, length)
-            buf.write(tmp)
+            bufs.append(tmp)
             length -= len(tmp)
             offset += len(tmp)
 
@@ -855,8 +1158,37 @@ class Operations(llfuse.Operations):
         if inode.atime < inode.ctime or inode.atime < inode.mtime:
             inode.atime = time.time()
 
-        return buf.getvalue()
+        if len(bufs) == 1:
+            return bufs[0]
+        return b''.join(bufs)
 
+    def _readahead(self, id_, offset, length, size):
+        '''Prefetch blocks ahead of a sequential reader
+        
+        If the read request at *offset* continues where the previous read of
+        *id_* ended, the read-ahead window is doubled (up to
+        `BlockCache.max_readahead` blocks) and the blocks following the
+        requested range are scheduled for download. Non-sequential reads reset
+        the window.
+        '''
+        
+        max_window = self.cache.max_readahead
+        if not max_window:
+            return
+        
+        (next_offset, window) = self.read_state.get(id_, (0, 0))
+        if offset == next_offset:
+            window = min(max(2 * window, 1), max_window)
+        else:
+            window = 0
+        self.read_state[id_] = (offset + length, window)
+        
+        if window:
+            first_block = (offset + length - 1) // self.blocksize + 1
+            last_block = min(first_block + window, 
+                             int(math.ceil(size / self.blocksize)))
+            self.cache.prefetch(id_, first_block, last_block)
+        
     def _read(self, id_, offset, length):
         """Reads at the specified position until the end of the block
 
@@ -875,6 +1207,10 @@ class Operations(llfuse.Operations):
         if offset_rel + length > self.blocksize:
             length = self.blocksize - offset_rel
 
+        # Don't create cache entries for blocks that have never been written
+        if self.cache.is_hole(id_, blockno):
+            return b"\0" * length
+        
         try:
             with self.cache.get(id_, blockno) as fh:
                 fh.seek(offset_rel)
@@ -904,13 +1240,20 @@ class Operations(llfuse.Operations):
         
         if self.inodes[fh].locked:
             raise FUSEError(errno.EPERM)
+        
+        self.cache.throttle()
             
         total = len(buf)
         minsize = offset + total
-        while buf:
-            written = self._write(fh, offset, buf)
-            offset += written
-            buf = buf[written:]
+        
+        # If the request spans several blocks, use a memoryview so
+        # that the pieces can be passed on without copying.
+        if (offset + total - 1) // self.blocksize != offset // self.blocksize:
+            buf = memoryview(buf)
+        
+        pos = 0
+        while pos < total:
+            pos += self._write(fh, offset + pos, buf[pos:] if pos else buf)
 
         # Update file size if changed
         # Fuse does not ensure that we do not get concurrent write requests,
@@ -942,8 +1285,14 @@ class Operations(llfuse.Operations):
         if offset_rel + len(buf) > self.blocksize:
             buf = buf[:self.blocksize - offset_rel]
 
+        # If the entire block (or everything up to the end of the
+        # file) is going to be overwritten, the old contents need not
+        # be retrieved.
+        overwrite = (offset_rel == 0 and 
+                     (len(buf) == self.blocksize or offset + len(buf) >= self.inodes[id_].size))
+        
         try:
-            with self.cache.get(id_, blockno) as fh:
+            with self.cache.get(id_, blockno, overwrite) as fh:
                 fh.seek(offset_rel)
                 fh.write(buf)
                 
@@ -975,6 +1324,7 @@ class Operations(llfuse.Operations):
 
         if self.open_inodes[fh] == 0:
             del self.open_inodes[fh]
+            self.read_state.pop(fh, None)
 
             inode = self.inodes[fh]
             if inode.refcount == 0:
@@ -982,6 +1332,7 @@ class Operations(llfuse.Operations):
                                   int(math.ceil(inode.size / self.blocksize)))
                 # Since the inode is not open, it's not possible that new blocks
                 # get created at this point and we can safely delete the in
+                self.cache.unpin((fh,))
                 del self.inodes[fh]
 
 
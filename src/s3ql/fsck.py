@@ -8,6 +8,7 @@ This program can be distributed under the terms of the GNU GPLv3.
 
 from __future__ import division, print_function, absolute_import
 from .backends.common import NoSuchObject
+from .block_cache import read_index, write_index
 from .common import ROOT_INODE, CTRL_INODE, inode_for_path, sha256_fh, get_path
 from .database import NoSuchRowError
 from os.path import basename
@@ -57,6 +58,7 @@ class Fsck(object):
         self.conn.execute('CREATE INDEX tmp3 ON inodes(block_id)')
         self.conn.execute('CREATE INDEX tmp4 ON contents(inode)')
         try:
+            self.check_pinned_inodes()
             self.check_foreign_keys()
             self.check_cache()
             self.check_lof()
@@ -110,6 +112,18 @@ class Fsck(object):
                     self.log_error("Don't know how to fix this problem!")
         
         
+    def check_pinned_inodes(self):
+        '''Remove pins of inodes that no longer exist'''
+        
+        log.info('Checking pinned inodes...')
+        
+        for (inode,) in list(self.conn.query('SELECT pinned_inodes.inode FROM pinned_inodes '
+                                             'LEFT JOIN inodes ON pinned_inodes.inode = inodes.id '
+                                             'WHERE inodes.id IS NULL')):
+            self.found_errors = True
+            self.log_error('Inode %d is pinned but does not exist, removing pin', inode)
+            self.conn.execute('DELETE FROM pinned_inodes WHERE inode=?', (inode,))
+        
     def check_cache(self):
         """Commit uncommitted cache files"""
     
@@ -117,7 +131,15 @@ class Fsck(object):
         if not os.path.exists(self.cachedir):
             return
         
+        # Clean entries preserved by mount.s3ql --keep-cache do not need
+        # to be committed
+        preserved = read_index(self.cachedir, self.conn)
+        preserved_names = set('%d-%d' % key for key in preserved)
+        
         for filename in os.listdir(self.cachedir):
+            if filename in preserved_names:
+                continue
+            
             self.found_errors = True
     
             match = re.match('^(\\d+)-(\\d+)$', filename)
@@ -149,8 +171,8 @@ class Fsck(object):
                     obj_size = dest.compr_size
                 else:
                     obj_size = fh.tell()                    
-                self.conn.execute('UPDATE objects SET compr_size=? WHERE id=?', 
-                                  (obj_size, obj_id))
+                self.conn.execute('UPDATE objects SET compr_size=?, size=? WHERE id=?', 
+                                  (obj_size, size, obj_id))
     
             else:
                 self.conn.execute('UPDATE blocks SET refcount=refcount+1 WHERE id=?', (block_id,))                         
@@ -183,6 +205,11 @@ class Fsck(object):
                 fh.close()
             os.unlink(os.path.join(self.cachedir, filename))
             
+        saved = set(write_index(self.cachedir, self.conn, preserved))
+        for key in preserved:
+            if key not in saved:
+                os.unlink(os.path.join(self.cachedir, '%d-%d' % key))
+            
     
     def check_lof(self):
         """Ensure that there is a lost+found directory"""
@@ -559,7 +586,8 @@ class Fsck(object):
         """Check the list of objects.
     
         Checks that:
-        - all objects are referred in the object table
+        - all objects are referred in the object table (objects that are
+          still listed in the deleted_objects table are removed silently)
         - all objects in the object table exist
         - object has correct hash
         """
@@ -585,7 +613,8 @@ class Fsck(object):
             for (obj_id,) in self.conn.query('SELECT id FROM obj_ids '
                                              'EXCEPT SELECT id FROM objects'):
                 try:
-                    if obj_id in self.unlinked_objects:
+                    if (obj_id in self.unlinked_objects or
+                        self.conn.has_val('SELECT 1 FROM deleted_objects WHERE id=?', (obj_id,))):
                         del self.bucket['s3ql_data_%d' % obj_id]
                     else:
                         # TODO: Save the data in lost+found instead
@@ -594,6 +623,9 @@ class Fsck(object):
                         self.log_error("Deleted spurious object %d",  obj_id)               
                 except NoSuchObject:
                     pass
+                
+            # All objects that still had to be removed are gone now
+            self.conn.execute('DELETE FROM deleted_objects')
         
             self.conn.execute('CREATE TEMPORARY TABLE missing AS '
                               'SELECT id FROM objects EXCEPT SELECT id FROM obj_ids')
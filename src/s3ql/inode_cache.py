@@ -14,13 +14,14 @@ from random import randint
 import apsw
 from .database import NoSuchRowError
 
-__all__ = [ 'InodeCache', 'OutOfInodesError' ]
+__all__ = [ 'InodeCache', 'OutOfInodesError', 'ATTRIBUTES' ]
 log = logging.getLogger('inode_cache')
 
 CACHE_SIZE = 100
 ATTRIBUTES = ('mode', 'refcount', 'uid', 'gid', 'size', 'locked',
               'rdev', 'atime', 'mtime', 'ctime', 'id')
 ATTRIBUTE_STR = ', '.join(ATTRIBUTES)
+ID_INDEX = ATTRIBUTES.index('id')
 UPDATE_ATTRS = ('mode', 'refcount', 'uid', 'gid', 'size', 'locked',
               'rdev', 'atime', 'mtime', 'ctime')
 UPDATE_STR = ', '.join('%s=?' % x for x in UPDATE_ATTRS)
@@ -175,9 +176,46 @@ class InodeCache(object):
             self.attrs[id_] = inode
             return inode
 
+    def load(self, row):
+        '''Return inode for *row*, caching it if possible
+        
+        *row* contains the values of `ATTRIBUTES` as read from the
+        database. If the inode is already cached, the cached object is
+        returned instead, since it may have been modified. Otherwise the
+        inode is only added to the cache if this does not require a dirty
+        inode to be written back, so that loading the attributes of many
+        inodes at once (e.g. for `readdir`) does not cause lots of
+        database updates.
+        '''
+        
+        id_ = row[ID_INDEX]
+        try:
+            return self.attrs[id_]
+        except KeyError:
+            pass
+        
+        inode = self._from_row(row)
+        old_id = self.cached_rows[self.pos]
+        old_inode = self.attrs.get(old_id)
+        if old_inode is not None and old_inode.dirty:
+            return inode
+        
+        self.cached_rows[self.pos] = id_
+        self.pos = (self.pos + 1) % CACHE_SIZE
+        if old_inode is not None:
+            del self.attrs[old_id]
+        self.attrs[id_] = inode
+        return inode
+        
     def getattr(self, id_):
         attrs = self.db.get_row("SELECT %s FROM inodes WHERE id=? " % ATTRIBUTE_STR,
                                   (id_,))
+        return self._from_row(attrs)
+    
+    @staticmethod
+    def _from_row(attrs):
+        '''Create inode from the values of `ATTRIBUTES`'''
+        
         inode = _Inode()
 
         for (i, id_) in enumerate(ATTRIBUTES):
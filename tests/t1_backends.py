@@ -12,6 +12,7 @@ from s3ql.backends import local, s3, s3s, gs, gss, s3c
 from s3ql.backends.common import (ChecksumError, ObjectNotEncrypted, NoSuchObject, 
     BetterBucket)
 import ConfigParser
+import multiprocessing
 import os
 import stat
 import tempfile
@@ -87,6 +88,18 @@ class BackendTestsMixin(object):
         time.sleep(self.delay)
         self.assertFalse(key in self.bucket)
 
+    def test_delete_multi(self):
+        keys = [ self.newname() for _ in range(3) ]
+        for key in keys[:2]:
+            self.bucket[key] = self.newname()
+        time.sleep(self.delay)
+        
+        # Missing keys are ignored
+        self.bucket.delete_multi(keys)
+        time.sleep(self.delay)
+        for key in keys:
+            self.assertFalse(key in self.bucket)
+
     def test_clear(self):
         key1 = self.newname()
         key2 = self.newname()
@@ -270,6 +283,22 @@ class EncryptionCompressionTests(EncryptionTests):
 
     def _wrap_bucket(self):
         return BetterBucket('schlurz', 'zlib', self.plain_bucket)
+
+    def test_encode(self):
+        pool = multiprocessing.Pool(1)
+        try:
+            for (key, pool_) in (('local', None), ('pool', pool)):
+                value = self.newname() * 100
+                (meta_raw, buf, compr_size) = self.bucket.encode(key, value, { 'tag': key },
+                                                                 pool=pool_)
+                self.assertTrue(compr_size < len(value))
+                self.bucket.store_encoded(key, meta_raw, buf)
+                time.sleep(self.delay)
+                self.assertEquals(self.bucket[key], value)
+                self.assertEquals(self.bucket.lookup(key), { 'tag': key })
+        finally:
+            pool.close()
+            pool.join()
         
                 
 # Somehow important according to pyunit documentation
@@ -0,0 +1,104 @@
+'''
+t1_cache_policy.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function
+
+import unittest2 as unittest
+from s3ql.cache_policy import POLICIES, get_policy
+from _common import TestCase
+
+class CachePolicyTests(TestCase):
+
+    def evict_all(self, policy):
+        keys = []
+        while True:
+            key = policy.evict()
+            if key is None:
+                break
+            keys.append(key)
+        return keys
+
+    def test_basic(self):
+        for name in POLICIES:
+            policy = get_policy(name, 10)
+            for i in range(5):
+                policy.add(i)
+            self.assertEqual(len(policy), 5)
+            self.assertTrue(3 in policy)
+
+            policy.remove(3)
+            self.assertFalse(3 in policy)
+            policy.access(2)
+
+            keys = self.evict_all(policy)
+            self.assertEqual(sorted(keys), [0, 1, 2, 4])
+            self.assertEqual(len(policy), 0)
+            self.assertEqual(policy.evict(), None)
+
+        self.assertRaises(ValueError, get_policy, 'foo', 10)
+
+    def test_lru(self):
+        policy = get_policy('lru', 10)
+        for i in range(5):
+            policy.add(i)
+        policy.access(0)
+        policy.access(2)
+        self.assertEqual(self.evict_all(policy), [1, 3, 4, 0, 2])
+
+    def test_scan_resistance(self):
+        for name in ('2q', 'arc'):
+            policy = get_policy(name, 8)
+
+            # Establish hot set. 2Q only promotes entries that are
+            # requested again after having been evicted
+            for i in range(4):
+                policy.add(i)
+            if name == '2q':
+                self.evict_all(policy)
+                for i in range(4):
+                    policy.add(i)
+            for i in range(4):
+                policy.access(i)
+
+            # Sequential scan, evicting whenever we exceed capacity
+            for i in range(100, 140):
+                policy.add(i)
+                while len(policy) > 8:
+                    self.assertFalse(policy.evict() in range(4))
+
+            for i in range(4):
+                self.assertTrue(i in policy)
+
+    def test_2q_ghost(self):
+        policy = get_policy('2q', 8)
+        for i in range(4):
+            policy.add(i)
+
+        # 0 is evicted from a1in, but remembered
+        self.assertEqual(policy.evict(), 0)
+        policy.add(0)
+        self.assertTrue(0 in policy.am)
+
+    def test_arc_adapt(self):
+        policy = get_policy('arc', 8)
+        for i in range(4):
+            policy.add(i)
+        self.assertEqual(policy.evict(), 0)
+        self.assertEqual(policy.p, 0)
+
+        # Hit in b1 increases target size of t1
+        policy.add(0)
+        self.assertTrue(policy.p > 0)
+        self.assertTrue(0 in policy.t2)
+
+
+def suite():
+    return unittest.makeSuite(CachePolicyTests)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+'''
+t1_cache_stats.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function
+
+from _common import TestCase
+from s3ql.cache_stats import CacheStats, Histogram, percentile, HIST_BUCKETS
+import unittest2 as unittest
+
+class CacheStatsTests(TestCase):
+
+    def test_histogram(self):
+        hist = Histogram()
+        for val in (0.0005, 0.001, 0.0015, 0.003, 0.003, 1e6):
+            hist.add(val)
+
+        snap = hist.snapshot()
+        self.assertEqual(snap['buckets'][:3], [ 2, 1, 2 ])
+        self.assertEqual(snap['buckets'][-1], 1)
+        self.assertEqual(snap['count'], 6)
+        self.assertEqual(snap['max'], 1e6)
+        self.assertEqual(len(snap['buckets']), HIST_BUCKETS)
+
+        self.assertEqual(percentile(snap, 0.3), 0.001)
+        self.assertEqual(percentile(snap, 0.5), 0.002)
+        self.assertEqual(percentile(snap, 0.8), 0.004)
+        self.assertEqual(percentile(snap, 1), 1e6)
+        self.assertEqual(percentile(Histogram().snapshot(), 0.5), None)
+
+    def test_stats(self):
+        stats = CacheStats()
+        stats.count('get.clean')
+        stats.count('get.clean')
+        stats.count('bytes.downloaded', 42)
+        stats.record('latency.wait', 0.5)
+
+        snap = stats.snapshot()
+        self.assertEqual(snap['counters'], { 'get.clean': 2, 'bytes.downloaded': 42 })
+        self.assertEqual(snap['histograms']['latency.wait']['count'], 1)
+
+        # Snapshots are not affected by later changes
+        stats.count('get.clean')
+        self.assertEqual(snap['counters']['get.clean'], 2)
+
+        stats.reset()
+        self.assertEqual(stats.snapshot(), { 'counters': {}, 'histograms': {} })
+
+
+def suite():
+    return unittest.makeSuite(CacheStatsTests)
+
+if __name__ == "__main__":
+    unittest.main()
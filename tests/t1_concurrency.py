@@ -0,0 +1,125 @@
+'''
+t1_concurrency.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function
+
+from _common import TestCase
+from s3ql import common
+from s3ql.concurrency import AIMDController
+import unittest2 as unittest
+
+class Bucket(object):
+    '''Fails the first *failures* calls of `store`'''
+
+    def __init__(self, failures):
+        self.failures = failures
+
+    def _retry_on(self, exc):
+        return isinstance(exc, RuntimeError)
+
+    @common.retry
+    def store(self):
+        '''Store something'''
+
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError()
+
+class ConcurrencyTests(TestCase):
+
+    def run_transfers(self, ctrl, count):
+        '''Run *count* rounds of transfers using all slots'''
+
+        for _ in range(count):
+            cms = [ ctrl() for _ in range(ctrl.slots) ]
+            for cm in cms:
+                cm.__enter__().size = 1024
+            self.assertEqual(ctrl.active, len(cms))
+            for cm in cms:
+                cm.__exit__(None, None, None)
+
+    def test_increase(self):
+        ctrl = AIMDController(1, 4, limit=1)
+        self.assertEqual(ctrl.slots, 1)
+
+        history = list()
+        for _ in range(20):
+            self.run_transfers(ctrl, 1)
+            history.append(ctrl.slots)
+        self.assertEqual(history[:2], [ 2, 2 ])
+        self.assertEqual(history[-1], 4)
+        self.assertEqual(sorted(history), history)
+        self.assertEqual(ctrl.active, 0)
+        self.assertEqual(ctrl.errors, 0)
+        self.assertEqual(ctrl.requests, sum([1] + history[:-1]))
+
+    def test_error(self):
+        ctrl = AIMDController(2, 16, limit=16)
+        self.run_transfers(ctrl, 1)
+
+        def fail():
+            with ctrl():
+                raise RuntimeError()
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(ctrl.slots, 8)
+        self.assertEqual(ctrl.active, 0)
+
+        # No further decrease until a complete round has finished
+        self.assertRaises(RuntimeError, fail)
+        self.assertEqual(ctrl.slots, 8)
+
+        for _ in range(4):
+            self.run_transfers(ctrl, 1)
+            self.assertRaises(RuntimeError, fail)
+        self.assertEqual(ctrl.slots, 2)
+        self.assertEqual(ctrl.errors, 6)
+
+    def test_retry(self):
+        ctrl = AIMDController(1, 8, limit=8)
+        self.run_transfers(ctrl, 1)
+
+        with ctrl():
+            Bucket(failures=0).store()
+        self.assertEqual(ctrl.slots, 8)
+
+        retries = common.get_retry_count()
+        with ctrl():
+            Bucket(failures=1).store()
+        self.assertEqual(common.get_retry_count(), retries + 1)
+        self.assertEqual(ctrl.slots, 4)
+        self.assertEqual(ctrl.errors, 1)
+
+    def test_slow(self):
+        ctrl = AIMDController(1, 8, limit=8)
+        self.run_transfers(ctrl, 1)
+        ctrl.throughput = 1024**2
+        
+        # Large transfers are not slow just because they take long
+        ctrl.active += 1
+        ctrl._completed(5, 10 * 1024**2, False, False)
+        self.assertEqual(ctrl.slots, 8)
+        self.assertEqual(ctrl.errors, 0)
+        
+        ctrl.active += 1
+        ctrl._completed(5, 100 * 1024, False, False)
+        self.assertEqual(ctrl.slots, 4)
+        self.assertEqual(ctrl.errors, 1)
+        self.assertEqual(ctrl.active, 0)
+        
+    def test_limits(self):
+        self.assertRaises(ValueError, AIMDController, 0, 4)
+        self.assertRaises(ValueError, AIMDController, 5, 4)
+        self.assertEqual(AIMDController(1, 8).slots, 4)
+        self.assertEqual(AIMDController(3, 4).slots, 3)
+
+
+def suite():
+    return unittest.makeSuite(ConcurrencyTests)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+'''
+t1_dentry_cache.py - this file is part of S3QL (http://s3ql.googlecode.com)
+
+Copyright (C) 2011 Nikolaus Rath <Nikolaus@rath.org>
+
+This program can be distributed under the terms of the GNU GPLv3.
+'''
+
+from __future__ import division, print_function
+
+from _common import TestCase
+from s3ql.dentry_cache import DentryCache
+import unittest2 as unittest
+
+class DentryCacheTests(TestCase):
+
+    def test_get(self):
+        cache = DentryCache(max_size=10)
+        self.assertRaises(KeyError, cache.get, 1, 'foo')
+
+        cache.add(1, 'foo', 42)
+        cache.add(1, 'bar', None)
+        self.assertEqual(cache.get(1, 'foo'), 42)
+        self.assertIs(cache.get(1, 'bar'), None)
+        self.assertRaises(KeyError, cache.get, 2, 'foo')
+
+        cache.add(1, 'bar', 43)
+        self.assertEqual(cache.get(1, 'bar'), 43)
+        cache.invalidate(1, 'bar')
+        cache.invalidate(1, 'bar')
+        self.assertRaises(KeyError, cache.get, 1, 'bar')
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_expire(self):
+        cache = DentryCache(max_size=3)
+        for i in range(3):
+            cache.add(1, 'name_%d' % i, i)
+
+        # Least recently used entry is evicted first
+        cache.get(1, 'name_0')
+        cache.add(1, 'name_3', 3)
+        self.assertEqual(len(cache), 3)
+        self.assertRaises(KeyError, cache.get, 1, 'name_1')
+        self.assertEqual(cache.get(1, 'name_0'), 0)
+
+
+def suite():
+    return unittest.makeSuite(DentryCacheTests)
+
+if __name__ == "__main__":
+    unittest.main()
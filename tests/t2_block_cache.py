@@ -10,12 +10,14 @@ from __future__ import division, print_function
 from _common import TestCase
 from contextlib import contextmanager
 from s3ql.backends import local
-from s3ql.backends.common import BucketPool, AbstractBucket
-from s3ql.block_cache import BlockCache
+from s3ql.backends.common import BucketPool, AbstractBucket, BetterBucket
+from s3ql.block_cache import BlockCache, INDEX_NAME, init_worker
 from s3ql.common import create_tables, init_tables
 from s3ql.database import Connection
 import llfuse
+import multiprocessing
 import os
+import s3ql.block_cache
 import shutil
 import stat
 import tempfile
@@ -47,8 +49,10 @@ class cache_tests(TestCase):
                          | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH,
                          os.getuid(), os.getgid(), time.time(), time.time(), time.time(), 1, 32))
 
+        # Most tests count the uploaded objects, so packing is only
+        # enabled by the tests that are concerned with it
         self.cache = BlockCache(self.bucket_pool, self.db, self.cachedir,
-                                self.blocksize * 100)
+                                self.blocksize * 100, pack_threshold=0)
         
         # Tested methods assume that they are called from
         # file system request handler
@@ -90,6 +94,475 @@ class cache_tests(TestCase):
             self.assertEqual(data, fh.read(len(data)))
 
 
+    def test_process_pool(self):
+        inode = self.inode
+        blockno = 11
+        data = b'compressible' * 50
+        
+        self.cache.bucket_pool = BucketPool(
+            lambda: BetterBucket('passphrase', 'zlib', local.Bucket(self.bucket_dir, None, None)))
+        self.cache.process_pool = multiprocessing.Pool(1, init_worker)
+        
+        with self.cache.get(inode, blockno) as fh:
+            fh.write(data)
+        commit(self.cache, inode)
+        (size, compr_size) = self.db.get_row('SELECT size, compr_size FROM objects')
+        self.assertEqual(size, len(data))
+        self.assertTrue(0 < compr_size < size)
+        
+        self.cache.clear()
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            self.assertEqual(data, fh.read(len(data)))
+        
+    def test_prefetch(self):
+        inode = self.inode
+        blockno = 3
+        data = self.random_data(int(0.5 * self.blocksize))
+        
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            fh.write(data)
+        self.cache.clear()
+        
+        # Holes are not prefetched
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache._do_prefetch(inode, blockno + 1)
+        self.cache.bucket_pool.verify()
+        self.assertTrue((inode, blockno + 1) not in self.cache.entries)
+        
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_read=1)
+        self.cache._do_prefetch(inode, blockno)
+        self.cache.bucket_pool.verify()
+        self.assertTrue((inode, blockno) in self.cache.entries)
+        
+        # Now it must not be downloaded again
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache._do_prefetch(inode, blockno)
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            self.assertEqual(data, fh.read(len(data)))
+        self.cache.bucket_pool.verify()
+        
+    def test_keep_cache(self):
+        inode = self.inode
+        data1 = self.random_data(int(0.5 * self.blocksize))
+        data2 = self.random_data(int(0.5 * self.blocksize))
+        
+        for (blockno, data) in ((1, data1), (2, data2)):
+            with self.cache.get(inode, blockno) as fh:
+                fh.seek(0)
+                fh.write(data)
+                
+        self.cache.keep_cache = True
+        self.cache.destroy()
+        self.assertTrue(os.path.exists(os.path.join(self.cachedir, INDEX_NAME)))
+        
+        # Block 2 is changed while not mounted
+        self.db.execute('DELETE FROM inode_blocks WHERE inode=? AND blockno=?', (inode, 2))
+        
+        self.cache = BlockCache(self.bucket_pool, self.db, self.cachedir,
+                                self.blocksize * 100, pack_threshold=0)
+        self.assertFalse(os.path.exists(os.path.join(self.cachedir, INDEX_NAME)))
+        self.assertTrue((inode, 1) in self.cache.entries)
+        self.assertTrue((inode, 2) not in self.cache.entries)
+        self.assertFalse(os.path.exists(os.path.join(self.cachedir, '%d-2' % inode)))
+        
+        # Must not be downloaded again
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        with self.cache.get(inode, 1) as fh:
+            fh.seek(0)
+            self.assertEqual(data1, fh.read(len(data1)))
+        self.cache.bucket_pool.verify()
+        
+    def test_shared(self):
+        inode = self.inode
+        inode2 = inode + 1
+        blockno = 3
+        data = self.random_data(int(0.5 * self.blocksize))
+        
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            fh.write(data)
+        commit(self.cache, inode)
+        
+        # Let another inode refer to the same block (like s3qlcp does)
+        block_id = self.db.get_val('SELECT block_id FROM inode_blocks_v '
+                                   'WHERE inode=? AND blockno=?', (inode, blockno))
+        for i in (inode2, inode2 + 1):
+            self.db.execute('INSERT INTO inode_blocks (inode, blockno, block_id) VALUES(?,?,?)',
+                            (i, blockno, block_id))
+            self.db.execute('UPDATE blocks SET refcount=refcount+1 WHERE id=?', (block_id,))
+        
+        # Must not be downloaded and must not use additional space
+        size = self.cache.size
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        with self.cache.get(inode2, blockno) as fh:
+            fh.seek(0)
+            self.assertEqual(data, fh.read(len(data)))
+        self.cache.bucket_pool.verify()
+        self.assertEqual(self.cache.size, size)
+        self.assertEqual(os.stat(os.path.join(self.cachedir, '%d-%d' % (inode, blockno))).st_nlink, 2)
+        
+        # Removing a shared entry does not free space
+        with self.cache.get(inode2 + 1, blockno) as fh:
+            pass
+        self.cache.remove(inode2 + 1, blockno)
+        self.assertEqual(self.cache.size, size)
+        
+        # Writing must not affect the other entry
+        with self.cache.get(inode2, blockno) as fh:
+            fh.seek(0)
+            fh.write(b'foobar')
+        self.assertEqual(self.cache.size, size + len(data))
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            self.assertEqual(data, fh.read(len(data)))
+
+        self.cache.remove(inode, blockno)
+        self.assertEqual(self.cache.size, len(data))
+        
+    def test_hash_unlocked(self):
+        inode = self.inode
+        with self.cache.get(inode, 1) as fh:
+            fh.write(b'foobar')
+            el = fh
+            
+        # Other threads must be able to acquire the lock while
+        # the block is hashed
+        acquired = []
+        def acquire():
+            with llfuse.lock:
+                acquired.append(True)
+        def sha256_fh(fh):
+            t = threading.Thread(target=acquire)
+            t.start()
+            t.join(5)
+            return orig_sha256_fh(fh)
+        
+        orig_sha256_fh = s3ql.block_cache.sha256_fh
+        s3ql.block_cache.sha256_fh = sha256_fh
+        try:
+            self.cache.upload(el)
+        finally:
+            s3ql.block_cache.sha256_fh = orig_sha256_fh
+        self.assertEqual(acquired, [True])
+        self.assertFalse(el.dirty)
+        
+    def test_dirty_entries(self):
+        inode = self.inode
+        with self.cache.get(inode, 1) as fh:
+            fh.write(b'foobar')
+        with self.cache.get(inode, 2) as fh:
+            pass
+        
+        self.assertTrue((inode, 1) in self.cache.dirty_entries)
+        self.assertFalse((inode, 1) in self.cache.policy)
+        self.assertTrue((inode, 2) in self.cache.policy)
+        
+        commit(self.cache, inode)
+        self.assertFalse((inode, 1) in self.cache.dirty_entries)
+        self.assertTrue((inode, 1) in self.cache.policy)
+        
+        # Clean entries are evicted without uploading anything
+        with self.cache.get(inode, 3) as fh:
+            fh.write(b'foobar')
+        self.cache.max_entries = 1
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache.expire()
+        self.cache.bucket_pool.verify()
+        self.assertEqual(list(self.cache.entries), [(inode, 3)])
+        
+    def test_throttle(self):
+        inode = self.inode
+        self.cache.max_dirty = 4 * self.blocksize
+        self.cache.dirty_thresh = 2 * self.blocksize
+        
+        for i in range(5):
+            with self.cache.get(inode, i) as fh:
+                fh.write(self.random_data(self.blocksize))
+        self.assertEqual(self.cache.dirty_size, 5 * self.blocksize)
+        
+        # Oldest blocks must be uploaded until we are below the threshold
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=3)
+        self.cache.throttle()
+        self.cache.bucket_pool.verify()
+        self.assertEqual(self.cache.dirty_size, 2 * self.blocksize)
+        for i in range(3):
+            self.assertFalse(self.cache.entries[(inode, i)].dirty)
+        
+        # Below threshold, nothing happens
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache.throttle()
+        self.cache.bucket_pool.verify()
+        
+        self.cache.remove(inode, 4)
+        self.assertEqual(self.cache.dirty_size, self.blocksize)
+        
+    def test_open_files(self):
+        inode = self.inode
+        self.cache.max_open = 3
+        
+        for i in range(10):
+            with self.cache.get(inode, i) as fh:
+                fh.write(('%d' % i) * 10)
+        self.assertEqual(len([ el for el in self.cache.entries.itervalues() 
+                               if el.is_open() ]), 3)
+        
+        # Closed files must be reopened transparently
+        for i in range(10):
+            with self.cache.get(inode, i) as fh:
+                fh.seek(5)
+                self.assertEqual(fh.read(5), ('%d' % i) * 5)
+        commit(self.cache, inode)
+        self.assertTrue(len(self.cache.open_entries) <= 3)
+        
+    def test_zero_block(self):
+        inode = self.inode
+        blockno = 2
+        
+        # New all-zero block is not uploaded
+        with self.cache.get(inode, blockno) as fh:
+            fh.write(b'\0' * self.blocksize)
+            el = fh
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache.upload(el)
+        self.cache.bucket_pool.verify()
+        self.assertFalse(el.dirty)
+        self.cache.bucket_pool = self.bucket_pool
+        self.assertTrue(self.cache.is_hole(inode, blockno + 1))
+        self.assertFalse(self.cache.is_hole(inode, blockno))
+        self.cache.clear()
+        self.assertTrue(self.cache.is_hole(inode, blockno))
+        self.assertEqual(self.cache.get_stats()['counters']['get.hole'], 2)
+        
+        # Existing block is removed when overwritten with zeros
+        with self.cache.get(inode, blockno) as fh:
+            fh.write(self.random_data(self.blocksize))
+        commit(self.cache, inode)
+        self.assertFalse(self.cache.is_hole(inode, blockno))
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            fh.write(b'\0' * self.blocksize)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_del=1)
+        commit(self.cache, inode)
+        self.cache.bucket_pool.verify()
+        self.cache.clear()
+        self.assertTrue(self.cache.is_hole(inode, blockno))
+        self.assertEqual(self.db.get_val('SELECT COUNT(*) FROM blocks'), 0)
+        
+    def test_upload_due(self):
+        inode = self.inode
+        self.cache.writeback_delay = 0.4
+        self.cache.max_dirty_age = 1
+        
+        with self.cache.get(inode, 0) as fh:
+            fh.write(self.random_data(self.blocksize))
+            el = fh
+        self.assertTrue(self.cache.upload_due() > time.time())
+        self.assertTrue(el.dirty)
+        
+        # Modification postpones the upload
+        time.sleep(0.3)
+        with self.cache.get(inode, 0) as fh:
+            fh.write(self.random_data(self.blocksize))
+        time.sleep(0.2)
+        self.cache.upload_due()
+        self.assertTrue(el.dirty)
+        
+        time.sleep(0.3)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=1)
+        self.assertTrue(self.cache.upload_due() is None)
+        self.cache.bucket_pool.verify()
+        self.assertFalse(el.dirty)
+        
+        # Entries that are modified continuously are uploaded 
+        # after max_dirty_age 
+        self.cache.bucket_pool = self.bucket_pool
+        stamp = time.time()
+        while time.time() - stamp < 2:
+            with self.cache.get(inode, 0) as fh:
+                fh.seek(0)
+                fh.write(self.random_data(self.blocksize))
+            self.cache.upload_due()
+            if not el.dirty:
+                break
+            time.sleep(0.1)
+        self.assertFalse(el.dirty)
+        self.assertTrue(time.time() - stamp >= self.cache.max_dirty_age)
+        
+    def test_upload_due_failed(self):
+        inode = self.inode
+        self.cache.writeback_delay = 0.2
+        self.cache.max_dirty_age = 0.2
+        
+        with self.cache.get(inode, 0) as fh:
+            fh.write(self.random_data(self.blocksize))
+            el = fh
+        time.sleep(0.3)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.assertRaises(RuntimeError, self.cache.upload_due)
+        self.assertTrue(el.dirty)
+        
+        # The entry must be retried later, and must not be deduplicated
+        # against the block that has not been stored
+        due = self.cache.upload_due()
+        self.assertTrue(due is not None and due > time.time())
+        time.sleep(due - time.time())
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=1, no_del=1)
+        self.assertTrue(self.cache.upload_due() is None)
+        self.cache.bucket_pool.verify()
+        self.assertFalse(el.dirty)
+        self.assertEqual(self.db.get_val('SELECT COUNT(*) FROM objects'), 1)
+        self.assertFalse(self.db.has_val('SELECT 1 FROM blocks WHERE hash IS NULL'))
+        
+    def test_pack(self):
+        inode = self.inode
+        self.cache.pack_threshold = self.blocksize
+        size = self.blocksize // 4
+        data = [ self.random_data(size) for _ in range(4) ]
+        for (blockno, buf) in enumerate(data):
+            with self.cache.get(inode, blockno) as fh:
+                fh.write(buf)
+                
+        # All blocks are stored in one object
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=1)
+        commit(self.cache, inode)
+        self.cache.bucket_pool.verify()
+        self.assertEqual(tuple(self.db.get_row('SELECT COUNT(*), SUM(refcount) FROM objects')),
+                         (1, 4))
+        self.assertEqual([ x[0] for x in self.db.query('SELECT obj_offset FROM blocks '
+                                                       'ORDER BY obj_offset') ],
+                         [ 0, size, 2*size, 3*size ])
+        
+        # Every block is extracted from the object, which is downloaded
+        # only once
+        self.cache.clear()
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_read=1)
+        for (blockno, buf) in enumerate(data):
+            with self.cache.get(inode, blockno) as fh:
+                fh.seek(0)
+                self.assertEqual(fh.read(len(buf)), buf)
+        self.cache.bucket_pool.verify()
+        self.assertEqual(self.cache.stats.counters['download.pack'], 3)
+        
+        # The decoded object is dropped when the object is removed
+        self.assertEqual(len(self.cache.packs), 1)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_del=1)
+        self.cache.remove(inode, 0, len(data))
+        self.cache.bucket_pool.verify()
+        self.assertEqual(len(self.cache.packs), 0)
+        
+    def test_pack_due(self):
+        inode = self.inode
+        self.cache.pack_threshold = self.blocksize
+        self.cache.writeback_delay = 0.25
+        size = self.blocksize // 4
+        
+        with self.cache.get(inode, 0) as fh:
+            fh.write(self.random_data(size))
+        time.sleep(0.3)
+        with self.cache.get(inode, 1) as fh:
+            fh.write(self.random_data(size))
+        
+        # Only the entry that is due is uploaded
+        slack = s3ql.block_cache.PACK_DUE_SLACK
+        s3ql.block_cache.PACK_DUE_SLACK = 0
+        try:
+            self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=1)
+            self.assertTrue(self.cache.upload_due() > time.time())
+            self.cache.bucket_pool.verify()
+        finally:
+            s3ql.block_cache.PACK_DUE_SLACK = slack
+        self.assertFalse(self.cache.entries[(inode, 0)].dirty)
+        self.assertTrue(self.cache.entries[(inode, 1)].dirty)
+        
+    def test_repack(self):
+        inode = self.inode
+        self.cache.pack_threshold = self.blocksize
+        data = [ self.random_data(self.blocksize // 4) for _ in range(4) ]
+        for (blockno, buf) in enumerate(data):
+            with self.cache.get(inode, blockno) as fh:
+                fh.write(buf)
+        commit(self.cache, inode)
+        obj_id = self.db.get_val('SELECT id FROM objects')
+        
+        # Object is still mostly used
+        self.cache.remove(inode, 0, 2)
+        self.assertEqual(self.db.get_val('SELECT id FROM objects'), obj_id)
+        
+        # Remaining block is moved into a new object
+        self.cache.remove(inode, 2)
+        (new_id, refcount) = self.db.get_row('SELECT id, refcount FROM objects')
+        self.assertNotEqual(new_id, obj_id)
+        self.assertEqual(refcount, 1)
+        self.assertEqual(tuple(self.db.get_row('SELECT obj_id, obj_offset FROM blocks')),
+                         (new_id, 0))
+        with self.bucket_pool() as bucket:
+            self.assertFalse('s3ql_data_%d' % obj_id in bucket)
+        
+        self.cache.clear()
+        with self.cache.get(inode, 3) as fh:
+            fh.seek(0)
+            self.assertEqual(fh.read(len(data[3])), data[3])
+        
+    def test_overwrite(self):
+        inode = self.inode
+        blockno = 5
+        data = self.random_data(self.blocksize)
+        
+        with self.cache.get(inode, blockno) as fh:
+            fh.write(self.random_data(self.blocksize))
+        commit(self.cache, inode)
+        self.cache.clear()
+        
+        # Failed overwrite must not leave an empty entry behind
+        try:
+            with self.cache.get(inode, blockno, overwrite=True) as fh:
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertTrue((inode, blockno) not in self.cache.entries)
+        
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        with self.cache.get(inode, blockno, overwrite=True) as fh:
+            fh.write(data)
+        self.cache.bucket_pool.verify()
+        
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=1, no_del=1)
+        commit(self.cache, inode)
+        self.cache.bucket_pool.verify()
+        
+        self.cache.clear()
+        self.cache.bucket_pool = self.bucket_pool
+        with self.cache.get(inode, blockno) as fh:
+            fh.seek(0)
+            self.assertEqual(data, fh.read(len(data)))
+        
+    def test_wait(self):
+        key1 = (self.inode, 1)
+        key2 = 42
+        self.cache._start_transit(key1)
+        self.cache._start_transit(key2)
+        
+        def end_transit():
+            time.sleep(0.1)
+            with llfuse.lock:
+                self.cache._end_transit(key2)
+        t = threading.Thread(target=end_transit)
+        t.start()
+        
+        # Must return although key1 is still in transit
+        self.cache.wait(key2)
+        self.assertTrue(key2 not in self.cache.in_transit)
+        self.assertTrue(key1 in self.cache.in_transit)
+        t.join()
+        
+        # Not in transit, must not block
+        self.cache.wait(key2)
+        self.cache._end_transit(key1)
+        self.cache.wait()
+        
     def test_expire(self):
         inode = self.inode
 
@@ -195,6 +668,210 @@ class cache_tests(TestCase):
         self.cache.clear()
         self.cache.bucket_pool.verify()     
 
+    def test_deleted_objects(self):
+        inode = self.inode
+        blockno = 1
+        
+        # Removal is recorded in the database until the object is gone
+        with self.cache.get(inode, blockno) as fh:
+            fh.write(self.random_data(self.blocksize))
+        commit(self.cache, inode)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_del=1)
+        self.cache.remove(inode, blockno)
+        self.cache.bucket_pool.verify()
+        self.assertFalse(self.db.has_val('SELECT 1 FROM deleted_objects'))
+        
+        # Objects that were pending before a crash are removed
+        # by the removal thread
+        self.cache.bucket_pool = self.bucket_pool
+        with self.bucket_pool() as bucket:
+            for id_ in (10, 11):
+                bucket['s3ql_data_%d' % id_] = b'data'
+                self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (id_,))
+        self.cache.init()
+        stamp = time.time()
+        while (time.time() - stamp < 5 
+               and self.db.has_val('SELECT 1 FROM deleted_objects')):
+            llfuse.lock.release()
+            time.sleep(0.05)
+            llfuse.lock.acquire()
+        self.assertFalse(self.db.has_val('SELECT 1 FROM deleted_objects'))
+        with self.bucket_pool() as bucket:
+            self.assertEqual(list(bucket.list('s3ql_data_')), [])
+        
+    def test_removal_threads(self):
+        # The local backend deletes one object per request, so the
+        # objects have to be removed by several threads in parallel
+        with self.bucket_pool() as bucket:
+            self.assertFalse(bucket.has_delete_multi())
+            for id_ in range(100):
+                bucket['s3ql_data_%d' % id_] = b'data'
+                self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (id_,))
+        
+        threads = set()
+        orig_delete = local.Bucket.delete
+        def delete(bucket, key, force=False):
+            threads.add(threading.current_thread())
+            time.sleep(0.01)
+            return orig_delete(bucket, key, force)
+        
+        local.Bucket.delete = delete
+        try:
+            self.cache.init()
+            stamp = time.time()
+            while (time.time() - stamp < 5 
+                   and self.db.has_val('SELECT 1 FROM deleted_objects')):
+                llfuse.lock.release()
+                time.sleep(0.05)
+                llfuse.lock.acquire()
+        finally:
+            local.Bucket.delete = orig_delete
+        self.assertFalse(self.db.has_val('SELECT 1 FROM deleted_objects'))
+        self.assertEqual(self.cache.removing, set())
+        self.assertGreater(len(threads), 1)
+        with self.bucket_pool() as bucket:
+            self.assertEqual(list(bucket.list('s3ql_data_')), [])
+        
+    def test_removal_failed(self):
+        with self.bucket_pool() as bucket:
+            for id_ in range(3):
+                bucket['s3ql_data_%d' % id_] = b'data'
+                self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (id_,))
+        
+        failures = [ 2 ]
+        orig_delete = local.Bucket.delete
+        def delete(bucket, key, force=False):
+            if failures[0]:
+                failures[0] -= 1
+                raise RuntimeError('simulated backend failure')
+            return orig_delete(bucket, key, force)
+        
+        local.Bucket.delete = delete
+        orig_delay = s3ql.block_cache.REMOVAL_RETRY_DELAY
+        s3ql.block_cache.REMOVAL_RETRY_DELAY = 0.01
+        try:
+            self.cache.init()
+            stamp = time.time()
+            while (time.time() - stamp < 5 
+                   and self.db.has_val('SELECT 1 FROM deleted_objects')):
+                llfuse.lock.release()
+                time.sleep(0.05)
+                llfuse.lock.acquire()
+        finally:
+            local.Bucket.delete = orig_delete
+            s3ql.block_cache.REMOVAL_RETRY_DELAY = orig_delay
+        self.assertEqual(failures[0], 0)
+        self.assertFalse(self.db.has_val('SELECT 1 FROM deleted_objects'))
+        self.assertTrue(all(t.is_alive() for t in self.cache.removal_threads))
+        with self.bucket_pool() as bucket:
+            self.assertEqual(list(bucket.list('s3ql_data_')), [])
+        
+    def test_prefetch_block(self):
+        inode = self.inode
+        for blockno in range(3):
+            with self.cache.get(inode, blockno) as fh:
+                fh.write(self.random_data(self.blocksize))
+        self.cache.clear()
+        
+        self.cache.init(threads=2)
+        self.assertTrue(self.cache.prefetch_block(inode, 0))
+        self.assertTrue(self.cache.prefetch_block(inode, 2))
+        self.assertFalse(self.cache.prefetch_block(inode, 2))
+        self.assertEqual(self.cache.warmup_queued, 2)
+        
+        stamp = time.time()
+        while (time.time() - stamp < 5 
+               and self.cache.warmup_done < self.cache.warmup_queued):
+            llfuse.lock.release()
+            time.sleep(0.05)
+            llfuse.lock.acquire()
+        self.assertEqual(self.cache.warmup_done, 2)
+        self.assertEqual(sorted(self.cache.entries.keys()), 
+                         [ (inode, 0), (inode, 2) ])
+        self.assertFalse(self.cache.prefetch_block(inode, 0))
+        
+    def test_pin(self):
+        inode = self.inode
+        other = self.inode + 1
+        self.db.execute("INSERT INTO inodes (id,mode,uid,gid,mtime,atime,ctime,refcount,size) "
+                        "VALUES (?,?,?,?,?,?,?,?,?)",
+                        (other, stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR, 
+                         os.getuid(), os.getgid(), time.time(), time.time(), time.time(), 1, 32))
+        
+        self.cache.pin([inode])
+        self.assertEqual(self.db.get_val('SELECT inode FROM pinned_inodes'), inode)
+        for blockno in range(2):
+            for id_ in (inode, other):
+                with self.cache.get(id_, blockno) as fh:
+                    fh.write(self.random_data(self.blocksize))
+        commit(self.cache, inode)
+        commit(self.cache, other)
+        
+        # Pinned blocks are evicted last
+        self.cache.max_size = 2 * self.blocksize
+        self.cache.expire()
+        self.assertEqual(sorted(self.cache.entries.keys()), [ (inode, 0), (inode, 1) ])
+        self.assertEqual(self.cache.pinned_size, 2 * self.blocksize)
+        
+        # ..and do not count against the cache size up to max_pinned
+        self.cache.max_size = 0
+        self.cache.max_pinned = 2 * self.blocksize
+        self.cache.expire()
+        self.assertEqual(len(self.cache.entries), 2)
+        
+        self.cache.max_pinned = self.blocksize
+        self.cache.expire()
+        self.assertEqual(len(self.cache.entries), 1)
+        self.assertEqual(self.cache.pinned_size, self.blocksize)
+        self.assertEqual(self.cache.get_stats()['counters']['evict.pinned'], 1)
+        
+        self.cache.unpin([inode])
+        self.assertFalse(self.db.has_val('SELECT 1 FROM pinned_inodes'))
+        self.assertEqual(self.cache.pinned_size, 0)
+        self.cache.pin([inode])
+        self.assertEqual(self.cache.pinned_size, self.blocksize)
+        with self.cache.get(inode, 0) as fh:
+            fh.write(b'foo')
+        self.assertEqual(self.cache.pinned_size, 0)
+        self.cache.unpin([inode])
+        self.cache.expire()
+        self.assertEqual(len(self.cache.entries), 0)
+        
+    def test_stats(self):
+        inode = self.inode
+        data = self.random_data(self.blocksize)
+        
+        with self.cache.get(inode, 0) as fh:
+            fh.write(data)
+        with self.cache.get(inode, 0) as fh:
+            pass
+        with self.cache.get(inode, 1) as fh:
+            fh.write(data)
+        commit(self.cache, inode)
+        with self.cache.get(inode, 0) as fh:
+            pass
+        self.cache.clear()
+        with self.cache.get(inode, 1) as fh:
+            fh.seek(0)
+            self.assertEqual(fh.read(len(data)), data)
+            
+        stats = self.cache.get_stats()
+        counters = stats['counters']
+        self.assertEqual(counters['get.new'], 2)
+        self.assertFalse('get.hole' in counters)
+        self.assertEqual(counters['get.dirty'], 1)
+        self.assertEqual(counters['get.clean'], 1)
+        self.assertEqual(counters['get.download'], 1)
+        self.assertEqual(counters['upload.new'], 1)
+        self.assertEqual(counters['upload.dedup'], 1)
+        self.assertEqual(counters['evict.clear'], 2)
+        self.assertEqual(counters['bytes.uploaded'], len(data))
+        self.assertEqual(counters['bytes.downloaded'], len(data))
+        self.assertEqual(stats['histograms']['latency.download']['count'], 1)
+        self.assertEqual(stats['histograms']['latency.upload']['count'], 1)
+        self.assertEqual(stats['gauges']['entries'], 1)
+        self.assertEqual(stats['gauges']['removal_queue'], 0)
+        
     def test_remove_referenced(self):
         inode = self.inode
         datalen = int(0.1 * self.cache.max_size)
@@ -267,6 +944,111 @@ class cache_tests(TestCase):
             fh.seek(0)
             self.assertTrue(fh.read(42) == '')  
 
+    def test_remove_sparse(self):
+        inode = self.inode
+        data1 = self.random_data(self.blocksize)
+        data2 = self.random_data(self.blocksize)
+        far = 10**9
+
+        for (blockno, data) in ((0, data1), (3, data1), (far, data2)):
+            with self.cache.get(inode, blockno) as fh:
+                fh.write(data)
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_write=2)
+        self.cache.clear()
+        self.cache.bucket_pool.verify()
+        
+        # Does not iterate over the entire range
+        self.cache.bucket_pool = self.bucket_pool
+        with self.cache.get(inode, far) as fh:
+            pass
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_del=1)
+        self.cache.remove(inode, 1, 2**62)
+        self.cache.bucket_pool.verify()
+        self.assertEqual([ row[0] for row in self.db.query('SELECT blockno FROM inode_blocks_v '
+                                                           'WHERE inode=?', (inode,)) ], [0])
+        self.assertEqual(self.db.get_val('SELECT refcount FROM blocks'), 1)
+        self.assertEqual(len(self.cache), 0)
+        
+        # An empty range does not remove anything
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool)
+        self.cache.remove(inode, 0, 0)
+        self.cache.bucket_pool.verify()
+        self.assertEqual([ row[0] for row in self.db.query('SELECT blockno FROM inode_blocks_v '
+                                                           'WHERE inode=?', (inode,)) ], [0])
+        self.assertEqual(self.db.get_val('SELECT refcount FROM blocks'), 1)
+        
+        self.cache.bucket_pool = TestBucketPool(self.bucket_pool, no_del=1)
+        self.cache.remove(inode, 0, 2**62)
+        self.cache.bucket_pool.verify()
+        self.assertFalse(self.db.has_val('SELECT 1 FROM blocks'))
+        self.assertFalse(self.db.has_val('SELECT 1 FROM objects'))
+
+    def test_remove_hashing(self):
+        inode = self.inode
+        with self.cache.get(inode, 1) as fh:
+            fh.write(self.random_data(self.blocksize))
+            el = fh
+        el.close()
+            
+        # Remove the entry while it is being hashed
+        def remove():
+            with llfuse.lock:
+                self.cache.remove(inode, 1)
+        def sha256_fh(fh):
+            t = threading.Thread(target=remove)
+            t.start()
+            t.join(5)
+            return orig_sha256_fh(fh)
+        
+        orig_sha256_fh = s3ql.block_cache.sha256_fh
+        s3ql.block_cache.sha256_fh = sha256_fh
+        try:
+            self.cache.upload(el)
+        finally:
+            s3ql.block_cache.sha256_fh = orig_sha256_fh
+        self.assertFalse((inode, 1) in self.cache.entries)
+        self.assertFalse(el.is_open())
+        self.assertEqual(self.cache.orphans, dict())
+        self.assertFalse(self.db.has_val('SELECT 1 FROM objects'))
+        
+    def test_remove_uploading(self):
+        inode = self.inode
+        with self.cache.get(inode, 1) as fh:
+            fh.write(self.random_data(self.blocksize))
+            el = fh
+            
+        # Remove the entry after the upload thread has started
+        # to upload it
+        bucket = self.bucket_pool.pop_conn()
+        orig_open_write = bucket.open_write
+        def remove():
+            with llfuse.lock:
+                self.cache.remove(inode, 1)
+        t = threading.Thread(target=remove)
+        def open_write(key, metadata=None):
+            t.start()
+            stamp = time.time()
+            while (inode, 1) in self.cache.entries and time.time() - stamp < 5:
+                time.sleep(0.01)
+            return orig_open_write(key, metadata)
+        bucket.open_write = open_write
+        self.bucket_pool.push_conn(bucket)
+        
+        self.cache.init(threads=1)
+        try:
+            self.cache.upload(el)
+            while self.cache.transfer_in_progress():
+                self.cache.wait()
+            with llfuse.lock_released:
+                t.join(5)
+        finally:
+            del bucket.open_write
+        self.assertTrue(self.cache.upload_threads[0].is_alive())
+        self.assertFalse((inode, 1) in self.cache.entries)
+        self.assertFalse(el.is_open())
+        self.assertEqual(self.cache.orphans, dict())
+        self.assertFalse(self.db.has_val('SELECT 1 FROM inode_blocks_v WHERE inode=?', (inode,)))
+
 class TestBucketPool(AbstractBucket):
     def __init__(self, bucket_pool, no_read=0, no_write=0, no_del=0):
         super(TestBucketPool, self).__init__()
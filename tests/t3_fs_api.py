@@ -10,13 +10,14 @@ from __future__ import division, print_function
 from _common import TestCase
 from llfuse import FUSEError
 from random import randint
-from s3ql import fs
+from s3ql import fs, inode_cache
 from s3ql.backends import local
 from s3ql.backends.common import BucketPool
 from s3ql.block_cache import BlockCache
-from s3ql.common import ROOT_INODE, create_tables, init_tables
+from s3ql.common import ROOT_INODE, CTRL_INODE, create_tables, init_tables
 from s3ql.database import Connection
 from s3ql.fsck import Fsck
+import cPickle as pickle
 import errno
 import llfuse
 import os
@@ -141,9 +142,14 @@ class fs_api_tests(TestCase):
         # Test with data in file
         fh = self.server.open(inode.id, os.O_RDWR)
         self.server.write(fh, 0, 'foobar')
+        self.server.write(fh, 2 * self.blocksize, 'foobar')
+        self.assertEqual(self.server.read(fh, self.blocksize, 6), b'\0' * 6)
         self.server.release(fh)
 
         self.server.extstat()
+        stats = pickle.loads(self.server.getxattr(CTRL_INODE, b's3qlcache'))
+        self.assertTrue(stats['counters']['get.new'] >= 2)
+        self.assertEqual(stats['counters']['get.hole'], 1)
 
         self.fsck()
 
@@ -332,6 +338,54 @@ class fs_api_tests(TestCase):
 
         self.fsck()
 
+    def test_lookup_cache(self):
+        name = self.newname()
+        
+        # Non-existing entries are returned with inode number zero
+        entry = self.server.lookup(ROOT_INODE, name)
+        self.assertEqual(entry.st_ino, 0)
+        self.assertGreater(entry.entry_timeout, 0)
+        self.assertIs(self.server.dentries.get(ROOT_INODE, name), None)
+        
+        (fh, inode) = self.server.create(ROOT_INODE, name, self.file_mode(), Ctx())
+        self.server.release(fh)
+        self.assertEqual(self.server.lookup(ROOT_INODE, name).id, inode.id)
+        
+        newname = self.newname()
+        self.assertEqual(self.server.lookup(ROOT_INODE, newname).st_ino, 0)
+        self.server.link(inode.id, ROOT_INODE, newname)
+        self.assertEqual(self.server.lookup(ROOT_INODE, newname).id, inode.id)
+        
+        self.server.rename(ROOT_INODE, newname, ROOT_INODE, name)
+        self.assertEqual(self.server.lookup(ROOT_INODE, newname).st_ino, 0)
+        self.assertEqual(self.server.lookup(ROOT_INODE, name).id, inode.id)
+        
+        self.server.unlink(ROOT_INODE, name)
+        self.assertEqual(self.server.lookup(ROOT_INODE, name).st_ino, 0)
+        with self.assertRaises(FUSEError) as cm:
+            self.server.unlink(ROOT_INODE, name)
+        self.assertEqual(cm.exception.errno, errno.ENOENT)
+        
+        # Entries created by copy_tree() are not announced to the kernel,
+        # so negative entries have to be invalidated
+        src_inode = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
+        (fh, _) = self.server.create(src_inode.id, name, self.file_mode(), Ctx())
+        self.server.release(fh)
+        dst_inode = self.server.mkdir(ROOT_INODE, 'dest', self.dir_mode(), Ctx())
+        self.assertEqual(self.server.lookup(dst_inode.id, name).st_ino, 0)
+        
+        invalidated = []
+        orig_invalidate_entry = llfuse.invalidate_entry
+        llfuse.invalidate_entry = lambda *a: invalidated.append(a)
+        try:
+            self.server.copy_tree(src_inode.id, dst_inode.id)
+        finally:
+            llfuse.invalidate_entry = orig_invalidate_entry
+        self.assertEqual(invalidated, [ (dst_inode.id, name) ])
+        self.assertNotEqual(self.server.lookup(dst_inode.id, name).st_ino, 0)
+        
+        self.fsck()
+        
     def test_replace_file(self):
         oldname = self.newname()
         newname = self.newname()
@@ -595,6 +649,56 @@ class fs_api_tests(TestCase):
 
         self.fsck()
 
+    def test_write_multiblock(self):
+        len_ = int(2.5 * self.blocksize)
+        data = self.random_data(len_)
+        off = self.blocksize // 3
+        (fh, inode) = self.server.create(ROOT_INODE, self.newname(),
+                                     self.file_mode(), Ctx())
+        self.assertEqual(self.server.write(fh, off, data), len_)
+        self.assertEqual(self.server.read(fh, off, len_), data)
+        self.assertEqual(self.server.read(fh, off + 10, 20), data[10:30])
+        self.assertEqual(self.server.read(fh, 0, off), b'\0' * off)
+        self.server.release(fh)
+
+        self.fsck()
+        
+    def test_read_sparse(self):
+        (fh, inode) = self.server.create(ROOT_INODE, self.newname(),
+                                     self.file_mode(), Ctx())
+        self.server.write(fh, 3 * self.blocksize, b'foo')
+        self.server.release(fh)
+        self.block_cache.clear()
+        
+        fh = self.server.open(inode.id, os.O_RDONLY)
+        self.assertEqual(self.server.read(fh, 0, 3 * self.blocksize), 
+                         b'\0' * (3 * self.blocksize))
+        self.assertEqual(len(self.block_cache.entries), 0)
+        self.server.release(fh)
+        
+        self.fsck()
+        
+    def test_read_multiblock(self):
+        len_ = int(3.5 * self.blocksize)
+        data = self.random_data(len_)
+        (fh, inode) = self.server.create(ROOT_INODE, self.newname(),
+                                     self.file_mode(), Ctx())
+        self.server.write(fh, 0, data)
+        self.server.release(fh)
+        self.block_cache.clear()
+        
+        # All blocks after the first one must be requested at once
+        calls = []
+        self.block_cache.prefetch = lambda *a: calls.append(a)
+        fh = self.server.open(inode.id, os.O_RDONLY)
+        self.assertEqual(self.server.read(fh, self.blocksize // 2, len_), 
+                         data[self.blocksize // 2:])
+        self.server.release(fh)
+        del self.block_cache.prefetch
+        self.assertEqual(calls[0], (inode.id, 1, 4))
+        
+        self.fsck()
+        
     def test_edit(self):
         len_ = self.blocksize
         data = self.random_data(len_)
@@ -680,6 +784,56 @@ class fs_api_tests(TestCase):
         
         self.fsck()
 
+    def test_copy_tree_batches(self):
+        # Force a lock release after every entry
+        interval = fs.GIL_RELEASE_INTERVAL
+        fs.GIL_RELEASE_INTERVAL = 0
+        try:
+            self._test_copy_tree_batches()
+        finally:
+            fs.GIL_RELEASE_INTERVAL = interval
+            inode_cache.RANDOMIZE_INODES = False
+            
+    def _test_copy_tree_batches(self):
+        src_inode = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
+        
+        # Several levels with a file, a symlink and a hardlink of a file
+        # in the top level directory in each of them
+        (fh, f_inode) = self.server.create(src_inode.id, 'file',
+                                           self.file_mode(), Ctx())
+        data = self.random_data(3 * self.blocksize)
+        self.server.write(fh, 0, data)
+        self.server.release(fh)
+        
+        dir_inode = src_inode
+        for i in range(3):
+            dir_inode = self.server.mkdir(dir_inode.id, 'dir%d' % i, self.dir_mode(), Ctx())
+            self.server.symlink(dir_inode.id, 'link', 'target%d' % i, Ctx())
+            self.server.link(f_inode.id, dir_inode.id, 'hardlink')
+        
+        for (name, randomize) in (('dest1', False), ('dest2', True)):
+            inode_cache.RANDOMIZE_INODES = randomize
+            dst_inode = self.server.mkdir(ROOT_INODE, name, self.dir_mode(), Ctx())
+            self.server.copy_tree(src_inode.id, dst_inode.id)
+            
+            f_inode_c = self.server.lookup(dst_inode.id, 'file')
+            self.assertNotEqual(f_inode_c.id, f_inode.id)
+            self.assertEqual(f_inode_c.refcount, 4)
+            fh = self.server.open(f_inode_c.id, os.O_RDONLY)
+            self.assertEqual(self.server.read(fh, 0, len(data)), data)
+            self.server.release(fh)
+            
+            dir_inode = dst_inode
+            for i in range(3):
+                dir_inode = self.server.lookup(dir_inode.id, 'dir%d' % i)
+                self.assertEqual(self.server.lookup(dir_inode.id, 'hardlink').id,
+                                 f_inode_c.id)
+                link_inode = self.server.lookup(dir_inode.id, 'link')
+                self.assertEqual(self.server.readlink(link_inode.id), 'target%d' % i)
+                
+        self.assertEqual(self.server.getattr(f_inode.id).refcount, 4)
+        self.fsck()
+
     def test_lock_tree(self):
 
         inode1 = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
@@ -757,6 +911,67 @@ class fs_api_tests(TestCase):
 
         self.fsck()
         
+    def test_prefetch_tree(self):
+
+        inode1 = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
+        (fh, inode1a) = self.server.create(inode1.id, 'file1',
+                                           self.file_mode(), Ctx())
+        self.server.write(fh, 0, self.random_data(2 * self.blocksize))
+        self.server.release(fh)
+        inode2 = self.server.mkdir(inode1.id, 'dir1', self.dir_mode(), Ctx())
+        (fh, inode2a) = self.server.create(inode2.id, 'file2',
+                                           self.file_mode(), Ctx())
+        self.server.write(fh, 0, self.random_data(self.blocksize))
+        self.server.release(fh)
+
+        self.block_cache.clear()
+        self.assertEqual(len(self.block_cache), 0)
+        
+        self.server.setxattr(CTRL_INODE, 'prefetch', 
+                             pickle.dumps((inode1.id, False, None)))
+        self.assertEqual(sorted(self.block_cache.entries.keys()),
+                         [ (inode1a.id, 0), (inode1a.id, 1) ])
+        self.assertEqual(pickle.loads(self.server.getxattr(CTRL_INODE, b'prefetch?')),
+                         (2, 2))
+        
+        # Cached blocks are skipped
+        self.assertEqual(self.server.prefetch_tree(inode1.id, recursive=True), 1)
+        self.assertEqual(sorted(self.block_cache.entries.keys()),
+                         [ (inode1a.id, 0), (inode1a.id, 1), (inode2a.id, 0) ])
+        
+        self.block_cache.clear()
+        self.assertEqual(self.server.prefetch_tree(inode1.id, recursive=True,
+                                                   max_bytes=self.blocksize), 1)
+        self.assertEqual(len(self.block_cache), 1)
+        self.assertEqual(self.server.prefetch_tree(inode1.id, recursive=True), 2)
+        self.assertEqual(len(self.block_cache), 3)
+        
+        self.fsck()
+        
+    def test_pin_tree(self):
+
+        inode1 = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
+        (fh, inode1a) = self.server.create(inode1.id, 'file1',
+                                           self.file_mode(), Ctx())
+        self.server.write(fh, 0, self.random_data(2 * self.blocksize))
+        self.server.release(fh)
+        self.block_cache.clear()
+        
+        self.server.setxattr(CTRL_INODE, 'pin', pickle.dumps((inode1.id, True)))
+        self.assertEqual(self.block_cache.pinned, set([inode1.id, inode1a.id]))
+        self.assertEqual(sorted(self.block_cache.entries.keys()),
+                         [ (inode1a.id, 0), (inode1a.id, 1) ])
+        self.assertEqual(self.block_cache.pinned_size, 2 * self.blocksize)
+        
+        # Pins are removed together with the inode
+        self.server.unlink(inode1.id, 'file1')
+        self.assertEqual(self.block_cache.pinned, set([inode1.id]))
+        
+        self.server.setxattr(CTRL_INODE, 'pin', pickle.dumps((inode1.id, False)))
+        self.assertFalse(self.db.has_val('SELECT 1 FROM pinned_inodes'))
+        
+        self.fsck()
+        
     def test_remove_tree(self):
 
         inode1 = self.server.mkdir(ROOT_INODE, 'source', self.dir_mode(), Ctx())
@@ -9,6 +9,7 @@ This program can be distributed under the terms of the GNU GPLv3.
 from __future__ import division, print_function
 from _common import TestCase
 from s3ql.backends import local
+from s3ql.block_cache import write_index, INDEX_NAME
 from s3ql.common import ROOT_INODE, create_tables, init_tables
 from s3ql.database import Connection, NoSuchRowError
 from s3ql.fsck import Fsck
@@ -86,6 +87,19 @@ class fsck_tests(TestCase):
         with open(self.cachedir + '%d-2' % inode, 'wb') as fh:
             fh.write('overwriting last piece of somedata')
         self.assert_fsck(self.fsck.check_cache)
+        
+        # Preserved clean entry is kept
+        with open(self.cachedir + '%d-2' % inode, 'wb') as fh:
+            fh.write('somedata')
+        self.assert_fsck(self.fsck.check_cache)
+        with open(self.cachedir + '%d-2' % inode, 'wb') as fh:
+            fh.write('somedata')
+        write_index(self.cachedir, self.db, [(inode, 2)])
+        self.fsck.found_errors = False
+        self.fsck.check_cache()
+        self.assertFalse(self.fsck.found_errors)
+        self.assertTrue(os.path.exists(self.cachedir + '%d-2' % inode))
+        self.assertTrue(os.path.exists(self.cachedir + INDEX_NAME))
                 
         
     def test_lof1(self):
@@ -125,6 +139,18 @@ class fsck_tests(TestCase):
                        0, 0, time.time(), time.time(), time.time(), 1, 0))
         self.assert_fsck(self.fsck.check_inode_refcount)
         
+    def test_pinned_inodes(self):
+        
+        inode = self.db.rowid("INSERT INTO inodes (mode,uid,gid,mtime,atime,ctime,refcount,size) "
+                              "VALUES (?,?,?,?,?,?,?,?)",
+                              (stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR,
+                               0, 0, time.time(), time.time(), time.time(), 1, 0))
+        self._link('name1', inode)
+        self.db.execute('INSERT INTO pinned_inodes (inode) VALUES(?)', (inode,))
+        self.db.execute('INSERT INTO pinned_inodes (inode) VALUES(?)', (inode + 1,))
+        self.assert_fsck(self.fsck.check_pinned_inodes)
+        self.assertEqual(self.db.get_val('SELECT inode FROM pinned_inodes'), inode)
+        
     def test_name_refcount(self):
 
         inode = self.db.rowid("INSERT INTO inodes (mode,uid,gid,mtime,atime,ctime,refcount,size) "
@@ -215,6 +241,16 @@ class fsck_tests(TestCase):
         self.db.execute('INSERT INTO objects (id, refcount) VALUES(?, ?)', (34, 1))
         self.assert_fsck(self.fsck.check_keylist)
 
+    def test_deleted_objects(self):
+        # Pending removals are not errors
+        self.bucket['s3ql_data_4364'] = 'Testdata'
+        self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (4364,))
+        self.db.execute('INSERT INTO deleted_objects (id) VALUES(?)', (4365,))
+        self.fsck.check_keylist()
+        self.assertFalse(self.fsck.found_errors)
+        self.assertFalse('s3ql_data_4364' in self.bucket)
+        self.assertFalse(self.db.has_val('SELECT 1 FROM deleted_objects'))
+
     def test_missing_obj(self):
         
         obj_id = self.db.rowid('INSERT INTO objects (refcount) VALUES(1)')
@@ -91,6 +91,41 @@ class cache_tests(TestCase):
 
         self.assertRaises(KeyError, self.cache.__getitem__, inode.id)
 
+    def test_load(self):
+        attrs = {'mode': 784,
+                'refcount': 3,
+                'uid': 7,
+                'gid': 2,
+                'size': 34674,
+                'rdev': 11,
+                'atime': time.time(),
+                'ctime': time.time(),
+                'mtime': time.time() }
+        
+        inode = self.cache.create_inode(**attrs)
+        for _ in xrange(inode_cache.CACHE_SIZE - 1):
+            self.cache.create_inode(**attrs)
+        rows = dict((row[-1], row) for row in 
+                    self.db.query('SELECT %s FROM inodes' % inode_cache.ATTRIBUTE_STR))
+        root_id = min(rows)
+        
+        # Cached inodes take precedence over the database row
+        inode.size = 42
+        self.assertIs(self.cache.load(rows[inode.id]), inode)
+        
+        # Dirty inodes are not evicted, the next slot belongs to *inode*
+        root = self.cache.load(rows[root_id])
+        self.assertEqual(root.id, root_id)
+        self.assertIs(self.cache[inode.id], inode)
+        self.assertEqual(self.db.get_val('SELECT size FROM inodes WHERE id=?', (inode.id,)),
+                         attrs['size'])
+        
+        # ..but clean ones are
+        self.cache.flush()
+        root = self.cache.load(rows[root_id])
+        self.assertIs(self.cache[root_id], root)
+        self.assertEqual(self.db.get_val('SELECT size FROM inodes WHERE id=?', (inode.id,)), 42)
+
 
 
 def suite():